@@ -10,7 +10,7 @@ from os.path import dirname, join as osj
 import shutil
 
 import vannotplus
-from vannotplus.commons import set_log_level, load_config
+from vannotplus.commons import set_log_level, load_config, parse_size
 from vannotplus.family.barcode import main_barcode, main_barcode_fast
 from vannotplus.exomiser.exomiser import main_exomiser
 from vannotplus.annot.score import main_annot
@@ -78,14 +78,21 @@ def main():
             help="Output VCF containing all samples of interest",
         )
 
-    for subparser in (barcode_parser, exomiser_parser):
-        subparser.add_argument(
-            "-a",
-            "--app",
-            type=str,
-            required=True,
-            help="STARK application",
-        )
+    barcode_parser.add_argument(
+        "-a",
+        "--app",
+        type=str,
+        required=True,
+        help="STARK application",
+    )
+    exomiser_parser.add_argument(
+        "-a",
+        "--app",
+        type=str,
+        nargs="+",
+        required=True,
+        help="STARK application, or several profiles APP:FIELD to write the annotations computed with the HPOs of each application to its own FORMAT field FIELD (FIELD_<annotation> if several annotations are added)",
+    )
 
     # separate loops to keep args in order
     default_config = osj(dirname(vannotplus.__file__), "config.yml")
@@ -98,6 +105,39 @@ def main():
             help=f"YAML config file [{default_config}]",
         )
 
+    barcode_parser.add_argument(
+        "-hf",
+        "--header_families",
+        action="store_true",
+        help="Declare each family's barcode samples once in a ##BARCODE_FAMILY header line instead of writing the BCFS field for every sample of every record",
+    )
+
+    exomiser_parser.add_argument(
+        "-nc",
+        "--no_cache",
+        action="store_true",
+        help="Run Exomiser on every sample, ignoring and not updating the Exomiser results cache (exomiser:cache_dir) [False]",
+    )
+    exomiser_parser.add_argument(
+        "-po",
+        "--phenotype_only",
+        action="store_true",
+        help="Run a reduced Exomiser analysis with the phenotype prioritisers only, without frequency nor pathogenicity filtering. Only EXOMISER_GENE_PHENO_SCORE can be added [False]",
+    )
+    exomiser_parser.add_argument(
+        "-r",
+        "--resume",
+        action="store_true",
+        help="Work in <output>.exomiser_work and checkpoint each completed sample there. Running the same command again after a failure or an interruption only runs Exomiser on missing samples [False]",
+    )
+    exomiser_parser.add_argument(
+        "-tm",
+        "--timings",
+        type=str,
+        default=None,
+        help="TSV file to write the wall time, CPU time and peak memory of each Exomiser analysis to [None]",
+    )
+
     score_parser.add_argument(
         "-vs",
         "--vannotscore",
@@ -110,6 +150,33 @@ def main():
         action="store_true",
         help="Compute Filtered Gene Mutations Count (FILT_GMC) in addition to GMC [False]",
     )
+    score_parser.add_argument(
+        "-s",
+        "--streaming",
+        action="store_true",
+        help="Compute GMC in a single pass over the input VCF, which must be sorted by coordinates. Genes are assumed to span at most gmc:max_gene_span bases (default: 2.5Mb) [False]",
+    )
+    score_parser.add_argument(
+        "-t",
+        "--threads",
+        type=int,
+        default=1,
+        help="Number of processes. If > 1, contigs are processed in parallel, which requires a tabix/CSI-indexed input VCF [1]",
+    )
+    score_parser.add_argument(
+        "-gt",
+        "--gmc_table",
+        type=str,
+        default=None,
+        help="Sidecar GMC table (.npz) of a previous run on the same merged VCF. GMC of unchanged samples is reused from it, then it is updated. Created if missing [None]",
+    )
+    score_parser.add_argument(
+        "-mm",
+        "--max_memory",
+        type=str,
+        default=None,
+        help="Memory budget of GMC counts, e.g. 500M or 4G. Past it, counts are spilled to disk next to the output. Not compatible with --threads > 1 [None]",
+    )
 
     for subparser in (barcode_parser, exomiser_parser, score_parser, config_parser):
         subparser.add_argument(
@@ -131,9 +198,18 @@ def main():
         config = load_config(args.config)
         log.debug(f"config: {config}")
         if args.subparser == "barcode":
-            main_barcode_fast(args.input, args.output, args.app, config)
+            main_barcode_fast(args.input, args.output, args.app, config, header_families=args.header_families)
         elif args.subparser == "exomiser":
-            main_exomiser(args.input, args.output, args.app, config)
+            main_exomiser(
+                args.input,
+                args.output,
+                args.app if len(args.app) > 1 else args.app[0],
+                config,
+                use_cache=not args.no_cache,
+                phenotype_only=args.phenotype_only,
+                resume=args.resume,
+                timings=args.timings,
+            )
         elif args.subparser == "score":
             main_annot(
                 args.input,
@@ -141,6 +217,10 @@ def main():
                 config,
                 do_vannotscore=args.vannotscore,
                 do_filtered_gmc=args.filtered_gmc,
+                streaming=args.streaming,
+                threads=args.threads,
+                gmc_table=args.gmc_table,
+                max_memory=parse_size(args.max_memory) if args.max_memory else None,
             )
 
 
@@ -1,3 +1,11 @@
+from collections import deque
+import hashlib
+from itertools import islice
+import os
+from os.path import join as osj
+import tempfile
+from typing import Iterable, Iterator
+
 from cyvcf2 import cyvcf2
 import logging as log
 import numpy as np
@@ -6,6 +14,14 @@ import numpy as np
 from vannotplus.commons import get_variant_id
 
 
+# Genes are assumed to never span more than this many bases (the longest human genes, e.g. CNTNAP2 or DMD, are ~2.3Mb)
+# Used by stream_gmc() to decide when a gene can no longer receive variants
+DEFAULT_MAX_GENE_SPAN = 2_500_000
+
+# Number of records read at once by GMC passes, see iter_blocks()
+DEFAULT_BLOCK_SIZE = 4096
+
+
 def get_gmc_header(gene_field: str, do_filtered_gmc) -> list[dict[str, str | int]]:
     """
     To be used with cyvcf2.VCF.set_format()
@@ -37,12 +53,70 @@ def genotypes_to_counts(genotypes: np.ndarray) -> np.ndarray:
     """
     # return [1 if 1 <= v <= 2 else 0 for v in genotypes]
     # return np.where(1 <= genotypes <= 2, 1, 0)
-    mask = (genotypes >= 1) & (genotypes <= 2)
-    return mask.astype(np.int32)
+    return genotypes_to_mask(genotypes).astype(np.int32)
+
+
+def genotypes_to_mask(genotypes: np.ndarray) -> np.ndarray:
+    """
+    Same as genotypes_to_counts() but returns a boolean array, works on a single record or a (records x samples) matrix
+    """
+    return (genotypes >= 1) & (genotypes <= 2)
+
+
+def get_allele_gt_types(variant: cyvcf2.Variant) -> np.ndarray:
+    """
+    Return a (ALT alleles x samples) matrix of genotypes of a multiallelic record, as gt_types (gts012=True) of the records obtained with bcftools norm -m-:
+    in the record of an ALT allele, this allele becomes 1 and other ALT alleles become 0 (e.g. 1/2 is HET for both alleles, 2/2 is HOM_REF for allele 1 and HOM_ALT for allele 2)
+
+    Example, for GT 1/2, 2/2, ./2 and ./.:
+    HET, HOM_REF, HOM_REF, UNKNOWN for allele 1
+    HET, HOM_ALT, HET, UNKNOWN for allele 2
+    """
+    # (samples x ploidy) allele indexes, -1 if missing, -2 if ploidy is lower than the record's max ploidy. Last column is the phasing
+    genotypes = variant.genotype.array()[:, :-1]
+    alleles = np.arange(1, len(variant.ALT) + 1, dtype=genotypes.dtype)
+    alt_counts = (genotypes[None, :, :] == alleles[:, None, None]).sum(axis=2)
+    called_counts = (genotypes >= 0).sum(axis=1)
+    partially_missing = (genotypes == -1).any(axis=1)
+    res = np.where(alt_counts == 0, 0, np.where((alt_counts == called_counts) & ~partially_missing, 2, 1))
+    res[:, called_counts == 0] = 3
+    return res
+
+
+def get_allele_index(n_values: int, variant: cyvcf2.Variant, allele: int, field: str) -> int:
+    """
+    Return the position of the allele-th (0-based) ALT allele's value among the n_values values of a field, like bcftools norm -m- would split it:
+    - Number=A fields (one value per ALT allele): value of this allele
+    - Number=R fields (one value per allele, REF included): value of this allele
+    - single values (e.g. Number=1 fields): shared by all alleles
+    """
+    if n_values == 1:
+        return 0
+    n_alts = len(variant.ALT)
+    if n_values == n_alts:
+        return allele
+    if n_values == n_alts + 1:
+        return allele + 1
+    raise ValueError(
+        f"Field {field} has {n_values} values for variant {variant.CHROM} {variant.POS} {variant.REF} {variant.ALT}, expected 1, one per ALT allele or one per allele"
+    )
+
+
+def get_allele_value(value, variant: cyvcf2.Variant, allele: int, field: str):
+    """
+    Return the value of an INFO field (as returned by cyvcf2, a tuple if it has several values) for the allele-th ALT allele, see get_allele_index()
+    """
+    if isinstance(value, tuple):
+        return value[get_allele_index(len(value), variant, allele, field)]
+    return value
 
 
-def variant_to_filtered_counts(variant: cyvcf2.Variant, default_empty_array: np.ndarray, gmc_config: dict, eps: float = 1e-8) -> np.ndarray:
+def variant_to_filtered_counts(
+    variant: cyvcf2.Variant, default_empty_array: np.ndarray, gmc_config: dict, eps: float = 1e-8, allele: int = 0
+) -> np.ndarray:
     """
+    Reference, record by record implementation of the filter. GMC passes use FilteredGmcFilter instead, which gives the same results on blocks of records.
+
     default_empty_array is an array of zeros with length equal to the number of samples in the VCF
     It is computed once and passed as an arg to avoid recomputing it for each variant
     
@@ -56,11 +130,14 @@ def variant_to_filtered_counts(variant: cyvcf2.Variant, default_empty_array: np.
 
     Note: this relies on numpy float comparisons. Due to floating point precision issues,  a variant with allele frequency exactly equal to the threshold might be considered as above or below the threshold (e.g. 0.01 might be stored as 0.009999999 or 0.010000001).
     To avoid this, a small epsilon (default: 1e-8) is added to float thresholds conservatively.
+
+    Multiallelic records are evaluated for their allele-th (0-based) ALT allele, with the genotypes and per-allele INFO and VAF values
+    this allele would have after bcftools norm -m- (see get_allele_gt_types and get_allele_index)
     """
 
     for pop_freq in gmc_config["pop_freq_fields"]:
         try:
-            if variant.INFO[pop_freq] > gmc_config["pop_freq_threshold"] + eps:
+            if get_allele_value(variant.INFO[pop_freq], variant, allele, pop_freq) > gmc_config["pop_freq_threshold"] + eps:
                 return default_empty_array
         except KeyError:
             # field not present = variant passes filter
@@ -69,7 +146,7 @@ def variant_to_filtered_counts(variant: cyvcf2.Variant, default_empty_array: np.
 
     for pop_homcount_field in gmc_config["pop_homcount_fields"]:
         try:
-            if variant.INFO[pop_homcount_field] > gmc_config["pop_homcount_threshold"]:
+            if get_allele_value(variant.INFO[pop_homcount_field], variant, allele, pop_homcount_field) > gmc_config["pop_homcount_threshold"]:
                 return default_empty_array
         except KeyError:
             pass
@@ -89,28 +166,29 @@ def variant_to_filtered_counts(variant: cyvcf2.Variant, default_empty_array: np.
 
     for inner_freq in gmc_config["allelefreq_fields"]:
         try:
-            if variant.INFO[inner_freq] > gmc_config["allelefreq_threshold"] + eps:
+            if get_allele_value(variant.INFO[inner_freq], variant, allele, inner_freq) > gmc_config["allelefreq_threshold"] + eps:
                 return default_empty_array
         except KeyError:
             pass
 
     for inner_count in gmc_config["homcount_fields"]:
         try:
-            if variant.INFO[inner_count] > gmc_config["homcount_threshold"]:
+            if get_allele_value(variant.INFO[inner_count], variant, allele, inner_count) > gmc_config["homcount_threshold"]:
                 return default_empty_array
         except KeyError:
             pass
 
     #last ones are more technical : they are sample based
-    result_array = np.ones(len(variant.gt_types), dtype=bool)
+    gt_types = variant.gt_types if len(variant.ALT) <= 1 else get_allele_gt_types(variant)[allele]
+    result_array = np.ones(len(gt_types), dtype=bool)
 
     # genotype filter
     if gmc_config["gt"] == 1:
         # keep only heterozygous variants
-        result_array &= (variant.gt_types == 1)
+        result_array &= (gt_types == 1)
     else:
         # default method: keep both HET and HOM_ALT
-        result_array = (variant.gt_types >= 1) & (variant.gt_types <= 2)
+        result_array = (gt_types >= 1) & (gt_types <= 2)
 
     # VAF filter
     try:
@@ -120,11 +198,8 @@ def variant_to_filtered_counts(variant: cyvcf2.Variant, default_empty_array: np.
     vaf_threshold = gmc_config.get("vaf_threshold", None)
 
     if vaf_array is not None and vaf_threshold is not None:
-        # this manipulation is required because cyvcf2 returns a 2D array even for single ALT alleles
-        if vaf_array.ndim == 2 and vaf_array.shape[1] == 1:
-            vaf_array = vaf_array[:, 0]
-        else:
-            raise ValueError(f"Unexpected VAF array shape: {vaf_array.shape} for variant {variant.CHROM} {variant.POS} {variant.REF} {variant.ALT}\\nThis code assumes no multiallelic records. You should be able to fix this with bcftools norm -m- <input.vcf>")
+        # cyvcf2 returns a 2D array even for single ALT alleles
+        vaf_array = vaf_array[:, get_allele_index(vaf_array.shape[1], variant, allele, "VAF")]
         result_array &= ~np.isnan(vaf_array) & (vaf_array >= vaf_threshold)
 
     log.debug(f"Variant passed all filters: {variant.CHROM} {variant.POS} {variant.REF} {variant.ALT} {vaf_array}")
@@ -140,83 +215,612 @@ def filter_gmc_by_gmc(gmc: np.ndarray, filtered_gmc: np.ndarray) -> np.ndarray:
     """
     return np.where(gmc < 2, 0, filtered_gmc)
 
-def get_gmc_by_variant(
-    vcf_path: str, gmc_config: dict, do_filtered_gmc: bool = False
-) -> tuple[dict[str, np.ndarray], dict[str, np.ndarray]]:
+class FilteredGmcFilter:
+    """
+    Vectorized version of variant_to_filtered_counts(): the AR htz filter is compiled once from the gmc config section,
+    then evaluated on blocks of records with array operations instead of one record at a time.
+
+    Site checks are evaluated column by column in the same order as variant_to_filtered_counts(): each INFO field is pulled into a NumPy array
+    for the records of the block that still pass, with NaN standing in for missing values (NaN never exceeds a threshold, so missing values pass).
+    Sample checks (genotype and VAF) are then evaluated as (records x samples) masks on the remaining records.
+
+    Rows can also be ALT alleles of multiallelic records (see AlleleRows), each row then uses the values of its allele.
+
+    See variant_to_filtered_counts() for details on each check and on the epsilon added to float thresholds.
+    """
+
+    def __init__(self, gmc_config: dict, eps: float = 1e-8) -> None:
+        # (field, threshold) pairs: a record fails if field > threshold
+        pop_thresholds = [(f, gmc_config["pop_freq_threshold"] + eps) for f in gmc_config["pop_freq_fields"]]
+        pop_thresholds += [(f, gmc_config["pop_homcount_threshold"]) for f in gmc_config["pop_homcount_fields"]]
+        inner_thresholds = [(f, gmc_config["allelefreq_threshold"] + eps) for f in gmc_config["allelefreq_fields"]]
+        inner_thresholds += [(f, gmc_config["homcount_threshold"]) for f in gmc_config["homcount_fields"]]
+        self.pop_thresholds = pop_thresholds
+        self.inner_thresholds = inner_thresholds
+        self.omim_id_field = gmc_config["omim_id_field"]
+        self.omim_inheritance_field = gmc_config["omim_inheritance_field"]
+        self.gt = gmc_config["gt"]
+        self.vaf_threshold = gmc_config.get("vaf_threshold", None)
+
+    def evaluate(self, variants: list[cyvcf2.Variant], gt_types: np.ndarray, alleles: np.ndarray | None = None) -> np.ndarray:
+        """
+        Return a (records x samples) array of 1 or 0 depending on if the filter passed for each record and sample
+
+        gt_types : (records x samples) matrix of cyvcf2.Variant.gt_types, read with gts012=True
+        alleles : 0-based ALT allele evaluated on each row (see AlleleRows), all 0 if not set
+        """
+        res = np.zeros(gt_types.shape, dtype=np.int32)
+        rows = np.arange(len(variants))
+        if alleles is None:
+            alleles = np.zeros(len(variants), dtype=np.intp)
+
+        rows = self.apply_thresholds(variants, alleles, rows, self.pop_thresholds)
+
+        # OMIM ID can't be null
+        # /!\ opposite of pop filters: absence of omim_id means fail
+        rows = rows[np.array([variants[i].INFO.get(self.omim_id_field) is not None for i in rows], dtype=bool)]
+
+        # missing inheritance passes
+        inheritance = np.array([str(variants[i].INFO.get(self.omim_inheritance_field, "AR")) for i in rows], dtype=str)
+        rows = rows[np.char.find(inheritance, "AR") >= 0]
+
+        rows = self.apply_thresholds(variants, alleles, rows, self.inner_thresholds)
+        if len(rows) == 0:
+            return res
+
+        # last ones are more technical : they are sample based
+        gt = gt_types[rows]
+        if self.gt == 1:
+            # keep only heterozygous variants
+            mask = gt == 1
+        else:
+            # default method: keep both HET and HOM_ALT
+            mask = (gt >= 1) & (gt <= 2)
+
+        if self.vaf_threshold is not None:
+            mask &= self.get_vaf_mask([variants[i] for i in rows], alleles[rows])
+
+        log.debug(f"{len(rows)}/{len(variants)} records passed site filters")
+        res[rows] = mask
+        return res
+
+    @staticmethod
+    def apply_thresholds(
+        variants: list[cyvcf2.Variant], alleles: np.ndarray, rows: np.ndarray, thresholds: list[tuple[str, float]]
+    ) -> np.ndarray:
+        """
+        Return the subset of rows for which no field is above its threshold
+        """
+        for field, threshold in thresholds:
+            if len(rows) == 0:
+                break
+            values = np.array(
+                [get_allele_value(variants[i].INFO.get(field, np.nan), variants[i], alleles[i], field) for i in rows],
+                dtype=np.float64,
+            )
+            rows = rows[~(values > threshold)]
+        return rows
+
+    def get_vaf_mask(self, variants: list[cyvcf2.Variant], alleles: np.ndarray) -> np.ndarray:
+        """
+        Return a (records x samples) mask of VAF >= vaf_threshold. Records without VAF pass, samples with a missing VAF fail.
+        All records pass if VAF is not declared in the header.
+        """
+        vaf = np.full((len(variants), len(variants[0].gt_types)), np.inf, dtype=np.float32)
+        for i, (variant, allele) in enumerate(zip(variants, alleles)):
+            try:
+                vaf_array = variant.format("VAF")
+            except KeyError:
+                vaf_array = None
+            if vaf_array is None:
+                continue
+            # cyvcf2 returns a 2D array even for single ALT alleles
+            vaf[i] = vaf_array[:, get_allele_index(vaf_array.shape[1], variant, allele, "VAF")]
+        # NaN >= threshold is False
+        return vaf >= self.vaf_threshold
+
+
+def iter_blocks(variants: Iterable[cyvcf2.Variant], block_size: int = DEFAULT_BLOCK_SIZE) -> Iterator[list[cyvcf2.Variant]]:
+    """
+    Yield lists of up to block_size consecutive records
+    """
+    variants = iter(variants)
+    while True:
+        block = list(islice(variants, block_size))
+        if not block:
+            return
+        yield block
+
+
+def get_gene(variant: cyvcf2.Variant, gene_field: str) -> str | None:
+    """
+    Return the gene of variant, or None if variant is not in a gene
+    If the gene field contains multiple genes (e.g. "GENE1/GENE2"), raise NotImplementedError
+    """
+    gene = variant.INFO.get(gene_field)
+    if gene is not None and "/" in gene:
+        raise NotImplementedError(
+            f"gene field '{gene_field}' needs to contain only one gene. Got '{gene}' for variant {get_variant_id(variant)}"
+        )
+    return gene
+
+
+class AlleleRows:
+    """
+    Genic records of a block expanded to one row per ALT allele, so that multiallelic records count as the records bcftools norm -m- would split them into.
+    Biallelic records (the usual case) are a single row with their own gt_types.
+
+    After fill():
+    - variants: record of each row, a multiallelic record is repeated for each of its ALT alleles
+    - records: position in the block of each row's record
+    - alleles: 0-based ALT allele of each row
+    - gt_types: (rows x samples) genotypes of each row, see get_allele_gt_types(). View of a buffer reused from one block to the next
+    """
+
+    def __init__(self, n_samples: int, block_size: int = DEFAULT_BLOCK_SIZE) -> None:
+        self.buffer = np.empty((block_size, n_samples), dtype=np.int8)
+        self.variants: list[cyvcf2.Variant] = []
+        self.records = np.empty(0, dtype=np.intp)
+        self.alleles = np.empty(0, dtype=np.intp)
+        self.gt_types = self.buffer[:0]
+
+    def fill(self, block: list[cyvcf2.Variant], genes: list[str | None]) -> None:
+        """
+        Expand records of block whose gene is not None
+        """
+        variants = []
+        records = []
+        alleles = []
+        n_rows = 0
+        for i, (variant, gene) in enumerate(zip(block, genes)):
+            if gene is None:
+                continue
+            n_alts = len(variant.ALT)
+            if n_alts <= 1:
+                if n_rows == len(self.buffer):
+                    self.buffer = grow(self.buffer, 2 * n_rows)
+                self.buffer[n_rows] = variant.gt_types
+                variants.append(variant)
+                records.append(i)
+                alleles.append(0)
+                n_rows += 1
+            else:
+                if n_rows + n_alts > len(self.buffer):
+                    self.buffer = grow(self.buffer, 2 * (n_rows + n_alts))
+                self.buffer[n_rows : n_rows + n_alts] = get_allele_gt_types(variant)
+                variants.extend([variant] * n_alts)
+                records.extend([i] * n_alts)
+                alleles.extend(range(n_alts))
+                n_rows += n_alts
+        self.variants = variants
+        self.records = np.array(records, dtype=np.intp)
+        self.alleles = np.array(alleles, dtype=np.intp)
+        self.gt_types = self.buffer[:n_rows]
+
+    def __len__(self) -> int:
+        return len(self.variants)
+
+
+class GmcIndex:
+    """
+    Result of the first GMC pass, indexed by record ordinal (0-based position of the record in the VCF) instead of variant IDs
+
+    - genes: gene names, in order of first appearance. A gene's position in this list is its gene code
+    - record_genes: gene code of each record, -1 if the record is not in a gene
+    - gmc: (genes x samples) matrix of GMC
+    - filtered_gmc: (genes x samples) matrix of filtered GMC, already filtered on GMC itself (see filter_gmc_by_gmc), or None if filtered GMC was not computed
+
+    Arrays grow by doubling their capacity while the VCF is read, see add_records() and finalize()
+
+    Optionally, fingerprints holds a fingerprint of each sample's genotype column (see fingerprint_block), used to reuse counts between runs (see gmc_cache.py)
+
+    If max_memory (bytes) is set, arrays that would bring the index over this budget are spilled to memory-mapped files in a temporary directory (created in spill_dir),
+    see grow_array(). Memory-mapped pages are backed by their file instead of swap, so the OS can evict them under memory pressure. Results are unchanged.
+    """
+
+    def __init__(
+        self,
+        samples: list[str],
+        do_filtered_gmc: bool = False,
+        fingerprint: bool = False,
+        max_memory: int | None = None,
+        spill_dir: str | None = None,
+    ) -> None:
+        self.max_memory = max_memory
+        self.spill_dir = spill_dir
+        self.tmp_dir: tempfile.TemporaryDirectory | None = None
+        n_samples = len(samples)
+        self.samples = list(samples)
+        self.genes: list[str] = []
+        self.gene_codes: dict[str, int] = {}
+        self.n_records = 0
+        self.record_genes = np.full(1024, -1, dtype=np.int32)
+        # We keep np.int32 type to be able to set its value to "." (minimal value of np.int32 in cyvcf2)
+        self.gmc = np.zeros((64, n_samples), dtype=np.int32)
+        self.filtered_gmc = np.zeros((64, n_samples), dtype=np.int32) if do_filtered_gmc else None
+        self.fingerprints = np.zeros(n_samples, dtype=np.uint64) if fingerprint else None
+
+    def get_gene_code(self, gene: str) -> int:
+        """
+        Return the code of gene, registering it if it was never seen before
+        """
+        code = self.gene_codes.get(gene)
+        if code is None:
+            code = len(self.genes)
+            self.genes.append(gene)
+            self.gene_codes[gene] = code
+            if code == len(self.gmc):
+                self.grow_array("gmc", 2 * code)
+                if self.filtered_gmc is not None:
+                    self.grow_array("filtered_gmc", 2 * code)
+        return code
+
+    def add_records(self, gene_codes: np.ndarray) -> None:
+        """
+        Append gene codes of consecutive records
+        """
+        n_records = self.n_records + len(gene_codes)
+        if n_records > len(self.record_genes):
+            self.grow_array("record_genes", max(2 * len(self.record_genes), n_records), fill_value=-1)
+        self.record_genes[self.n_records : n_records] = gene_codes
+        self.n_records = n_records
+
+    def get_memory_usage(self) -> int:
+        """
+        Bytes used by arrays of the index that are in memory, i.e. not spilled to disk
+        """
+        arrays = [self.record_genes, self.gmc, self.filtered_gmc, self.fingerprints]
+        return sum(a.nbytes for a in arrays if a is not None and not isinstance(a, np.memmap))
+
+    def grow_array(self, name: str, length: int, fill_value: int = 0) -> None:
+        """
+        Replace array attribute name by a copy extended to length (see grow()).
+        The copy is a memory-mapped file if the array was already spilled, or if an in-memory copy would exceed max_memory
+        """
+        array = getattr(self, name)
+        new_nbytes = length * array.nbytes // max(len(array), 1)
+        if self.max_memory is None or (
+            not isinstance(array, np.memmap) and self.get_memory_usage() - array.nbytes + new_nbytes <= self.max_memory
+        ):
+            setattr(self, name, grow(array, length, fill_value))
+            return
+        if self.tmp_dir is None:
+            self.tmp_dir = tempfile.TemporaryDirectory(prefix="gmc_", dir=self.spill_dir)
+            log.info(f"GMC index exceeds max_memory ({self.max_memory} bytes), spilling it to {self.tmp_dir.name}")
+        res = np.memmap(
+            osj(self.tmp_dir.name, f"{name}_{length}.dat"), dtype=array.dtype, mode="w+", shape=(length,) + array.shape[1:]
+        )
+        res[: len(array)] = array
+        if fill_value != 0:
+            # new files are filled with zeros
+            res[len(array) :] = fill_value
+        setattr(self, name, res)
+        if isinstance(array, np.memmap):
+            os.remove(array.filename)
+
+    def trim(self) -> None:
+        """
+        Trim arrays to their final size
+        """
+        self.record_genes = self.record_genes[: self.n_records]
+        self.gmc = self.gmc[: len(self.genes)]
+        if self.filtered_gmc is not None:
+            self.filtered_gmc = self.filtered_gmc[: len(self.genes)]
+
+    def finalize(self) -> None:
+        """
+        Trim arrays to their final size and apply the last filtered GMC step
+        """
+        self.trim()
+        if self.filtered_gmc is not None:
+            # Unlike gmc that is always null (if variant isn't in a gene) or >= 1 (if variant is in a gene),
+            # filtered_gmc can be 0 if the variant is in a gene but no variant in that gene passed the filter
+
+            # there is one ultimate step that can't be done before gmc is computed: filter filtered_gmc on gmc itself
+            # done in place by blocks of genes, so that a spilled matrix is not loaded in memory at once
+            for start in range(0, len(self.genes), DEFAULT_BLOCK_SIZE):
+                rows = slice(start, start + DEFAULT_BLOCK_SIZE)
+                self.filtered_gmc[rows] = filter_gmc_by_gmc(self.gmc[rows], self.filtered_gmc[rows])
+
+    def get(self, record: int) -> tuple[np.ndarray | None, np.ndarray | None]:
+        """
+        Return GMC and filtered GMC arrays of the record-th record, or None if it is not in a gene
+        """
+        code = self.record_genes[record]
+        if code < 0:
+            return None, None
+        if self.filtered_gmc is None:
+            return self.gmc[code], None
+        return self.gmc[code], self.filtered_gmc[code]
+
+
+def add_grouped(matrix: np.ndarray, codes: np.ndarray, values: np.ndarray, columns: np.ndarray | None = None) -> None:
+    """
+    For each row i of values: matrix[codes[i]] += values[i], as a single grouped reduction instead of a Python loop.
+    If columns is set, only these columns of values are added (to the same columns of matrix).
+
+    Consecutive rows with the same code (i.e. consecutive records of the same gene, the usual case in a sorted VCF) are summed with np.add.reduceat,
+    then run sums are added to matrix with np.add.at, which also handles codes found in several runs.
+    Boolean values are summed as int8 into an int32 accumulator, to avoid converting the whole block.
+    """
+    if len(codes) == 0 or (columns is not None and len(columns) == 0):
+        return
+    if values.dtype == bool:
+        values = values.view(np.int8)
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    if columns is None:
+        np.add.at(matrix, codes[starts], np.add.reduceat(values, starts, axis=0, dtype=matrix.dtype))
+    else:
+        sums = np.add.reduceat(values[:, columns], starts, axis=0, dtype=matrix.dtype)
+        np.add.at(matrix, (codes[starts][:, None], columns[None, :]), sums)
+
+
+def get_site_hash(variant: cyvcf2.Variant, gene: str, allele: int = 0) -> int:
+    """
+    64 bits hash of a record's position, alleles and gene, stable between runs (unlike hash())
+    For multiallelic records, the site is the allele-th ALT allele, hashed as the record bcftools norm -m- would give for it
+    """
+    alt = variant.ALT
+    if len(alt) > 1:
+        key = f"{variant.CHROM}_{variant.POS}_{variant.REF}_{[alt[allele]]}_{gene}".encode()
+    else:
+        key = f"{get_variant_id(variant)}_{gene}".encode()
+    return int.from_bytes(hashlib.blake2b(key, digest_size=8).digest(), "little")
+
+
+def fingerprint_block(site_hashes: np.ndarray, gt_types: np.ndarray, filtered_counts: np.ndarray | None) -> np.ndarray:
     """
-    Returns two dictionaries:
-    - variant_gene_dict: keys are variant IDs, values are numpy arrays of GMC for each sample
-    - filtered_variant_gene_dict: keys are variant IDs, values are numpy arrays of filtered GMC for each sample
+    Return the contribution of a block of genic records to each sample's fingerprint, to be summed (modulo 2**64) over all blocks.
+
+    Only records where the sample is HET or HOM_ALT contribute, through a hash of (site, genotype, filtered GMC result).
+    As hom ref and missing genotypes do not contribute to GMC either, a sample's fingerprint only changes if its GMC can change:
+    adding records or samples to a merged VCF does not change fingerprints of existing samples, unless they have a variant at the new records.
+    The sum is order independent, so fingerprints do not depend on how records are split into blocks or contigs.
 
-    Steps:
-    1) build a gene to GMC mapping
-        If do_filtered_gmc is True, apply the same logic but only for variants passing the filter
-    2) build a variant to GMC mapping using the gene to GMC mapping
+    site_hashes: (records) uint64 array from get_site_hash()
+    gt_types: (records x samples) genotypes, read with gts012=True
+    filtered_counts: (records x samples) result of FilteredGmcFilter.evaluate(), or None
+    """
+    values = gt_types.astype(np.uint64)
+    if filtered_counts is not None:
+        values += np.uint64(4) * filtered_counts.astype(np.uint64)
+    # splitmix64 finalizer, overflows are intended
+    z = site_hashes[:, None] + values * np.uint64(0x9E3779B97F4A7C15)
+    z = (z ^ (z >> np.uint64(30))) * np.uint64(0xBF58476D1CE4E5B9)
+    z = (z ^ (z >> np.uint64(27))) * np.uint64(0x94D049BB133111EB)
+    z ^= z >> np.uint64(31)
+    z[~genotypes_to_mask(gt_types)] = 0
+    return z.sum(axis=0, dtype=np.uint64)
+
+
+def grow(array: np.ndarray, length: int, fill_value: int = 0) -> np.ndarray:
+    """
+    Return a copy of array extended along its first axis to length, new cells are set to fill_value
+    """
+    res = np.full((length,) + array.shape[1:], fill_value, dtype=array.dtype)
+    res[: len(array)] = array
+    return res
+
+
+def get_gmc_index(
+    vcf_path: str,
+    gmc_config: dict,
+    do_filtered_gmc: bool = False,
+    region: str | None = None,
+    finalize: bool = True,
+    samples: list[str] | None = None,
+    count_columns: np.ndarray | None = None,
+    fingerprint: bool = False,
+    max_memory: int | None = None,
+    spill_dir: str | None = None,
+) -> GmcIndex:
+    """
+    First pass of the two-pass GMC path. Returns a GmcIndex holding, for each record, the code of its gene,
+    and for each gene, the GMC (and optionally filtered GMC) of each sample.
 
-    If do_filtered_gmc is True, a second dictionary is built along the way, counting only variants passing the filter
+    The second pass must read the same VCF (or region) in the same order, and can then get GMC by record ordinal with GmcIndex.get()
 
+    If region is set, only records of this region are read, which requires an indexed VCF.
+    Partial indexes obtained with finalize=False can then be combined with merge_gmc_indexes()
 
-    If a variant is not in a gene, it is not included in the output dictionaries
+    Options used by incremental GMC (see gmc_cache.py):
+    - samples: only read these samples (GMC columns are then in VCF order for this subset)
+    - count_columns: only count GMC for these sample columns, other columns are left to 0
+    - fingerprint: also compute the fingerprint of each sample's genotype column (see fingerprint_block)
+
+    max_memory and spill_dir: memory budget of the index, see GmcIndex
+
+    If a variant is not in a gene, its gene code is -1
     If a gene field contains multiple genes (e.g. "GENE1/GENE2"), raise NotImplementedError
-    GMC is computed as the sum of genotypes (HET=1, HOM_ALT=2) for each sample
+    GMC is computed as the number of variants where each sample is HET or HOM_ALT
     The filtered GMC is computed similarly but only for variants passing the filter
+    Each ALT allele of a multiallelic record counts as a variant, as if the VCF was normalized with bcftools norm -m- (see AlleleRows)
     """
     # gts012=True is extremely important for genotypes_to_counts
-    vcf = cyvcf2.VCF(vcf_path, gts012=True)
-    variant_gene_dict = {}
-    filtered_variant_gene_dict = {}
-    gene_gmc_dict = {}
-    gene_filtered_gmc_dict = {}
-    # We keep np.int32 type to be able to set its value to "." (minimal value of np.int32 in cyvcf2)
-    default_filtered_gmc = np.zeros(len(vcf.samples), dtype=np.int32)
+    vcf = cyvcf2.VCF(vcf_path, gts012=True, samples=samples)
+    index = GmcIndex(
+        vcf.samples, do_filtered_gmc=do_filtered_gmc, fingerprint=fingerprint, max_memory=max_memory, spill_dir=spill_dir
+    )
+    gmc_filter = FilteredGmcFilter(gmc_config) if do_filtered_gmc else None
+    # preallocated block buffers: gene code of each record, and genic records expanded to one row per ALT allele
+    record_codes = np.empty(DEFAULT_BLOCK_SIZE, dtype=np.int32)
+    rows = AlleleRows(len(vcf.samples))
 
     log.debug(f"do_filtered_gmc: {do_filtered_gmc}")
-    for variant in vcf:
-        key = get_variant_id(variant)
-        try:
-            gene = variant.INFO[gmc_config["gene_field"]]
-        except KeyError:
-            # variant is not in a gene
+    for block in iter_blocks(vcf(region) if region else vcf, DEFAULT_BLOCK_SIZE):
+        genes = [get_gene(variant, gmc_config["gene_field"]) for variant in block]
+        for i, gene in enumerate(genes):
+            # -1 if variant is not in a gene
+            record_codes[i] = -1 if gene is None else index.get_gene_code(gene)
+        index.add_records(record_codes[: len(block)])
+
+        rows.fill(block, genes)
+        if len(rows) == 0:
             continue
-        variant_gene_dict[key] = gene
-
-        if gene in gene_gmc_dict:
-            gene_gmc_dict[gene] = np.add(
-                gene_gmc_dict[gene], genotypes_to_counts(variant.gt_types)
-            )
-        else:
-            gene_gmc_dict[gene] = genotypes_to_counts(variant.gt_types)
-
-        # if gene == "DVL1":
-        #     print(variant)
-        #     print(variant.CHROM, variant.POS, variant.REF, variant.ALT, variant.gt_types)
-        #     print(gene_gmc_dict[gene])
-
+        genic_codes = record_codes[rows.records]
+        add_grouped(index.gmc, genic_codes, genotypes_to_mask(rows.gt_types), count_columns)
         # same for filtered GMC
+        filtered_counts = None
         if do_filtered_gmc:
-                if gene in gene_filtered_gmc_dict:
-                    gene_filtered_gmc_dict[gene] = np.add(
-                        gene_filtered_gmc_dict[gene],
-                        variant_to_filtered_counts(variant, default_filtered_gmc, gmc_config),
-                    )
-                else:
-                    gene_filtered_gmc_dict[gene] = variant_to_filtered_counts(variant, default_filtered_gmc, gmc_config)
-
-    # overwrite genes with GMC in variant_gene_dict to save RAM
-    for variant, gene in variant_gene_dict.items():
-        if "/" in gene:
-            raise NotImplementedError(
-                f"gene field '{gmc_config['gene_field']}' needs to contain only one gene. Got '{gene}' for variant {variant}"
+            filtered_counts = gmc_filter.evaluate(rows.variants, rows.gt_types, rows.alleles)
+            add_grouped(index.filtered_gmc, genic_codes, filtered_counts, count_columns)
+        if fingerprint:
+            site_hashes = np.array(
+                [get_site_hash(v, genes[r], a) for v, r, a in zip(rows.variants, rows.records, rows.alleles)], dtype=np.uint64
             )
-        variant_gene_dict[variant] = gene_gmc_dict[gene]
+            index.fingerprints += fingerprint_block(site_hashes, rows.gt_types, filtered_counts)
+
+    vcf.close()
+    if finalize:
+        index.finalize()
+    else:
+        index.trim()
+    return index
 
-        if do_filtered_gmc:
-            # Unlike gmc that is always null (if variant isn't in a gene) or >= 1 (if variant is in a gene),
-            # filtered_gmc can be 0 if the variant is in a gene but no variant in that gene passed the filter
 
-            #there is one ultimate step that can't be done before gmc is computed: filter filtered_gmc on gmc itself
-            final_filtered_gmc = filter_gmc_by_gmc(gene_gmc_dict[gene], gene_filtered_gmc_dict[gene])
+def merge_gmc_indexes(indexes: list[GmcIndex]) -> None:
+    """
+    Combine partial (not finalized) GMC indexes computed on distinct parts of the same VCF, e.g. one per contig.
+    Counts of each gene are summed over all indexes, then every index is updated in place with the total counts and finalized,
+    so it gives the same GMC as an index computed on the whole VCF.
 
-            filtered_variant_gene_dict[variant] = final_filtered_gmc
+    Genes are usually contig-specific, but the same gene name can be found on several contigs (e.g. PAR genes on chrX/chrY) and is then counted once over all of them.
+    """
+    if len(indexes) == 0:
+        return
+    total = GmcIndex(indexes[0].samples, do_filtered_gmc=indexes[0].filtered_gmc is not None)
+    for index in indexes:
+        for code, gene in enumerate(index.genes):
+            total_code = total.get_gene_code(gene)
+            total.gmc[total_code] += index.gmc[code]
+            if total.filtered_gmc is not None:
+                total.filtered_gmc[total_code] += index.filtered_gmc[code]
+    total.finalize()
+
+    for index in indexes:
+        total_codes = [total.gene_codes[gene] for gene in index.genes]
+        index.gmc = total.gmc[total_codes]
+        if total.filtered_gmc is not None:
+            index.filtered_gmc = total.filtered_gmc[total_codes]
+
+
+def stream_gmc(
+    vcf: cyvcf2.VCF,
+    gmc_config: dict,
+    do_filtered_gmc: bool = False,
+    max_gene_span: int = DEFAULT_MAX_GENE_SPAN,
+) -> Iterator[tuple[cyvcf2.Variant, np.ndarray | None, np.ndarray | None]]:
+    """
+    Single-pass alternative to get_gmc_index() for coordinate-sorted VCFs.
+    Yields (variant, GMC, filtered GMC) in input order. GMC arrays are None if the variant is not in a gene (filtered GMC is also None if do_filtered_gmc is False).
 
-    return variant_gene_dict, filtered_variant_gene_dict
+    Records are buffered until every gene they belong to is "closed", i.e. can no longer receive variants:
+    - the current record is on another contig than the gene's first variant
+    - or the current position is more than max_gene_span bases after the gene's first variant
+    Only records of genes still open at the current position are kept in memory.
+
+    Output is identical to the two-pass path as long as:
+    - the input is sorted by coordinates (checked, raises ValueError otherwise)
+    - no gene spans more than max_gene_span bases, and a gene name is never reused on another contig (checked, raises ValueError otherwise)
+
+    vcf must be opened with gts012=True
+    """
+    n_samples = len(vcf.samples)
+    gmc_filter = FilteredGmcFilter(gmc_config) if do_filtered_gmc else None
+
+    # gene -> (contig, position of its first variant); dicts keep insertion order, so genes are sorted by first position
+    open_genes: dict[str, tuple[str, int]] = {}
+    closed_genes: set[str] = set()
+    gene_gmc_dict: dict[str, np.ndarray] = {}
+    gene_filtered_gmc_dict: dict[str, np.ndarray] = {}
+    # number of buffered records per gene, to free counts as soon as a closed gene is fully written
+    pending: dict[str, int] = {}
+    buffer: deque[tuple[cyvcf2.Variant, str | None]] = deque()
+    seen_contigs: set[str] = set()
+    current_contig = None
+    last_pos = 0
+
+    def close_genes(contig: str | None, pos: int) -> None:
+        while open_genes:
+            gene, (gene_contig, first_pos) = next(iter(open_genes.items()))
+            if gene_contig == contig and pos <= first_pos + max_gene_span:
+                break
+            del open_genes[gene]
+            closed_genes.add(gene)
+
+    def flush() -> Iterator[tuple[cyvcf2.Variant, np.ndarray | None, np.ndarray | None]]:
+        while buffer:
+            variant, gene = buffer[0]
+            if gene is None:
+                buffer.popleft()
+                yield variant, None, None
+                continue
+            if gene in open_genes:
+                break
+            buffer.popleft()
+            gmc = gene_gmc_dict[gene]
+            filtered_gmc = None
+            if do_filtered_gmc:
+                filtered_gmc = filter_gmc_by_gmc(gmc, gene_filtered_gmc_dict[gene])
+            pending[gene] -= 1
+            if pending[gene] == 0:
+                del pending[gene]
+                del gene_gmc_dict[gene]
+                if do_filtered_gmc:
+                    del gene_filtered_gmc_dict[gene]
+            yield variant, gmc, filtered_gmc
+
+    rows = AlleleRows(n_samples)
+    for block in iter_blocks(vcf, DEFAULT_BLOCK_SIZE):
+        genes = [get_gene(variant, gmc_config["gene_field"]) for variant in block]
+        rows.fill(block, genes)
+        # counts of each record, summed over its ALT alleles
+        counts = np.zeros((len(block), n_samples), dtype=np.int32)
+        add_grouped(counts, rows.records, genotypes_to_mask(rows.gt_types))
+        if do_filtered_gmc:
+            filtered_counts = np.zeros((len(block), n_samples), dtype=np.int32)
+            if len(rows):
+                add_grouped(filtered_counts, rows.records, gmc_filter.evaluate(rows.variants, rows.gt_types, rows.alleles))
+
+        for i, variant in enumerate(block):
+            if variant.CHROM != current_contig:
+                if variant.CHROM in seen_contigs:
+                    raise ValueError(
+                        f"Streaming GMC requires a coordinate-sorted VCF, contig {variant.CHROM} was seen twice. Sort the input or disable streaming."
+                    )
+                seen_contigs.add(variant.CHROM)
+                current_contig = variant.CHROM
+            elif variant.POS < last_pos:
+                raise ValueError(
+                    f"Streaming GMC requires a coordinate-sorted VCF, got {variant.CHROM}:{variant.POS} after {variant.CHROM}:{last_pos}. Sort the input or disable streaming."
+                )
+            last_pos = variant.POS
+
+            close_genes(variant.CHROM, variant.POS)
+            yield from flush()
+
+            gene = genes[i]
+            if gene is None:
+                # variant is not in a gene
+                buffer.append((variant, None))
+                yield from flush()
+                continue
+            if gene in closed_genes:
+                raise ValueError(
+                    f"Gene {gene} received a variant at {variant.CHROM}:{variant.POS} after being closed. It either spans more than {max_gene_span} bases or is present on several contigs. Increase gmc:max_gene_span in config or disable streaming."
+                )
+
+            if gene not in open_genes:
+                open_genes[gene] = (variant.CHROM, variant.POS)
+                gene_gmc_dict[gene] = counts[i].copy()
+                if do_filtered_gmc:
+                    gene_filtered_gmc_dict[gene] = filtered_counts[i].copy()
+            else:
+                gene_gmc_dict[gene] += counts[i]
+                if do_filtered_gmc:
+                    gene_filtered_gmc_dict[gene] += filtered_counts[i]
+            pending[gene] = pending.get(gene, 0) + 1
+            buffer.append((variant, gene))
+
+    close_genes(None, 0)
+    yield from flush()
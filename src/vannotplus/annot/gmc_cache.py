@@ -0,0 +1,193 @@
+"""
+Incremental GMC: reuse GMC of samples already counted in a previous run.
+
+Merged VCFs of an application are regenerated each time a run adds a few samples.
+A sidecar GMC table (.npz) stores, for each sample of the previous run, its GMC for each gene and a fingerprint of its genotype column (see gmc.fingerprint_block).
+On the next run, samples with an unchanged fingerprint reuse their counts. Only new and changed samples are counted.
+"""
+
+import hashlib
+import json
+import logging as log
+import os
+
+from cyvcf2 import cyvcf2
+import numpy as np
+
+from vannotplus.annot.gmc import GmcIndex, get_gmc_index
+from vannotplus.commons import atomic_write
+
+# increase if the content of the table or the way fingerprints are computed changes
+GMC_CACHE_VERSION = 1
+
+
+class GmcCache:
+    """
+    Content of a sidecar GMC table
+    - config: fingerprint of the gmc config section (see get_config_fingerprint)
+    - samples, fingerprints: sample names and fingerprints of their genotype column
+    - genes: gene names
+    - gmc: (genes x samples) GMC matrix
+    - filtered_gmc: (genes x samples) filtered GMC matrix, before filter_gmc_by_gmc(), or None
+    """
+
+    def __init__(
+        self,
+        config: str,
+        samples: list[str],
+        fingerprints: np.ndarray,
+        genes: list[str],
+        gmc: np.ndarray,
+        filtered_gmc: np.ndarray | None,
+    ) -> None:
+        self.config = config
+        self.samples = samples
+        self.fingerprints = fingerprints
+        self.genes = genes
+        self.gmc = gmc
+        self.filtered_gmc = filtered_gmc
+
+    @classmethod
+    def load(cls, path: str) -> "GmcCache":
+        with np.load(path, allow_pickle=False) as f:
+            if int(f["version"]) != GMC_CACHE_VERSION:
+                raise ValueError(f"Unsupported GMC table version in {path}: {int(f['version'])}")
+            return cls(
+                str(f["config"]),
+                f["samples"].tolist(),
+                f["fingerprints"],
+                f["genes"].tolist(),
+                f["gmc"],
+                f["filtered_gmc"] if "filtered_gmc" in f else None,
+            )
+
+    def save(self, path: str) -> None:
+        """
+        Write the table atomically, so that an interrupted run does not leave a truncated table behind
+        """
+        arrays = {
+            "version": np.array(GMC_CACHE_VERSION),
+            "config": np.array(self.config),
+            "samples": np.array(self.samples, dtype=str),
+            "fingerprints": self.fingerprints,
+            "genes": np.array(self.genes, dtype=str),
+            "gmc": self.gmc,
+        }
+        if self.filtered_gmc is not None:
+            arrays["filtered_gmc"] = self.filtered_gmc
+        with atomic_write(path) as f:
+            np.savez(f, **arrays)
+
+
+def get_config_fingerprint(gmc_config: dict, do_filtered_gmc: bool) -> str:
+    """
+    Counts can only be reused if they were computed with the same GMC parameters
+    """
+    relevant = {k: v for k, v in gmc_config.items() if k not in ("do_filtered_gmc", "max_gene_span")}
+    relevant["do_filtered_gmc"] = do_filtered_gmc
+    return hashlib.sha256(json.dumps(relevant, sort_keys=True).encode()).hexdigest()
+
+
+def copy_columns(index: GmcIndex, source: GmcIndex | GmcCache, samples: list[str]) -> None:
+    """
+    Copy GMC (and filtered GMC) of samples from source to index, matching genes and samples by name.
+    Genes of index absent from source keep their current value (0 for columns that were not counted)
+    """
+    if len(samples) == 0:
+        return
+    source_positions = {s: i for i, s in enumerate(source.samples)}
+    index_positions = {s: i for i, s in enumerate(index.samples)}
+    source_columns = [source_positions[s] for s in samples]
+    index_columns = [index_positions[s] for s in samples]
+    source_rows = []
+    index_rows = []
+    for source_row, gene in enumerate(source.genes):
+        if gene in index.gene_codes:
+            source_rows.append(source_row)
+            index_rows.append(index.gene_codes[gene])
+    index.gmc[np.ix_(index_rows, index_columns)] = source.gmc[np.ix_(source_rows, source_columns)]
+    if index.filtered_gmc is not None:
+        index.filtered_gmc[np.ix_(index_rows, index_columns)] = source.filtered_gmc[np.ix_(source_rows, source_columns)]
+
+
+def get_incremental_gmc_index(
+    vcf_path: str,
+    gmc_config: dict,
+    do_filtered_gmc: bool,
+    cache_path: str,
+    max_memory: int | None = None,
+    spill_dir: str | None = None,
+) -> GmcIndex:
+    """
+    Same result as get_gmc_index(), reusing counts stored in cache_path by a previous run, then updating it.
+
+    1) The input is read once to count GMC of samples absent from the table, and to fingerprint every sample
+    2) Samples whose fingerprint differs from the table are counted again, reading only their genotype columns
+    3) Other samples get their counts from the table
+
+    If the table does not exist or was computed with another gmc config, every sample is counted.
+    max_memory and spill_dir: memory budget of the index, see GmcIndex
+    """
+    config = get_config_fingerprint(gmc_config, do_filtered_gmc)
+    cache = None
+    if os.path.exists(cache_path):
+        cache = GmcCache.load(cache_path)
+        if cache.config != config:
+            log.info(f"GMC table {cache_path} was computed with another gmc config, counting all samples")
+            cache = None
+
+    vcf = cyvcf2.VCF(vcf_path)
+    samples = vcf.samples
+    vcf.close()
+    cached_fingerprints = {}
+    if cache is not None:
+        cached_fingerprints = dict(zip(cache.samples, cache.fingerprints))
+    count_columns = np.array([i for i, s in enumerate(samples) if s not in cached_fingerprints], dtype=np.intp)
+
+    index = get_gmc_index(
+        vcf_path,
+        gmc_config,
+        do_filtered_gmc=do_filtered_gmc,
+        finalize=False,
+        count_columns=count_columns,
+        fingerprint=True,
+        max_memory=max_memory,
+        spill_dir=spill_dir,
+    )
+
+    changed = []
+    reused = []
+    for s, fingerprint in zip(samples, index.fingerprints):
+        if s in cached_fingerprints:
+            if cached_fingerprints[s] == fingerprint:
+                reused.append(s)
+            else:
+                changed.append(s)
+    log.info(
+        f"GMC table: {len(reused)} samples reused, {len(changed)} changed, {len(count_columns)} new"
+    )
+
+    if changed:
+        recount = get_gmc_index(
+            vcf_path,
+            gmc_config,
+            do_filtered_gmc=do_filtered_gmc,
+            finalize=False,
+            samples=changed,
+            max_memory=max_memory,
+            spill_dir=spill_dir,
+        )
+        copy_columns(index, recount, changed)
+    copy_columns(index, cache, reused)
+
+    GmcCache(
+        config,
+        index.samples,
+        index.fingerprints,
+        index.genes,
+        index.gmc,
+        index.filtered_gmc,
+    ).save(cache_path)
+
+    index.finalize()
+    return index
@@ -1,11 +1,34 @@
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+import io
 import logging as log
+import os
+from os.path import join as osj
+import shutil
+import tempfile
+from typing import Iterator
 
 from cyvcf2 import cyvcf2
 import numpy as np
 
-from vannotplus.annot.gmc import get_gmc_by_variant, get_gmc_header
+from vannotplus.annot.gmc import (
+    DEFAULT_MAX_GENE_SPAN,
+    GmcIndex,
+    get_gmc_header,
+    get_gmc_index,
+    merge_gmc_indexes,
+    stream_gmc,
+)
+from vannotplus.annot.gmc_cache import get_incremental_gmc_index
 from vannotplus.annot.splicing import get_splicing_score
-from vannotplus.commons import get_variant_id, get_variant_info
+from vannotplus.commons import (
+    BGZF_EOF,
+    bgzf_compress,
+    get_indexed_contigs,
+    get_peak_rss,
+    get_variant_info,
+    read_vcf_header,
+)
 
 
 MIN_INT32 = np.iinfo(np.int32).min
@@ -35,12 +58,33 @@ def replace_empty_genotype(gt_types: np.ndarray, format_field: np.ndarray) -> np
     res[gt_types == 3] = MIN_INT32
     return res
 
+def lookup_gmc(
+    vcf: cyvcf2.VCF, gmc_index: GmcIndex
+) -> Iterator[tuple[cyvcf2.Variant, np.ndarray | None, np.ndarray | None]]:
+    """
+    Second pass of the two-pass GMC path: yields (variant, GMC, filtered GMC) like stream_gmc()
+    Records are matched to the first pass by their ordinal, so vcf must be the same file as the one given to get_gmc_index()
+    """
+    n_records = 0
+    for i, variant in enumerate(vcf):
+        if i >= gmc_index.n_records:
+            raise ValueError(f"VCF has more records than during the first GMC pass ({gmc_index.n_records})")
+        gmc, filtered_gmc = gmc_index.get(i)
+        yield variant, gmc, filtered_gmc
+        n_records = i + 1
+    if n_records != gmc_index.n_records:
+        raise ValueError(f"VCF has {n_records} records, expected {gmc_index.n_records} from the first GMC pass")
+
 def main_annot(
     input_vcf_path: str,
     output_vcf_path: str,
     config: dict,
     do_vannotscore: bool = False,
     do_filtered_gmc: bool = False,
+    streaming: bool = False,
+    threads: int = 1,
+    gmc_table: str | None = None,
+    max_memory: int | None = None,
 ) -> None:
     """
     VANNOT score has been replaced by PZTScore_transcript computed by howard
@@ -50,12 +94,81 @@ def main_annot(
     This code is still required in VANNOT to add GMC to the final VCF
 
     if config["gmc"]["do_filtered_gmc"] == True: compute filtered GMC as well. This overrides the function argument do_filtered_gmc
+
+    if streaming == True: compute GMC in a single pass over the input, which must be sorted by coordinates (see stream_gmc)
+    Otherwise the input is read twice: once to count, once to write
+
+    if threads > 1: process contigs in parallel, see main_annot_parallel. Requires an indexed input VCF
+
+    if gmc_table is set: reuse GMC of samples already counted in this sidecar table by a previous run, then update it (see gmc_cache.py)
+    Only compatible with the default two-pass path
+
+    if max_memory is set (bytes): GMC counts of the two-pass path are spilled to disk past this budget (see GmcIndex).
+    Streaming GMC only holds the genes currently open, so it is not affected
+    Peak RSS is logged at the end
     """
     gmc_config_check(config)
     if config["gmc"]["do_filtered_gmc"]:
         # if specified in config, override function argument
         do_filtered_gmc = True
+    log.debug(config)
+
+    if gmc_table and (streaming or threads > 1):
+        raise ValueError("A GMC table can only be used with the default two-pass GMC (no streaming, threads = 1)")
+    if max_memory is not None and threads > 1:
+        raise ValueError("max_memory can not be combined with threads > 1, as GMC counts of each contig are sent back to the main process")
+
+    if threads > 1:
+        if streaming:
+            raise ValueError("Streaming GMC can not be combined with threads > 1")
+        if output_vcf_path.endswith(".bcf"):
+            log.warning("Multithreaded annot can only write VCF or bgzipped VCF, falling back to a single thread for BCF output")
+        else:
+            main_annot_parallel(input_vcf_path, output_vcf_path, config, threads, do_vannotscore, do_filtered_gmc)
+            log_peak_rss(workers=True)
+            return
+
+    input_vcf = open_annot_vcf(input_vcf_path, config, do_vannotscore, do_filtered_gmc)
+
+    if streaming:
+        annotated_variants = stream_gmc(
+            input_vcf,
+            config["gmc"],
+            do_filtered_gmc=do_filtered_gmc,
+            max_gene_span=config["gmc"].get("max_gene_span", DEFAULT_MAX_GENE_SPAN),
+        )
+    else:
+        spill_dir = os.path.dirname(os.path.abspath(output_vcf_path))
+        if gmc_table:
+            gmc_index = get_incremental_gmc_index(
+                input_vcf_path, config["gmc"], do_filtered_gmc, gmc_table, max_memory=max_memory, spill_dir=spill_dir
+            )
+        else:
+            gmc_index = get_gmc_index(
+                input_vcf_path, config["gmc"], do_filtered_gmc=do_filtered_gmc, max_memory=max_memory, spill_dir=spill_dir
+            )
+        annotated_variants = lookup_gmc(input_vcf, gmc_index)
 
+    output_vcf = cyvcf2.Writer(output_vcf_path, input_vcf)
+    write_annotated_variants(annotated_variants, output_vcf, config, do_vannotscore, do_filtered_gmc)
+    output_vcf.close()
+    log_peak_rss()
+
+
+def log_peak_rss(workers: bool = False) -> None:
+    peak_rss, peak_rss_children = get_peak_rss()
+    message = f"Peak RSS: {peak_rss / 1024**2:.1f} MB"
+    if workers:
+        message += f" (largest worker process: {peak_rss_children / 1024**2:.1f} MB)"
+    log.info(message)
+
+
+def open_annot_vcf(
+    input_vcf_path: str, config: dict, do_vannotscore: bool, do_filtered_gmc: bool
+) -> cyvcf2.VCF:
+    """
+    Open input VCF with the header lines added by main_annot
+    """
     input_vcf = cyvcf2.VCF(input_vcf_path, gts012=True)
 
     if do_vannotscore:
@@ -68,36 +181,129 @@ def main_annot(
             }
         )
 
-    log.debug(config)
     for header in get_gmc_header(config["gmc"]["gene_field"], do_filtered_gmc):
         input_vcf.add_format_to_header(header)
 
-    variant_gmc_dic, variant_filtered_gmc_dic = get_gmc_by_variant(
-        input_vcf_path, config["gmc"], do_filtered_gmc=do_filtered_gmc
-    )
+    return input_vcf
 
-    output_vcf = cyvcf2.Writer(output_vcf_path, input_vcf)
 
-    for variant in input_vcf:
+def write_annotated_variants(
+    annotated_variants: Iterator[tuple[cyvcf2.Variant, np.ndarray | None, np.ndarray | None]],
+    output_vcf: cyvcf2.Writer,
+    config: dict,
+    do_vannotscore: bool,
+    do_filtered_gmc: bool,
+) -> None:
+    for variant, gmc, filtered_gmc in annotated_variants:
         # vannotscore
         if do_vannotscore:
             variant.INFO["vannotscore"] = get_score(variant, config)
 
         # GMC
-        variant_id = get_variant_id(variant)
-        try:
-            gmc_with_null = replace_empty_genotype(variant.gt_types, variant_gmc_dic[variant_id])
+        if gmc is not None:
+            gmc_with_null = replace_empty_genotype(variant.gt_types, gmc)
             variant.set_format("GMC", gmc_with_null)
             if do_filtered_gmc:
-                gmc_filtered_with_null = replace_empty_genotype(variant.gt_types, variant_filtered_gmc_dic[variant_id])
+                gmc_filtered_with_null = replace_empty_genotype(variant.gt_types, filtered_gmc)
                 variant.set_format("GMC_FILTERED", gmc_filtered_with_null)
-        except KeyError:
-            # variant is not in a gene
-            pass
+        # else: variant is not in a gene
 
         output_vcf.write_record(variant)
 
+
+def main_annot_parallel(
+    input_vcf_path: str,
+    output_vcf_path: str,
+    config: dict,
+    threads: int,
+    do_vannotscore: bool = False,
+    do_filtered_gmc: bool = False,
+) -> None:
+    """
+    Map-reduce version of main_annot, with contigs processed by a pool of processes:
+    1) map: GMC is counted for each contig separately, using the tabix/CSI index of the input VCF
+    2) reduce: counts are summed over contigs with merge_gmc_indexes()
+    3) each contig is annotated in its own chunk file
+    4) chunks are concatenated in the input's contig order
+    Output is identical to main_annot's. It can be a plain VCF or a bgzipped VCF (.gz), in which case each chunk is compressed by its own worker.
+    """
+    contigs = get_indexed_contigs(input_vcf_path)
+    if len(contigs) == 0:
+        log.info(f"No record in {input_vcf_path}, running annot on a single thread")
+        main_annot(input_vcf_path, output_vcf_path, config, do_vannotscore, do_filtered_gmc)
+        return
+    compress = output_vcf_path.endswith(".gz")
+    tmp_dir = tempfile.TemporaryDirectory(dir=os.path.dirname(os.path.abspath(output_vcf_path)))
+    chunks = [osj(tmp_dir.name, f"chunk_{i}.vcf") for i in range(len(contigs))]
+    log.info(f"Computing GMC on {len(contigs)} contigs with {threads} processes")
+
+    with ProcessPoolExecutor(max_workers=threads) as executor:
+        gmc_indexes = list(
+            executor.map(
+                get_gmc_index,
+                repeat(input_vcf_path),
+                repeat(config["gmc"]),
+                repeat(do_filtered_gmc),
+                contigs,
+                repeat(False),
+            )
+        )
+        merge_gmc_indexes(gmc_indexes)
+        for _ in executor.map(
+            write_annotated_chunk,
+            repeat(input_vcf_path),
+            contigs,
+            gmc_indexes,
+            chunks,
+            repeat(config),
+            repeat(do_vannotscore),
+            repeat(do_filtered_gmc),
+            repeat(compress),
+        ):
+            pass
+
+    with open(output_vcf_path, "wb") as output_vcf:
+        with open(chunks[0], "rb") as f:
+            header = read_vcf_header(f)
+        if compress:
+            bgzf_compress(io.BytesIO(header), output_vcf)
+            for chunk in chunks:
+                with open(chunk + ".gz", "rb") as f:
+                    shutil.copyfileobj(f, output_vcf)
+            output_vcf.write(BGZF_EOF)
+        else:
+            output_vcf.write(header)
+            for chunk in chunks:
+                with open(chunk, "rb") as f:
+                    read_vcf_header(f)
+                    shutil.copyfileobj(f, output_vcf)
+    tmp_dir.cleanup()
+
+
+def write_annotated_chunk(
+    input_vcf_path: str,
+    region: str,
+    gmc_index: GmcIndex,
+    chunk_path: str,
+    config: dict,
+    do_vannotscore: bool,
+    do_filtered_gmc: bool,
+    compress: bool,
+) -> None:
+    """
+    Worker of main_annot_parallel: write annotated records of region in chunk_path as a plain VCF.
+    If compress is True, records (without header) are also written as BGZF blocks in chunk_path + ".gz"
+    """
+    input_vcf = open_annot_vcf(input_vcf_path, config, do_vannotscore, do_filtered_gmc)
+    output_vcf = cyvcf2.Writer(chunk_path, input_vcf)
+    write_annotated_variants(lookup_gmc(input_vcf(region), gmc_index), output_vcf, config, do_vannotscore, do_filtered_gmc)
     output_vcf.close()
+    input_vcf.close()
+
+    if compress:
+        with open(chunk_path, "rb") as f, open(chunk_path + ".gz", "wb") as out:
+            read_vcf_header(f)
+            bgzf_compress(f, out)
 
 
 def get_score(variant: cyvcf2.Variant, config: dict) -> int:
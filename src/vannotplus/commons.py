@@ -1,12 +1,20 @@
+from contextlib import contextmanager
+import gzip
 import logging as log
 import os
 from os.path import join as osj
+import resource
+import struct
 import subprocess
+import tempfile
+import time
+from typing import IO, BinaryIO, Iterator
 import yaml
+import zlib
 
 from cyvcf2 import cyvcf2
 
-from vannotplus.family.ped9 import Ped
+from vannotplus.family.ped9 import Ped, load_ped_cached
 
 
 def set_log_level(verbosity):
@@ -37,25 +45,100 @@ def load_config(config_file):
 
 def load_ped(config, app):
     ped_path = osj(config["ped_dir"], config["app_to_ped"][app])
+    # the ped cache is opt-in, so that runs never write outside of their directories unless asked to
+    cache_dir = config.get("ped_cache_dir")
     if not os.path.exists(ped_path):
         log.warning(f"No ped file found for app: {app}")
         ped = Ped()
+    elif cache_dir:
+        ped = load_ped_cached(ped_path, cache_dir)
     else:
         ped = Ped(ped_file=ped_path)
     return ped
 
 
-def run_shell(cmd: str) -> None:
+class ProcessUsage:
     """
-    Run cmd in a separate shell
+    Resources used by a shell command and the processes it waited for:
+    wall time and CPU time (user + system) in seconds, peak resident set size of the largest process in bytes
+    """
+
+    def __init__(self, wall_time: float, cpu_time: float, max_rss: int) -> None:
+        self.wall_time = wall_time
+        self.cpu_time = cpu_time
+        self.max_rss = max_rss
+
+    def __str__(self) -> str:
+        return f"{self.wall_time:.1f}s wall time, {self.cpu_time:.1f}s CPU time, {self.max_rss / 1024**2:.0f}M peak memory"
+
+
+def run_shell(cmd: str, check: bool = False, timeout: float | None = None) -> ProcessUsage:
+    """
+    Run cmd in a separate shell and return the resources it used
     Show stdout/stderr only if log level is log.DEBUG
+    If check is True, raise subprocess.CalledProcessError if cmd returns a non-zero code
+    If timeout (seconds) is reached, the shell is killed and subprocess.TimeoutExpired is raised
     """
     log.debug(cmd)
     if log.root.level <= 10:
         redirect = None
     else:
         redirect = subprocess.DEVNULL
-    subprocess.run(cmd, shell=True, stdout=redirect, stderr=redirect)
+    start = time.perf_counter()
+    proc = subprocess.Popen(cmd, shell=True, stdout=redirect, stderr=redirect)
+    # the shell is reaped with os.wait4 rather than Popen.wait, to get its resource usage
+    if timeout is None:
+        _, status, rusage = os.wait4(proc.pid, 0)
+    else:
+        delay = 0.001
+        while True:
+            pid, status, rusage = os.wait4(proc.pid, os.WNOHANG)
+            if pid != 0:
+                break
+            remaining = start + timeout - time.perf_counter()
+            if remaining <= 0:
+                proc.kill()
+                os.wait4(proc.pid, 0)
+                proc.returncode = -9
+                raise subprocess.TimeoutExpired(cmd, timeout)
+            time.sleep(min(delay, remaining))
+            delay = min(delay * 2, 0.1)
+    proc.returncode = os.waitstatus_to_exitcode(status)
+    if check and proc.returncode != 0:
+        raise subprocess.CalledProcessError(proc.returncode, cmd)
+    # ru_maxrss is in kilobytes on Linux
+    return ProcessUsage(
+        time.perf_counter() - start, rusage.ru_utime + rusage.ru_stime, rusage.ru_maxrss * 1024
+    )
+
+
+def parse_size(size: str) -> int:
+    """
+    Convert a human readable size to bytes, with an optional binary unit suffix
+
+    >>> parse_size("512M")
+    536870912
+    >>> parse_size("2G")
+    2147483648
+    >>> parse_size("1000")
+    1000
+    """
+    units = {"K": 1024, "M": 1024**2, "G": 1024**3, "T": 1024**4}
+    size = size.strip().upper().removesuffix("B")
+    if size and size[-1] in units:
+        return int(float(size[:-1]) * units[size[-1]])
+    return int(size)
+
+
+def get_peak_rss() -> tuple[int, int]:
+    """
+    Return peak resident set size (bytes) of the current process, and of its largest terminated child process (0 if none)
+    """
+    # ru_maxrss is in kilobytes on Linux
+    return (
+        resource.getrusage(resource.RUSAGE_SELF).ru_maxrss * 1024,
+        resource.getrusage(resource.RUSAGE_CHILDREN).ru_maxrss * 1024,
+    )
 
 
 def get_variant_id(variant: cyvcf2.Variant) -> str:
@@ -75,3 +158,96 @@ def get_variant_info(variant: cyvcf2.Variant, field: str) -> str:
         return variant.INFO[field]
     except KeyError:
         return ""
+
+
+def get_indexed_contigs(vcf_path: str) -> list[str]:
+    """
+    Return contigs of an indexed VCF in the order they appear in the file, as listed in its tabix (.tbi) or CSI (.csi) index.
+    Only contigs having at least one record are listed.
+
+    CSI indexes of BCF files do not contain contig names, in which case header contigs are returned (BCF records are sorted by header contig).
+    Raise ValueError if no index is found
+    """
+    for extension in (".tbi", ".csi"):
+        index_path = vcf_path + extension
+        if os.path.exists(index_path):
+            break
+    else:
+        raise ValueError(
+            f"No tabix or CSI index found for {vcf_path}. Compress it with bgzip and index it with tabix -p vcf (or bcftools index)"
+        )
+
+    with gzip.open(index_path, "rb") as f:
+        magic = f.read(4)
+        if magic == b"TBI\x01":
+            f.read(4)  # n_ref
+        elif magic == b"CSI\x01":
+            _, _, l_aux = struct.unpack("<iii", f.read(12))  # min_shift, depth, l_aux
+            if l_aux < 28:
+                return list(cyvcf2.VCF(vcf_path).seqnames)
+        else:
+            raise ValueError(f"Invalid index file: {index_path}")
+        # tabix configuration: format, col_seq, col_beg, col_end, meta, skip, l_nm, then l_nm bytes of names
+        l_nm = struct.unpack("<7i", f.read(28))[6]
+        names = f.read(l_nm)
+    return [n.decode() for n in names.split(b"\x00") if n]
+
+
+@contextmanager
+def atomic_write(path: str, mode: str = "wb") -> Iterator[IO]:
+    """
+    Open a temporary file to write path, renamed to path once the block succeeds, so that readers never see a partial file.
+    The temporary file is unique (tempfile.mkstemp) in the directory of path, so that concurrent writers never share it,
+    and it is removed if the block fails
+    """
+    fd, tmp_path = tempfile.mkstemp(
+        dir=os.path.dirname(os.path.abspath(path)), prefix=os.path.basename(path) + ".", suffix=".tmp"
+    )
+    try:
+        with os.fdopen(fd, mode) as f:
+            yield f
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.remove(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+
+def read_vcf_header(f: BinaryIO) -> bytes:
+    """
+    Read header lines of a plain VCF opened in binary mode, leaving f positioned at the first record
+    """
+    header = b""
+    while True:
+        position = f.tell()
+        line = f.readline()
+        if not line.startswith(b"#"):
+            f.seek(position)
+            return header
+        header += line
+
+
+# Empty BGZF block marking the end of a BGZF file, see SAM/BAM specification
+BGZF_EOF = bytes.fromhex("1f8b08040000000000ff0600424302001b0003000000000000000000")
+
+
+def bgzf_compress(src: BinaryIO, dst: BinaryIO, level: int = 6) -> None:
+    """
+    Write the content of src in dst as BGZF blocks, without the final EOF block (see BGZF_EOF)
+    so that outputs of several calls can be concatenated into a single valid BGZF file, e.g. a .vcf.gz
+    """
+    # same maximum uncompressed block size as htslib, so that compressed blocks are always smaller than 64kb
+    block_size = 0xFF00
+    while True:
+        data = src.read(block_size)
+        if not data:
+            break
+        compressor = zlib.compressobj(level, zlib.DEFLATED, -15)
+        compressed = compressor.compress(data) + compressor.flush()
+        # header (18 bytes) with BC extra subfield giving total block size - 1, then compressed data, then CRC32 and ISIZE (8 bytes)
+        dst.write(b"\x1f\x8b\x08\x04\x00\x00\x00\x00\x00\xff\x06\x00BC\x02\x00")
+        dst.write(struct.pack("<H", len(compressed) + 25))
+        dst.write(compressed)
+        dst.write(struct.pack("<II", zlib.crc32(data), len(data)))
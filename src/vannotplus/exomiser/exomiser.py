@@ -1,19 +1,41 @@
+from concurrent.futures import ThreadPoolExecutor, as_completed
 import json
 import logging as log
 import os
 from os.path import join as osj
 import shutil
+import subprocess
+import sys
 import tempfile
+import threading
 import random
 
 from cyvcf2 import cyvcf2
 import numpy as np
 
 from vannotplus import __version__
-from vannotplus.commons import get_variant_id, load_ped, run_shell
+from vannotplus.commons import ProcessUsage, get_variant_id, load_ped, parse_size, run_shell
+from vannotplus.exomiser.exomiser_cache import (
+    ExomiserCache,
+    get_cache_key,
+    get_exomiser_fingerprint,
+    get_host_path,
+)
+from vannotplus.exomiser.exomiser_resume import ExomiserManifest, get_work_dir
 from vannotplus.family.ped9 import Ped
 
 TEMPLATE = osj(os.path.dirname(__file__), "template.json")
+# annotations depending only on HPOs and gene, which can be computed once per HPO set (see get_gene_field)
+GENE_LEVEL_ANNOTATIONS = ("EXOMISER_GENE_PHENO_SCORE",)
+# output of Exomiser parsed in gene mode (TSV_GENE output format), see get_gene_scores
+EXOMISER_GENES_SUFFIX = ".genes.tsv"
+EXOMISER_GENES_COLUMNS = ("GENE_SYMBOL",) + GENE_LEVEL_ANNOTATIONS
+# ways of running Exomiser, see get_runner_cmd
+EXOMISER_RUNNERS = ("docker", "java", "stub")
+# records of Exomiser inputs are buffered up to this size (in characters), then appended to their files one file at a time,
+# so that the number of open files does not grow with the number of inputs (see write_exomiser_inputs)
+EXOMISER_INPUTS_BUFFER_SIZE = 64 * 1024**2
+EXOMISER_DESCRIPTION = "{RANK|ID|GENE_SYMBOL|ENTREZ_GENE_ID|MOI|P-VALUE|EXOMISER_GENE_COMBINED_SCORE|EXOMISER_GENE_PHENO_SCORE|EXOMISER_GENE_VARIANT_SCORE|EXOMISER_VARIANT_SCORE|CONTRIBUTING_VARIANT|WHITELIST_VARIANT|FUNCTIONAL_CLASS|HGVS|EXOMISER_ACMG_CLASSIFICATION|EXOMISER_ACMG_EVIDENCE|EXOMISER_ACMG_DISEASE_ID|EXOMISER_ACMG_DISEASE_NAME}"
 
 
 def any_sample_has_HPOs(samples: list[str], ped: Ped) -> bool:
@@ -30,26 +52,172 @@ def sample_has_HPOs(sample: str, ped: Ped) -> bool:
     return False
 
 
-def main_exomiser(input_vcf, output_vcf, app, config, remove_info_in_tmp=True):
+class ExomiserRecords:
     """
-    Split input_vcf into one VCF per sample
+    Records of the input VCF, registered once and shared by the ExomiserResults of all profiles
+
+    Results of Exomiser are keyed by variant ID (see get_variant_id) or by gene in gene mode (see get_gene_field).
+    rows gives the input records of each key, so that filling a sample's results does not require reading the input again
+    In gene mode, carriers keeps which samples of the input VCF carry an alternative allele at each record
+    """
+
+    def __init__(self, gene_field: str | None = None) -> None:
+        self.gene_field = gene_field
+        self.rows: dict[str | None, list[int]] = {}
+        self.n_records = 0
+        self.carriers: list[np.ndarray] = []
+
+    def get_key(self, variant: cyvcf2.Variant) -> str | None:
+        if self.gene_field is None:
+            return get_variant_id(variant)
+        return variant.INFO.get(self.gene_field)
+
+    def add_record(self, variant: cyvcf2.Variant, carriers: np.ndarray) -> None:
+        """
+        Register the next record of the input VCF, must be called for every record in order before ExomiserResults.fill()
+        carriers: samples of the input VCF carrying an alternative allele at this record
+        """
+        self.rows.setdefault(self.get_key(variant), []).append(self.n_records)
+        if self.gene_field is not None:
+            self.carriers.append(carriers)
+        self.n_records += 1
+
+
+class ExomiserResults:
+    """
+    Exomiser annotations of the records of the input VCF for one profile, as one (records x samples) float32 matrix per annotation, NaN if missing
+    Rows follow the order of input records (see ExomiserRecords), columns the order of samples (only samples with HPOs, see get_row)
+    In gene mode, samples not carrying an alternative allele at a record get NaN, as in variant mode
+    """
+
+    def __init__(
+        self,
+        annots: list[str],
+        records: ExomiserRecords,
+        vcf_samples: list[str],
+        samples: list[str],
+    ) -> None:
+        self.annots = annots
+        self.records = records
+        self.n_vcf_samples = len(vcf_samples)
+        self.columns = {s: i for i, s in enumerate(samples)}
+        # position of each column in vcf_samples
+        self.sample_indexes = np.array(
+            [vcf_samples.index(s) for s in samples], dtype=np.intp
+        )
+        self.matrices: dict[str, np.ndarray] = {}
+
+    def fill(self, sample: str, results: dict) -> None:
+        """
+        Fill the column of sample with results, from get_annotated_variants() or get_gene_scores()
+        """
+        if not self.matrices:
+            for annot in self.annots:
+                self.matrices[annot] = np.full(
+                    (self.records.n_records, len(self.columns)), np.nan, dtype=np.float32
+                )
+        rows = []
+        annot_values = {annot: [] for annot in self.annots}
+        for key, values in results.items():
+            key_rows = self.records.rows.get(key)
+            if key_rows is None:
+                continue
+            rows += key_rows
+            for annot in self.annots:
+                value = float(values[annot]) if annot in values else np.nan
+                annot_values[annot] += [value] * len(key_rows)
+        column = self.columns[sample]
+        for annot in self.annots:
+            self.matrices[annot][rows, column] = annot_values[annot]
+
+    def get_row(self, annot: str, row: int) -> np.ndarray:
+        """
+        Values of annot for all samples of the input VCF at record row, NaN for samples without HPOs
+        """
+        res = np.full(self.n_vcf_samples, np.nan, dtype=np.float32)
+        if self.matrices:
+            values = self.matrices[annot][row]
+            if self.records.gene_field is not None:
+                values = np.where(self.records.carriers[row][self.sample_indexes], values, np.nan)
+            res[self.sample_indexes] = values
+        return res
+
+
+def main_exomiser(
+    input_vcf,
+    output_vcf,
+    app,
+    config,
+    remove_info_in_tmp=True,
+    use_cache=True,
+    phenotype_only=False,
+    resume=False,
+    timings=None,
+):
+    """
+    Split input_vcf into one VCF per sample, in a single pass (see write_exomiser_inputs)
     Write the JSON template with a phenopacket using the sample's HPOs (pedigree determined by app)
-    Run Exomiser in a docker container for each sample
+    Run Exomiser in a docker container for each sample, several samples at once within the resources budget (see get_job_resources)
     Merge the Exomiser annotations back into the original VCF, as a sample-specific FORMAT field
 
+    app can also be a list of profiles APP[:FIELD], to annotate the VCF with the HPOs of several applications in one run.
+    Inputs are split once for all profiles, and each profile's annotations are written to their own FORMAT fields (see get_output_fields)
+
+    If only gene-level annotations are requested and exomiser:gene_field is set (see get_gene_field),
+    Exomiser is run once per distinct HPO set instead, on the variants of all samples sharing it,
+    and its gene scores are given to each record of these samples through the gene in gene_field.
+
     If remove_info_in_tmp is True, the INFO field is removed from the temporary monosample VCFs
     to avoid issues with Exomiser being limited to VCF version <= 4.2
     All of the original INFO fields are retained in the final output VCF no matter what.
     The only reason to use remove_info_in_tmp=False is improving performance, if the input VCF is already compatible with Exomiser.
+
+    If use_cache is True, results are looked up in and stored to the Exomiser cache (see exomiser_cache.py, disabled if exomiser:cache_dir is empty)
+    Samples with a cached result do not run Exomiser.
+
+    If phenotype_only is True, Exomiser runs a reduced analysis with the prioritisers only (see get_phenotype_only_template),
+    which is only possible if all annotations to add are gene-level (see GENE_LEVEL_ANNOTATIONS)
+
+    If resume is True, the run works in a stable directory next to output_vcf and checkpoints each completed analysis (see exomiser_resume.py).
+    Running it again after a failure or an interruption only runs Exomiser for analyses that were not completed, then merges all results.
+
+    Exomiser is run by the runner set in exomiser:runner (see get_runner_cmd).
+    If timings is given, the wall time, CPU time and peak memory of each Exomiser analysis are written to this TSV file
     """
+    profiles = parse_profiles(app)
+    try:
+        annots_to_add = config["exomiser"]["annotations_to_add"]
+    except KeyError:
+        # Default annotation: only phenotype score
+        annots_to_add = ["EXOMISER_GENE_PHENO_SCORE"]
+    if phenotype_only and not all(annot in GENE_LEVEL_ANNOTATIONS for annot in annots_to_add):
+        raise ValueError(
+            f"Phenotype-only Exomiser analysis can only add {', '.join(GENE_LEVEL_ANNOTATIONS)}, got: {', '.join(annots_to_add)}"
+        )
+    output_fields = [get_output_fields(field, annots_to_add) for _, field in profiles]
+    all_output_fields = [f for fields in output_fields for f in fields.values()]
+    if len(set(all_output_fields)) != len(all_output_fields):
+        raise ValueError(
+            f"Exomiser profiles would write the same FORMAT fields, name them with APP:FIELD: {app}"
+        )
+
+    runner = get_runner(config)
     with open(TEMPLATE, "r") as f:
         template = json.load(f)
+    if phenotype_only:
+        template = get_phenotype_only_template(template)
     output_dir = os.path.dirname(output_vcf)
-    tmp_dir = tempfile.mkdtemp(dir=output_dir)
+    if resume:
+        tmp_dir = get_work_dir(output_vcf)
+        os.makedirs(tmp_dir, exist_ok=True)
+    else:
+        tmp_dir = tempfile.mkdtemp(dir=output_dir)
     tmp_dir_in_container = tmp_dir
-    ped = load_ped(config, app)
+    peds = [load_ped(config, profile_app) for profile_app, _ in profiles]
     # vcf_in_container = input_vcf
     for real_path, container_path in config["mount"].items():
+        if runner != "docker":
+            break
         # if input_vcf.startswith(real_path):
         #   vcf_in_container = input_vcf.replace(real_path, container_path)
         if tmp_dir.startswith(real_path):
@@ -71,7 +239,7 @@ def main_exomiser(input_vcf, output_vcf, app, config, remove_info_in_tmp=True):
             config["mount"][io_dir] = io_dir
     log.debug(f"config[mount]:{config['mount']}")
 
-    if not any_sample_has_HPOs(vcf.samples, ped):
+    if not any(any_sample_has_HPOs(vcf.samples, ped) for ped in peds):
         log.debug(
             f"No HPO found for samples in {input_vcf}, copying it to {output_vcf} without change"
         )
@@ -79,83 +247,145 @@ def main_exomiser(input_vcf, output_vcf, app, config, remove_info_in_tmp=True):
         shutil.copy(input_vcf, output_vcf)
         return
 
-    sample_variant_dict = {}
+    gene_field = get_gene_field(config, annots_to_add)
+
+    cache = ExomiserCache.from_config(config) if use_cache else None
+    manifest = ExomiserManifest.load(tmp_dir) if resume else None
+    if cache is not None or manifest is not None:
+        exomiser_fingerprint = get_exomiser_fingerprint(config)
+        if gene_field is not None:
+            # gene tables and variant results must not share keys
+            exomiser_fingerprint += ":genes"
+        if runner == "stub":
+            exomiser_fingerprint += ":stub"
+    cache_keys = {}
+
     for s in vcf.samples:
-        if not sample_has_HPOs(s, ped):
+        if not any(sample_has_HPOs(s, ped) for ped in peds):
+            # nothing is written nor read for these samples, they get NaN in the output
             log.info(f"No HPO found for sample {s}, skipping Exomiser for this sample")
-            shutil.copy(input_vcf, osj(tmp_dir, s + ".vcf.gz"))
-            sample_variant_dict[s] = get_annotated_variants(
-                osj(tmp_dir, s + ".vcf.gz"), no_hpos=True
+    inputs, analyses = get_analyses(vcf.samples, peds, gene_field)
+    if gene_field is not None:
+        # gene scores are read from Exomiser's genes TSV, the much larger annotated VCF is not needed
+        template["outputOptions"]["outputFormats"] = ["TSV_GENE"]
+        for name, analysis in analyses.items():
+            log.info(
+                f"Exomiser gene scores of {name} are computed for samples sharing its HPOs: {', '.join(s for _, s in analysis.members)}"
             )
-            continue
 
-        # write monosample VCF
-        sample_vcf = cyvcf2.VCF(input_vcf, samples=s)
-        writer = cyvcf2.Writer(osj(tmp_dir, s + "_exomiserinput.vcf"), sample_vcf)
-        writer.write_header()
-        for variant in sample_vcf:
-            if not remove_info_in_tmp:
-                writer.write_record(variant)
-            else:
-                # Exomiser 14.0.0 does not follow the 4.4 VCF spec allowing spaces in INFO fields
-                l = str(variant).strip().split("\t")
-                l[7] = "."
-                infoless_variant = writer.variant_from_string("\t".join(l))
-                writer.write_record(infoless_variant)
-        writer.close()
+    # records are registered once for all profiles, each profile only has its own result matrices
+    records = ExomiserRecords(gene_field)
+    results = [
+        ExomiserResults(
+            annots_to_add,
+            records,
+            vcf.samples,
+            [s for s in vcf.samples if sample_has_HPOs(s, ped)],
+        )
+        for ped in peds
+    ]
+    write_exomiser_inputs(
+        input_vcf,
+        inputs,
+        tmp_dir,
+        remove_info_in_tmp,
+        pool_genotypes=gene_field is not None,
+        records=records,
+    )
 
+    exomiser_samples = []
+    for name, analysis in analyses.items():
         write_template(
             template,
-            s,
-            ped,
-            osj(tmp_dir_in_container, s + "_exomiserinput.vcf"),
+            name,
+            analysis.input_name,
+            analysis.hpos,
+            osj(tmp_dir_in_container, analysis.input_name + "_exomiserinput.vcf"),
             tmp_dir_in_container,
             tmp_dir,
             assembly,
         )
-        template_file_in_container = osj(tmp_dir_in_container, s + "_template.json")
-
-        cmd = f"-XX:ParallelGCThreads={config['exomiser']['threads']}  -XX:MaxHeapSize={config['exomiser']['heap']}  -jar {config['exomiser']['jar']}"
-        cmd += f" --analysis={template_file_in_container}"
-        cmd += f" --spring.config.location={config['exomiser']['properties']}"
-        cmd += f" --exomiser.data-directory={config['exomiser']['db']}"
-        cmd = docker_cmd(config, cmd)
-        run_shell(cmd)
-        sample_variant_dict[s] = get_annotated_variants(osj(tmp_dir, s + ".vcf.gz"))
+        if cache is not None or manifest is not None:
+            cache_keys[name] = get_cache_key(
+                osj(tmp_dir, analysis.input_name + "_exomiserinput.vcf"),
+                analysis.hpos,
+                template,
+                exomiser_fingerprint,
+            )
+        if manifest is not None:
+            completed = manifest.get(name, cache_keys[name])
+            if completed is not None:
+                log.info(f"Exomiser result of {name} found in {tmp_dir}, completed by a previous run")
+                for profile, s in analysis.members:
+                    results[profile].fill(s, completed)
+                continue
+        if cache is not None:
+            cached = cache.get(cache_keys[name])
+            if cached is not None:
+                log.info(f"Exomiser result of {name} found in cache")
+                for profile, s in analysis.members:
+                    results[profile].fill(s, cached)
+                continue
+        exomiser_samples.append(name)
+
+    timings_file = None
+    if timings is not None:
+        timings_file = open(timings, "w")
+        timings_file.write("analysis\trunner\tjob_analyses\twall_time\tcpu_time\tmax_rss\n")
+
+    def on_result(name: str, res: dict, usage: ProcessUsage, job_size: int) -> None:
+        if timings_file is not None:
+            timings_file.write(
+                f"{name}\t{runner}\t{job_size}\t{usage.wall_time:.3f}\t{usage.cpu_time:.3f}\t{usage.max_rss}\n"
+            )
+        # stored as soon as its job is over, so that it survives a failure of other jobs
+        if manifest is not None:
+            manifest.add(name, cache_keys[name], res)
+        if cache is not None:
+            cache.put(cache_keys[name], res)
+        for profile, s in analyses[name].members:
+            results[profile].fill(s, res)
 
     try:
-        annots_to_add = config["exomiser"]["annotations_to_add"]
-    except KeyError:
-        # Default annotation: only phenotype score
-        annots_to_add = ["EXOMISER_GENE_PHENO_SCORE"]
+        run_exomiser_jobs(
+            exomiser_samples,
+            config,
+            tmp_dir,
+            tmp_dir_in_container,
+            get_annotated_variants if gene_field is None else get_gene_scores,
+            on_result,
+            ".vcf.gz" if gene_field is None else EXOMISER_GENES_SUFFIX,
+        )
+    finally:
+        if cache is not None:
+            cache.evict()
+        if timings_file is not None:
+            timings_file.close()
+
     descriptions = {k: f"Exported from vannotplus {__version__}" for k in annots_to_add}
     descriptions["EXOMISER_GENE_PHENO_SCORE"] = (
         "Gene-specific phenotype relevance score computed by Exomiser. 1 means the gene is highly linked to the HPOs, 0 means no link. Based on semantic similarity of the patient's HPO terms to phenotypic annotations of genes in 1) OMIM, with inheritance consistency checked and adjusted if inconsistent (the score is halved if inheritance is incompatible) and 2) phenotypes of protein-protein associated neighboring genes derived from protein interaction networks (hiphive)."
     )
 
-    for annot in annots_to_add:
-        vcf.add_format_to_header(
-            {
-                "ID": annot,
-                "Number": 1,
-                "Type": "Float",
-                "Description": descriptions[annot],
-            }
-        )
+    for (profile_app, field), fields in zip(profiles, output_fields):
+        for annot, output_field in fields.items():
+            description = descriptions[annot]
+            if field is not None:
+                description = f"{description.rstrip('.')}, with the HPOs of application {profile_app}"
+            vcf.add_format_to_header(
+                {
+                    "ID": output_field,
+                    "Number": 1,
+                    "Type": "Float",
+                    "Description": description,
+                }
+            )
     writer = cyvcf2.Writer(output_vcf, vcf)
     writer.write_header()
-    for variant in vcf:
-        key = get_variant_id(variant)
-
-        for annot in annots_to_add:
-            annot_list = []
-            for s in vcf.samples:
-                try:
-                    annot_list.append(sample_variant_dict[s][key][annot])
-                except KeyError:
-                    annot_list.append(np.nan)
-
-            variant.set_format(annot, np.array(annot_list, dtype=float))
+    for row, variant in enumerate(vcf):
+        for profile_results, fields in zip(results, output_fields):
+            for annot, output_field in fields.items():
+                variant.set_format(output_field, profile_results.get_row(annot, row))
         writer.write_record(variant)
     writer.close()
 
@@ -163,7 +393,378 @@ def main_exomiser(input_vcf, output_vcf, app, config, remove_info_in_tmp=True):
         shutil.rmtree(tmp_dir)
 
 
-def get_annotated_variants(vcf_path: str, no_hpos=False) -> dict:
+def parse_profiles(apps: str | list[str]) -> list[tuple[str, str | None]]:
+    """
+    Parse Exomiser profiles given as APP or APP:FIELD, see get_output_fields for FIELD
+    """
+    if isinstance(apps, str):
+        apps = [apps]
+    profiles = []
+    for app in apps:
+        app, _, field = app.partition(":")
+        profiles.append((app, field or None))
+    return profiles
+
+
+def get_output_fields(field: str | None, annots_to_add: list[str]) -> dict[str, str]:
+    """
+    FORMAT field of each annotation of a profile: the annotation itself if the profile has no FIELD,
+    else FIELD if there is a single annotation, FIELD_<annotation> otherwise
+    """
+    if field is None:
+        return {annot: annot for annot in annots_to_add}
+    if len(annots_to_add) == 1:
+        return {annots_to_add[0]: field}
+    return {annot: f"{field}_{annot}" for annot in annots_to_add}
+
+
+def get_phenotype_only_template(template: dict) -> dict:
+    """
+    Reduced analysis computing only what gene phenotype scores need: the prioritiser steps of template,
+    without frequency nor pathogenicity sources and filters, so that variants are not looked up in Exomiser's variant databases
+    """
+    analysis = {
+        **template["analysis"],
+        "frequencySources": [],
+        "pathogenicitySources": [],
+        "steps": [
+            step
+            for step in template["analysis"]["steps"]
+            if any(k.endswith("Prioritiser") for k in step)
+        ],
+    }
+    return {**template, "analysis": analysis}
+
+
+def get_gene_field(config: dict, annots_to_add: list[str]) -> str | None:
+    """
+    Return the INFO field holding the gene of each record if Exomiser can run once per distinct HPO set:
+    exomiser:gene_field must be set, and all annotations_to_add must be gene-level (see GENE_LEVEL_ANNOTATIONS).
+    Return None otherwise, in which case Exomiser runs on each sample's variants
+    """
+    gene_field = config["exomiser"].get("gene_field")
+    if not gene_field:
+        return None
+    if not all(annot in GENE_LEVEL_ANNOTATIONS for annot in annots_to_add):
+        log.info(
+            "Variant-level Exomiser annotations requested, running Exomiser on each sample's variants"
+        )
+        return None
+    return gene_field
+
+
+class ExomiserAnalysis:
+    """
+    One Exomiser analysis of the proband of an input VCF (see write_exomiser_inputs) with hpos
+    members: (profile index, sample) pairs getting its results
+    """
+
+    def __init__(self, input_name: str, hpos: list[str]) -> None:
+        self.input_name = input_name
+        self.hpos = hpos
+        self.members: list[tuple[int, str]] = []
+
+
+def get_unique_name(name: str, used) -> str:
+    if name not in used:
+        return name
+    i = 2
+    while f"{name}_{i}" in used:
+        i += 1
+    return f"{name}_{i}"
+
+
+def get_analyses(
+    samples: list[str], peds: list[Ped], gene_field: str | None = None
+) -> tuple[dict[str, list[str]], dict[str, ExomiserAnalysis]]:
+    """
+    Return Exomiser input VCFs (name -> samples, see write_exomiser_inputs) and analyses (name -> ExomiserAnalysis)
+    for the samples with HPOs in the ped of each profile
+
+    Without gene_field, each sample has its own input, and one analysis per distinct set of HPOs it has across profiles.
+    With gene_field, there is one pooled input and analysis per distinct set of HPOs, shared by all samples having it in any profile.
+    Inputs and analyses are named after their first sample, suffixed if the name is already taken
+    """
+    inputs: dict[str, list[str]] = {}
+    analyses: dict[str, ExomiserAnalysis] = {}
+    # (input name, HPO set) -> analysis name
+    analysis_names: dict[tuple[str, tuple[str, ...]], str] = {}
+    # HPO set -> pooled input name, with gene_field
+    pooled_inputs: dict[tuple[str, ...], str] = {}
+    for profile, ped in enumerate(peds):
+        for s in samples:
+            if not sample_has_HPOs(s, ped):
+                continue
+            hpo_set = tuple(sorted(set(ped[s].HPO)))
+            if gene_field is None:
+                input_name = s
+                inputs[s] = [s]
+            else:
+                if hpo_set not in pooled_inputs:
+                    pooled_inputs[hpo_set] = get_unique_name(s, inputs)
+                    inputs[pooled_inputs[hpo_set]] = []
+                input_name = pooled_inputs[hpo_set]
+                if s not in inputs[input_name]:
+                    inputs[input_name].append(s)
+            if (input_name, hpo_set) not in analysis_names:
+                name = get_unique_name(input_name, analyses)
+                analysis_names[(input_name, hpo_set)] = name
+                analyses[name] = ExomiserAnalysis(input_name, ped[s].HPO)
+            analyses[analysis_names[(input_name, hpo_set)]].members.append((profile, s))
+    return inputs, analyses
+
+
+def write_exomiser_inputs(
+    input_vcf: str,
+    inputs: dict[str, list[str]],
+    tmp_dir: str,
+    remove_info_in_tmp: bool = True,
+    pool_genotypes: bool = False,
+    records: ExomiserRecords | None = None,
+    buffer_size: int = EXOMISER_INPUTS_BUFFER_SIZE,
+) -> None:
+    """
+    Write each Exomiser input VCF (tmp_dir/<name>_exomiserinput.vcf) in a single pass over input_vcf
+    Records are buffered up to buffer_size characters for all inputs, then written one file at a time, so that a single file is open at once
+    inputs: name of each input -> its samples, see get_analyses
+    Records where none of the input's samples carries an alternative allele (hom-ref or no-call) are skipped, Exomiser ignores them anyway
+
+    Without pool_genotypes, each input is a single sample, whose column is kept as is.
+    With pool_genotypes, each input has a single sample named after it, carrying every site where one of its samples carries an alternative allele:
+    homozygous if one of them is homozygous, heterozygous otherwise.
+    This is used to compute the gene scores of an HPO set shared by several samples, over the genes of all of them.
+    See main_exomiser for remove_info_in_tmp
+    Every input record is registered in records (see ExomiserRecords.add_record)
+    """
+    vcf = cyvcf2.VCF(input_vcf)
+    positions = {s: i for i, s in enumerate(vcf.samples)}
+    # (inputs x samples) membership, a sample can be pooled in several inputs when it has several sets of HPOs
+    members = np.zeros((len(inputs), len(vcf.samples)), dtype=bool)
+    for i, samples in enumerate(inputs.values()):
+        members[i, [positions[s] for s in samples]] = True
+    # column of the sample of each input, without pool_genotypes
+    input_columns = members.argmax(axis=1)
+
+    header = vcf.raw_header.rstrip("\n").split("\n")
+    columns = header[-1].split("\t")[:9]
+    # pooled inputs only have GT, which the input may not declare if it has no genotypes
+    add_gt = pool_genotypes and not any(l.startswith("##FORMAT=<ID=GT,") for l in header)
+    paths = [osj(tmp_dir, name + "_exomiserinput.vcf") for name in inputs]
+    for name, path in zip(inputs, paths):
+        with open(path, "w") as f:
+            f.write("\n".join(header[:-1]) + "\n")
+            if add_gt:
+                f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+            f.write("\t".join(columns + [name]) + "\n")
+    buffers: list[list[str]] = [[] for _ in inputs]
+    buffered = 0
+
+    def flush() -> None:
+        nonlocal buffered
+        for path, buffer in zip(paths, buffers):
+            if buffer:
+                with open(path, "a") as f:
+                    f.writelines(buffer)
+                buffer.clear()
+        buffered = 0
+
+    for variant in vcf:
+        gt_types = variant.gt_types
+        carriers = (gt_types == vcf.HET) | (gt_types == vcf.HOM_ALT)
+        if records is not None:
+            records.add_record(variant, carriers)
+        if pool_genotypes:
+            carrying_inputs = np.flatnonzero(members[:, carriers].any(axis=1))
+        else:
+            carrying_inputs = np.flatnonzero(carriers[input_columns])
+        if len(carrying_inputs) == 0:
+            continue
+        l = str(variant).rstrip("\n").split("\t")
+        if remove_info_in_tmp:
+            # Exomiser 14.0.0 does not follow the 4.4 VCF spec allowing spaces in INFO fields
+            l[7] = "."
+        if pool_genotypes:
+            site = "\t".join(l[:8]) + "\tGT\t"
+            hom_inputs = members[:, gt_types == vcf.HOM_ALT].any(axis=1)
+            for i in carrying_inputs:
+                buffers[i].append(site + ("1/1\n" if hom_inputs[i] else "0/1\n"))
+            buffered += (len(site) + 4) * len(carrying_inputs)
+        else:
+            site = "\t".join(l[:9]) + "\t"
+            for i in carrying_inputs:
+                line = site + l[9 + input_columns[i]] + "\n"
+                buffers[i].append(line)
+                buffered += len(line)
+        if buffered >= buffer_size:
+            flush()
+
+    flush()
+    vcf.close()
+
+
+def get_job_resources(exomiser_config: dict) -> tuple[int, str, str]:
+    """
+    Return the number of Exomiser jobs that can run at once, and the heap and threads of each job
+
+    heap and threads of the exomiser config are the total budget of a run.
+    Optional job_heap and job_threads are the share of each job (default: the whole budget, i.e. one job at a time)
+    """
+    heap = str(exomiser_config["heap"])
+    threads = str(exomiser_config["threads"])
+    job_heap = str(exomiser_config.get("job_heap", heap))
+    job_threads = str(exomiser_config.get("job_threads", threads))
+    n_jobs = min(
+        parse_size(heap) // parse_size(job_heap), int(threads) // int(job_threads)
+    )
+    if n_jobs < 1:
+        raise ValueError(
+            f"Exomiser job resources (job_heap: {job_heap}, job_threads: {job_threads}) exceed the budget (heap: {heap}, threads: {threads})"
+        )
+    return n_jobs, job_heap, job_threads
+
+
+def run_exomiser_jobs(
+    samples: list[str],
+    config: dict,
+    tmp_dir: str,
+    tmp_dir_in_container: str,
+    parse_result=None,
+    on_result=None,
+    output_suffix=".vcf.gz",
+) -> dict[str, dict]:
+    """
+    Run Exomiser on each sample, whose monosample VCF and template are already in tmp_dir
+    Jobs run in parallel within the budget given by get_job_resources()
+    Return parse_result(Exomiser output of the sample ending with output_suffix) of each sample (default: get_annotated_variants of the output VCF), in the order of samples
+    If on_result is given, on_result(sample, result, usage, job_size) is called from the calling thread as soon as the job of sample is over,
+    with the resources used by the job (see commons.ProcessUsage) and its number of samples
+
+    Without batch mode, each job analyses one sample.
+    With config["exomiser"]["batch"], samples are split between as many jobs as can run at once,
+    and each job analyses its samples in a single Exomiser process, so that its databases are loaded once per job instead of once per sample.
+
+    If a job fails or times out, jobs that did not start yet are cancelled and the error is raised once running jobs are over,
+    after on_result was called for the samples of every successful job
+    """
+    if len(samples) == 0:
+        return {}
+    n_jobs, job_heap, job_threads = get_job_resources(config["exomiser"])
+    n_jobs = min(n_jobs, len(samples))
+    timeout = config["exomiser"].get("timeout")
+    if config["exomiser"].get("batch", False):
+        jobs = [samples[i::n_jobs] for i in range(n_jobs)]
+    else:
+        jobs = [[s] for s in samples]
+    log.info(
+        f"Running Exomiser on {len(samples)} samples in {len(jobs)} jobs, {n_jobs} at once (heap: {job_heap}, threads: {job_threads} per job)"
+    )
+    # set as soon as a job fails, so that jobs that did not start yet are skipped
+    failed = threading.Event()
+
+    def run_job(job_samples: list[str]) -> tuple[dict[str, dict], ProcessUsage | None]:
+        if failed.is_set():
+            return {}, None
+        try:
+            return run_exomiser(
+                job_samples,
+                config,
+                job_heap,
+                job_threads,
+                tmp_dir,
+                tmp_dir_in_container,
+                timeout,
+                parse_result,
+                output_suffix,
+            )
+        except BaseException:
+            failed.set()
+            raise
+
+    res = {}
+    error = None
+    with ThreadPoolExecutor(max_workers=n_jobs) as executor:
+        futures = [executor.submit(run_job, job) for job in jobs]
+        try:
+            for future in as_completed(futures):
+                try:
+                    job_res, usage = future.result()
+                except Exception as e:
+                    # keep collecting results of running jobs
+                    failed.set()
+                    if error is None:
+                        error = e
+                    continue
+                if on_result is not None:
+                    for s, r in job_res.items():
+                        on_result(s, r, usage, len(job_res))
+                res.update(job_res)
+        except BaseException:
+            failed.set()
+            raise
+    if error is not None:
+        raise error
+    return {s: res[s] for s in samples}
+
+
+def run_exomiser(
+    samples: list[str],
+    config: dict,
+    job_heap: str,
+    job_threads: str,
+    tmp_dir: str,
+    tmp_dir_in_container: str,
+    timeout: float | None = None,
+    parse_result=None,
+    output_suffix: str = ".vcf.gz",
+) -> tuple[dict[str, dict], ProcessUsage]:
+    """
+    Run one Exomiser process with the runner of config (see get_runner_cmd) on the monosample VCFs of samples,
+    and return their annotations parsed by parse_result from their output ending with output_suffix (default: get_annotated_variants of the output VCF),
+    and the resources used by the process
+    Several samples are analysed with Exomiser's batch mode, timeout then applies to each sample of the batch
+    """
+    runner = get_runner(config)
+    jar, properties, db = (config["exomiser"][k] for k in ("jar", "properties", "db"))
+    if runner != "docker":
+        # paths of config are the ones in the container
+        jar, properties, db = (get_host_path(config, path) for path in (jar, properties, db))
+    cmd = f"-XX:ParallelGCThreads={job_threads}  -XX:MaxHeapSize={job_heap}  -jar {jar}"
+    if len(samples) == 1:
+        cmd += f" --analysis={osj(tmp_dir_in_container, samples[0] + '_template.json')}"
+    else:
+        # one line of arguments per analysis
+        batch_file = samples[0] + "_batch.txt"
+        with open(osj(tmp_dir, batch_file), "w") as f:
+            for s in samples:
+                f.write(f"--analysis={osj(tmp_dir_in_container, s + '_template.json')}\n")
+        cmd += f" --batch={osj(tmp_dir_in_container, batch_file)}"
+        if timeout is not None:
+            timeout *= len(samples)
+    cmd += f" --spring.config.location={properties}"
+    cmd += f" --exomiser.data-directory={db}"
+    docker_name = get_docker_name()
+    cmd = get_runner_cmd(config, runner, cmd, docker_name)
+    sample_names = ", ".join(samples)
+    try:
+        usage = run_shell(cmd, check=True, timeout=timeout)
+    except subprocess.CalledProcessError as e:
+        raise RuntimeError(
+            f"Exomiser failed for sample(s) {sample_names} with return code {e.returncode}"
+        ) from e
+    except subprocess.TimeoutExpired as e:
+        if runner == "docker":
+            # killing the docker client does not stop its container
+            run_shell(f"docker kill {docker_name}")
+        raise RuntimeError(
+            f"Exomiser timed out after {timeout} seconds for sample(s) {sample_names}"
+        ) from e
+    log.info(f"Exomiser on {sample_names}: {usage}")
+    if parse_result is None:
+        parse_result = get_annotated_variants
+    return {s: parse_result(osj(tmp_dir, s + output_suffix)) for s in samples}, usage
+
+
+def get_annotated_variants(vcf_path: str) -> dict:
     """
     Return a dict of dicts with Exomiser annotations for each variant in the VCF, such as:
     {
@@ -176,61 +777,122 @@ def get_annotated_variants(vcf_path: str, no_hpos=False) -> dict:
         },
         ...
     }
-    If no_hpos is True, return an empty dict for each variant.
     """
     log.debug(f"get_annotated_variants::vcf_path:{vcf_path}")
     vcf = cyvcf2.VCF(vcf_path)
 
-    if not no_hpos:
-        # verify description so indexes can be used safely later
-        exomiser_header = vcf.get_header_type("Exomiser")
-        if (
-            "{RANK|ID|GENE_SYMBOL|ENTREZ_GENE_ID|MOI|P-VALUE|EXOMISER_GENE_COMBINED_SCORE|EXOMISER_GENE_PHENO_SCORE|EXOMISER_GENE_VARIANT_SCORE|EXOMISER_VARIANT_SCORE|CONTRIBUTING_VARIANT|WHITELIST_VARIANT|FUNCTIONAL_CLASS|HGVS|EXOMISER_ACMG_CLASSIFICATION|EXOMISER_ACMG_EVIDENCE|EXOMISER_ACMG_DISEASE_ID|EXOMISER_ACMG_DISEASE_NAME}"
-            not in exomiser_header["Description"]
-        ):
-            raise ValueError(
-                f"Unexpected Exomiser description in VCF header: {exomiser_header} -- failing VCF: {vcf_path}"
-            )
+    check_exomiser_header(vcf, vcf_path)
 
     res = {}
     for variant in vcf:
         key = get_variant_id(variant)
-        if no_hpos:
-            res[key] = {}
-        else:
-            exomiser_data = variant.INFO["Exomiser"].split("|")
-            res[key] = {
-                "EXOMISER_P_VALUE": exomiser_data[5],
-                "EXOMISER_GENE_COMBINED_SCORE": exomiser_data[6],
-                "EXOMISER_GENE_PHENO_SCORE": exomiser_data[7],
-                "EXOMISER_GENE_VARIANT_SCORE": exomiser_data[8],
-                "EXOMISER_VARIANT_SCORE": exomiser_data[9],
-            }
+        exomiser_data = variant.INFO["Exomiser"].split("|")
+        res[key] = {
+            "EXOMISER_P_VALUE": exomiser_data[5],
+            "EXOMISER_GENE_COMBINED_SCORE": exomiser_data[6],
+            "EXOMISER_GENE_PHENO_SCORE": exomiser_data[7],
+            "EXOMISER_GENE_VARIANT_SCORE": exomiser_data[8],
+            "EXOMISER_VARIANT_SCORE": exomiser_data[9],
+        }
+    vcf.close()
+    return res
+
+
+def get_gene_scores(tsv_path: str) -> dict:
+    """
+    Return gene-level Exomiser annotations (see GENE_LEVEL_ANNOTATIONS) for each gene of Exomiser's genes TSV, such as:
+    {
+        "ALMS1": {
+            "EXOMISER_GENE_PHENO_SCORE": "0.9"
+        },
+        ...
+    }
+    Genes compatible with several modes of inheritance have one row per mode, sorted by rank: the first one is kept
+    """
+    log.debug(f"get_gene_scores::tsv_path:{tsv_path}")
+    res = {}
+    with open(tsv_path, "r") as f:
+        header = f.readline().rstrip("\n").lstrip("#").split("\t")
+        missing = [c for c in EXOMISER_GENES_COLUMNS if c not in header]
+        if missing:
+            raise ValueError(
+                f"Missing columns {', '.join(missing)} in Exomiser genes TSV header: {header} -- failing TSV: {tsv_path}"
+            )
+        gene_index = header.index("GENE_SYMBOL")
+        annot_indexes = {annot: header.index(annot) for annot in GENE_LEVEL_ANNOTATIONS}
+        for l in f:
+            row = l.rstrip("\n").split("\t")
+            if row[gene_index] not in res:
+                res[row[gene_index]] = {annot: row[i] for annot, i in annot_indexes.items()}
     return res
 
 
+def check_exomiser_header(vcf: cyvcf2.VCF, vcf_path: str) -> None:
+    """
+    Verify description so indexes can be used safely later
+    """
+    exomiser_header = vcf.get_header_type("Exomiser")
+    if EXOMISER_DESCRIPTION not in exomiser_header["Description"]:
+        raise ValueError(
+            f"Unexpected Exomiser description in VCF header: {exomiser_header} -- failing VCF: {vcf_path}"
+        )
+
+
 def write_template(
-    template, s, ped, vcf_in_container, tmp_dir_in_container, tmp_dir, assembly
+    template,
+    name,
+    proband,
+    hpos,
+    vcf_in_container,
+    tmp_dir_in_container,
+    tmp_dir,
+    assembly,
 ):
-    template["analysis"]["proband"] = s
-    if s in ped:
-        template["analysis"]["hpoIds"] = ped[s].HPO
-    else:
-        template["analysis"]["hpoIds"] = []
+    """
+    Write the template of analysis name, for proband of vcf_in_container with hpos
+    """
+    template["analysis"]["proband"] = proband
+    template["analysis"]["hpoIds"] = hpos
     template["analysis"]["vcf"] = vcf_in_container
     template["analysis"]["genomeAssembly"] = assembly
 
     template["outputOptions"]["outputDirectory"] = tmp_dir_in_container
-    template["outputOptions"]["outputFileName"] = s
+    template["outputOptions"]["outputFileName"] = name
 
-    template_file = osj(tmp_dir, s + "_template.json")
+    template_file = osj(tmp_dir, name + "_template.json")
     with open(template_file, "w") as f:
         json.dump(template, f)
 
 
-def docker_cmd(config, cmd):
+def get_runner(config: dict) -> str:
+    runner = config["exomiser"].get("runner", "docker")
+    if runner not in EXOMISER_RUNNERS:
+        raise ValueError(f"Unknown exomiser:runner {runner}, expected one of: {', '.join(EXOMISER_RUNNERS)}")
+    return runner
+
+
+def get_runner_cmd(config: dict, runner: str, cmd: str, docker_name: str | None = None) -> str:
+    """
+    Command running Exomiser's java arguments cmd with runner:
+    - docker: java in the howard container, see docker_cmd
+    - java: java of the host (exomiser:java, default: java found in PATH), with paths of config outside of the container
+    - stub: deterministic stand-in writing Exomiser-shaped VCFs without Exomiser's databases, see exomiser_stub.py
+    """
+    if runner == "docker":
+        return docker_cmd(config, cmd, docker_name)
+    if runner == "java":
+        return f"{config['exomiser'].get('java', 'java')} {cmd}"
+    return f"{sys.executable} -m vannotplus.exomiser.exomiser_stub {cmd}"
+
+
+def get_docker_name() -> str:
     random_tag = random.randint(1, 1000000)
-    docker_name = f"VANNOTPLUS_exomiser_{random_tag}"
+    return f"VANNOTPLUS_exomiser_{random_tag}"
+
+
+def docker_cmd(config, cmd, docker_name=None):
+    if docker_name is None:
+        docker_name = get_docker_name()
     docker_cmd = f"docker run --rm --name {docker_name}"
     for k, v in config["mount"].items():
         docker_cmd += f" -v {k}:{v}"
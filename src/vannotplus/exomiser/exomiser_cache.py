@@ -0,0 +1,147 @@
+"""
+Cache of Exomiser results, so that samples analysed again with the same inputs do not run Exomiser again.
+
+Each entry is the parsed result of one sample (see exomiser.get_annotated_variants), pickled in the cache directory.
+Entries are content-addressed: the file name is a hash of everything Exomiser's result depends on (see get_cache_key).
+The least recently used entries are removed once the cache exceeds its maximum size.
+"""
+
+import hashlib
+import json
+import logging as log
+import os
+import pickle
+
+from vannotplus.commons import atomic_write, parse_size
+
+DEFAULT_EXOMISER_CACHE_DIR = "~/.cache/vannotplus/exomiser"
+DEFAULT_EXOMISER_CACHE_SIZE = "5G"
+# increase if the content of entries or the way keys are computed changes
+EXOMISER_CACHE_VERSION = 1
+
+
+def get_host_path(config: dict, container_path: str) -> str:
+    """
+    Path outside of the container of container_path, according to config["mount"]
+    """
+    for real_path, mounted_path in config["mount"].items():
+        if container_path.startswith(mounted_path):
+            return container_path.replace(mounted_path, real_path, 1)
+    return container_path
+
+
+def get_exomiser_fingerprint(config: dict) -> str:
+    """
+    Identify the Exomiser version and data in use: image, jar, data directory, and content of the properties file which holds the data versions.
+    Only the path of the properties file is used if it cannot be read
+    """
+    exomiser_config = config["exomiser"]
+    fingerprint = [
+        str(config["howard"]["version"]),
+        exomiser_config["jar"],
+        exomiser_config["db"],
+        exomiser_config["properties"],
+    ]
+    try:
+        with open(get_host_path(config, exomiser_config["properties"]), "r") as f:
+            fingerprint.append(f.read())
+    except OSError:
+        log.debug(f"Could not read {exomiser_config['properties']}, using its path only in Exomiser cache keys")
+    return hashlib.sha256("\n".join(fingerprint).encode()).hexdigest()
+
+
+def get_cache_key(sample_vcf: str, hpos: list[str], template: dict, exomiser_fingerprint: str) -> str:
+    """
+    Hash of the variant set of sample_vcf (its records, the header is ignored), its sorted HPOs,
+    the analysis template without its run-specific paths and names, and the Exomiser fingerprint (see get_exomiser_fingerprint)
+    """
+    analysis = {k: v for k, v in template["analysis"].items() if k not in ("vcf", "proband", "hpoIds")}
+    output_options = {
+        k: v for k, v in template["outputOptions"].items() if k not in ("outputDirectory", "outputFileName")
+    }
+    normalized = {**template, "analysis": analysis, "outputOptions": output_options}
+
+    h = hashlib.sha256()
+    h.update(str(EXOMISER_CACHE_VERSION).encode())
+    h.update(exomiser_fingerprint.encode())
+    h.update(json.dumps(sorted(hpos)).encode())
+    h.update(json.dumps(normalized, sort_keys=True).encode())
+    with open(sample_vcf, "rb") as f:
+        for l in f:
+            if not l.startswith(b"#"):
+                h.update(l)
+    return h.hexdigest()
+
+
+class ExomiserCache:
+    """
+    Directory of cached Exomiser results, limited to max_size bytes
+    """
+
+    def __init__(self, cache_dir: str, max_size: int) -> None:
+        self.cache_dir = os.path.expanduser(cache_dir)
+        self.max_size = max_size
+
+    @classmethod
+    def from_config(cls, config: dict) -> "ExomiserCache | None":
+        """
+        Cache set by exomiser:cache_dir and exomiser:cache_max_size, None if cache_dir is empty
+        """
+        cache_dir = config["exomiser"].get("cache_dir", DEFAULT_EXOMISER_CACHE_DIR)
+        if not cache_dir:
+            return None
+        max_size = parse_size(str(config["exomiser"].get("cache_max_size", DEFAULT_EXOMISER_CACHE_SIZE)))
+        return cls(cache_dir, max_size)
+
+    def get_path(self, key: str) -> str:
+        return os.path.join(self.cache_dir, key + ".pkl")
+
+    def get(self, key: str) -> dict | None:
+        """
+        Cached result of key, None if absent or unreadable
+        """
+        path = self.get_path(key)
+        try:
+            with open(path, "rb") as f:
+                res = pickle.load(f)
+        except FileNotFoundError:
+            return None
+        except Exception as e:
+            log.debug(f"Ignoring unreadable Exomiser cache entry {path}: {e}")
+            return None
+        try:
+            # modification time is the last use, for eviction
+            os.utime(path)
+        except OSError:
+            pass
+        return res
+
+    def put(self, key: str, value: dict) -> None:
+        try:
+            os.makedirs(self.cache_dir, exist_ok=True)
+            with atomic_write(self.get_path(key)) as f:
+                pickle.dump(value, f, protocol=pickle.HIGHEST_PROTOCOL)
+        except OSError as e:
+            log.warning(f"Could not write Exomiser cache in {self.cache_dir}: {e}")
+
+    def evict(self) -> None:
+        """
+        Remove least recently used entries until the cache fits in max_size
+        """
+        entries = []
+        try:
+            for entry in os.scandir(self.cache_dir):
+                if entry.name.endswith(".pkl"):
+                    stat = entry.stat()
+                    entries.append((stat.st_mtime_ns, stat.st_size, entry.path))
+        except FileNotFoundError:
+            return
+        total = sum(e[1] for e in entries)
+        for _, size, path in sorted(entries):
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(path)
+                total -= size
+            except FileNotFoundError:
+                pass
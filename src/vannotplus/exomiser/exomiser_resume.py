@@ -0,0 +1,84 @@
+"""
+Checkpoints of an Exomiser run, so that a run interrupted by a failing sample or a preempted node can be resumed.
+
+A resumable run works in a stable directory next to its output (see get_work_dir) instead of a new temporary one.
+The parsed result of each analysis is stored there as soon as its Exomiser job is over,
+and recorded in a manifest along with the key of the analysis (see exomiser_cache.get_cache_key).
+A resumed run only runs Exomiser for analyses missing from the manifest, or whose inputs changed since.
+"""
+
+import json
+import logging as log
+import os
+import pickle
+
+from vannotplus.commons import atomic_write
+
+# increase if the content of the manifest or of results changes
+EXOMISER_MANIFEST_VERSION = 1
+
+
+def get_work_dir(output_vcf: str) -> str:
+    """
+    Stable work directory of the Exomiser run writing output_vcf
+    """
+    return os.path.abspath(output_vcf) + ".exomiser_work"
+
+
+class ExomiserManifest:
+    """
+    Completed analyses of a resumable run in work_dir, with the key of each one
+    """
+
+    def __init__(self, work_dir: str) -> None:
+        self.work_dir = work_dir
+        self.path = os.path.join(work_dir, "manifest.json")
+        self.analyses: dict[str, str] = {}
+
+    @classmethod
+    def load(cls, work_dir: str) -> "ExomiserManifest":
+        """
+        Manifest of work_dir, empty if there is none or if it cannot be used
+        """
+        manifest = cls(work_dir)
+        try:
+            with open(manifest.path, "r") as f:
+                content = json.load(f)
+        except FileNotFoundError:
+            return manifest
+        except ValueError as e:
+            log.warning(f"Ignoring unreadable Exomiser manifest {manifest.path}: {e}")
+            return manifest
+        if content.get("version") != EXOMISER_MANIFEST_VERSION:
+            log.info(f"Ignoring Exomiser manifest {manifest.path} of another version")
+            return manifest
+        manifest.analyses = content["analyses"]
+        return manifest
+
+    def get_result_path(self, name: str) -> str:
+        return os.path.join(self.work_dir, name + "_result.pkl")
+
+    def get(self, name: str, key: str) -> dict | None:
+        """
+        Result of analysis name if it was completed with the same key, None otherwise
+        """
+        if self.analyses.get(name) != key:
+            return None
+        try:
+            with open(self.get_result_path(name), "rb") as f:
+                return pickle.load(f)
+        except Exception as e:
+            log.debug(f"Ignoring unreadable Exomiser result {self.get_result_path(name)}: {e}")
+            return None
+
+    def add(self, name: str, key: str, result: dict) -> None:
+        """
+        Store the result of analysis name, then record it in the manifest.
+        Both are written atomically, so that an interruption never leaves a partial checkpoint
+        """
+        with atomic_write(self.get_result_path(name)) as f:
+            pickle.dump(result, f, protocol=pickle.HIGHEST_PROTOCOL)
+
+        self.analyses[name] = key
+        with atomic_write(self.path, "w") as f:
+            json.dump({"version": EXOMISER_MANIFEST_VERSION, "analyses": self.analyses}, f)
@@ -0,0 +1,111 @@
+"""
+Deterministic stand-in for Exomiser, used by the "stub" runner (see exomiser.get_runner_cmd) to test and profile
+the exomiser stage without Docker nor Exomiser's databases.
+
+Takes the same arguments as Exomiser's CLI (--analysis=template.json or --batch=file, other arguments are ignored)
+and writes, for each analysis, Exomiser-shaped outputs in the template's output directory, according to its output formats:
+- VCF: each variant of the input VCF annotated with an Exomiser INFO field, in the format of exomiser.EXOMISER_DESCRIPTION
+- TSV_GENE: one row per gene, with the columns of Exomiser's genes TSV (see STUB_GENES_HEADER)
+
+Genes are 100kb bins named <chrom>_<bin>, so gene mode needs a gene field holding the same names.
+Scores are hashes: the gene phenotype score depends on the HPOs and the gene, the other ones on the variant.
+The process fails (return code 1) on the analysis of the proband named by the STUB_FAIL_ENV environment variable, to test failures.
+"""
+
+import gzip
+import hashlib
+import json
+import os
+import sys
+
+from vannotplus.exomiser.exomiser import EXOMISER_DESCRIPTION, EXOMISER_GENES_SUFFIX
+
+STUB_GENE_SIZE = 100000
+STUB_FAIL_ENV = "VANNOTPLUS_EXOMISER_STUB_FAIL"
+STUB_GENES_HEADER = [
+    "#RANK",
+    "ID",
+    "GENE_SYMBOL",
+    "ENTREZ_GENE_ID",
+    "MOI",
+    "P-VALUE",
+    "EXOMISER_GENE_COMBINED_SCORE",
+    "EXOMISER_GENE_PHENO_SCORE",
+    "EXOMISER_GENE_VARIANT_SCORE",
+]
+
+
+def get_stub_score(*parts: str) -> str:
+    return "%.4f" % (int(hashlib.md5("|".join(parts).encode()).hexdigest()[:6], 16) / 0xFFFFFF)
+
+
+def run_stub_analysis(template_file: str) -> None:
+    with open(template_file, "r") as f:
+        template = json.load(f)
+    if template["analysis"]["proband"] == os.environ.get(STUB_FAIL_ENV):
+        sys.exit(f"Failing analysis of {template['analysis']['proband']} ({STUB_FAIL_ENV} is set)")
+    hpos = ",".join(sorted(template["analysis"]["hpoIds"]))
+    output_prefix = os.path.join(
+        template["outputOptions"]["outputDirectory"], template["outputOptions"]["outputFileName"]
+    )
+    output_formats = template["outputOptions"]["outputFormats"]
+    f_vcf = gzip.open(output_prefix + ".vcf.gz", "wt", compresslevel=1) if "VCF" in output_formats else None
+    genes = {}
+    with open(template["analysis"]["vcf"], "r") as f_in:
+        for l in f_in:
+            if l.startswith("##"):
+                if f_vcf is not None:
+                    f_vcf.write(l)
+                continue
+            if l.startswith("#"):
+                if f_vcf is not None:
+                    f_vcf.write(
+                        f'##INFO=<ID=Exomiser,Number=.,Type=String,Description="A pipe-separated set of values for the proband allele(s) from the record with one per compatible MOI following the format: {EXOMISER_DESCRIPTION}">\n'
+                    )
+                    f_vcf.write(l)
+                continue
+            fields = l.rstrip("\n").split("\t")
+            chrom, pos = fields[0], fields[1]
+            variant = "_".join(fields[:5])
+            gene = f"{chrom}_{int(pos) // STUB_GENE_SIZE}"
+            values = [
+                "1",
+                f"{chrom}-{pos}",
+                gene,
+                "1",
+                "AD",
+                get_stub_score("p_value", hpos, variant),
+                get_stub_score("combined", hpos, variant),
+                get_stub_score("pheno", hpos, gene),
+                get_stub_score("gene_variant", variant),
+                get_stub_score("variant", variant),
+            ]
+            genes.setdefault(gene, values)
+            if f_vcf is not None:
+                fields[7] = "Exomiser={" + "|".join(values + ["0"] * 8) + "}"
+                f_vcf.write("\t".join(fields) + "\n")
+    if f_vcf is not None:
+        f_vcf.close()
+
+    if "TSV_GENE" in output_formats:
+        with open(output_prefix + EXOMISER_GENES_SUFFIX, "w") as f:
+            f.write("\t".join(STUB_GENES_HEADER) + "\n")
+            for rank, (gene, values) in enumerate(genes.items(), 1):
+                # same gene-level values as the first variant of the gene in the VCF
+                f.write("\t".join([str(rank), f"{gene}_AD", gene, "1", "AD"] + values[5:9]) + "\n")
+
+
+def main(args: list[str]) -> None:
+    template_files = []
+    for arg in args:
+        if arg.startswith("--analysis="):
+            template_files.append(arg.split("=", 1)[1])
+        elif arg.startswith("--batch="):
+            with open(arg.split("=", 1)[1], "r") as f:
+                template_files += [l.strip().split("=", 1)[1] for l in f if l.strip()]
+    for template_file in template_files:
+        run_stub_analysis(template_file)
+
+
+if __name__ == "__main__":
+    main(sys.argv[1:])
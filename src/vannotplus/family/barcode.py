@@ -1,6 +1,8 @@
+from itertools import product
 import logging as log
 import os
 from os.path import join as osj
+import re
 import shutil
 import tempfile
 
@@ -9,6 +11,16 @@ import numpy as np
 
 from vannotplus.commons import load_ped, run_shell
 from vannotplus.family.ped9 import Ped, Sample
+from vannotplus.family.pedigree import PedigreeGraph
+
+# Families with more samples than this get their barcodes joined on the fly instead of read from a table of 3**n barcodes
+MAX_BARCODE_TABLE_SAMPLES = 10
+
+# header line declaring a family's barcode samples once, see main_barcode_fast(header_families=True)
+BARCODE_FAMILY_HEADER = "BARCODE_FAMILY"
+BARCODE_FAMILY_REGEX = re.compile(rf'^##{BARCODE_FAMILY_HEADER}=<ID=([^,]*),Samples="([^"]*)",Members="([^"]*)">$')
+# ID of a barcode family none of whose members is in the ped
+UNKNOWN_BARCODE_FAMILY = "unknown"
 
 
 def get_parental_aliases(sample: Sample, ped: Ped, is_mother: bool) -> list[str]:
@@ -139,12 +151,10 @@ def get_families_indexes_v2(input_vcf: cyvcf2.VCF, ped: Ped) -> list[list[int]]:
     Some implementation details :
     - If a sample has no family, its list will only contain itself
     - All samples of a given family have the same barcode, so the same indexes.
-    - Index order is : all affected samples of the family, then parents (mother first), then their parents if any (mother first) (then their parents, etc), then remaining samples of the family.
+    - Index order is : all affected samples of the family, then parents (mother first), then their parents if any (mother first) (then their parents, etc), then remaining samples of the family. See PedigreeGraph
     - The above implies that trios will have the usual barcode: index-mother-father
     - It is possible for mother/father samples to have a different family ID, in case of pooled parental samples. In this case the pooled parental samples will have no barcode. There should be a APP#POOL STARK tag to help detect this.
 
-    TODO: does not actually work yet with grandparents. Only parents are looked up.
-
     for example
         if ped says:
             sample A1 has father M1 and mother F1
@@ -157,14 +167,21 @@ def get_families_indexes_v2(input_vcf: cyvcf2.VCF, ped: Ped) -> list[list[int]]:
     [[0,2,1], [0,2,1], [0,2,1], [3], [5,4], [5,4], [6,9,7,8,10], [6,9,7,8,10], [6,9,7,8,10], [6,9,7,8,10], [6,9,7,8,10]]
     """
     families_indexes: list[list[int]] = []
+    samples = input_vcf.samples
+    # computed once: VCF column of each sample, and barcode indexes of each family
+    columns = get_sample_columns(samples)
+    family_indexes_dict: dict[str, list[int]] = {}
+    pedigree = PedigreeGraph(ped)
 
-    for s in input_vcf.samples:
+    for s in samples:
         family = ped.get_family_from_sample(s)
         if family == None:
-            indexes = samples_to_indexes(input_vcf.samples, [s])
+            indexes = samples_to_indexes(samples, [s], columns)
         else:
-            barcode_samples = get_samples_for_barcode(ped, family)
-            indexes = samples_to_indexes(input_vcf.samples, barcode_samples)
+            if family not in family_indexes_dict:
+                barcode_samples = pedigree.get_barcode_samples(family)
+                family_indexes_dict[family] = samples_to_indexes(samples, barcode_samples, columns)
+            indexes = family_indexes_dict[family]
         families_indexes.append(indexes)
 
     return families_indexes
@@ -173,71 +190,161 @@ def get_families_indexes_v2(input_vcf: cyvcf2.VCF, ped: Ped) -> list[list[int]]:
 def get_samples_for_barcode(ped: Ped, family: str) -> list[str]:
     """
     Get an ordered list of sample names. Order corresponds to specifications in get_families_indexes_v2 docstring.
+    To get the layout of several families, use a single PedigreeGraph instead.
     """
-    samples = ped.get_samples_from_family(family)
-    if len(samples) == 0:
-        return []
-    res = []
+    return PedigreeGraph(ped).get_barcode_samples(family)
 
-    # 1) Find ordered parents/grandparents/etc
-    unique_parents = []
-    for s in samples:
-        parents = s.get_parents()
-        for p in parents:
-            if p not in unique_parents and p not in ("", None):
-                unique_parents.append(p)
 
-    # 2) Add affected samples except if they're going to be in the parents block
-    for s in samples:
-        if s.is_affected and s.individual_id not in unique_parents:
-            res.append(s.individual_id)
+def get_sample_columns(sample_list: list[str]) -> dict[str, int]:
+    """
+    Sample name -> index of its first occurrence in sample_list (e.g. VCF column)
+    """
+    columns: dict[str, int] = {}
+    for i, s in enumerate(sample_list):
+        columns.setdefault(s, i)
+    return columns
 
-    # 3) Add the parents
-    res.extend(unique_parents)
 
-    # 4) Add any remaining samples from the family
-    for s in samples:
-        if s.individual_id not in res:
-            res.append(s.individual_id)
+def samples_to_indexes(
+    sample_list: list[str], samples_to_find: list[str], columns: dict[str, int] | None = None
+) -> list[int]:
+    """
+    Indexes of samples_to_find in sample_list, skipping absent samples
+    columns: get_sample_columns(sample_list), to avoid recomputing it on each call
+    """
+    if columns is None:
+        columns = get_sample_columns(sample_list)
+    return [columns[s] for s in samples_to_find if s in columns]
 
-    # This process should not result in duplicates
-    if len(res) != len(set(res)):
-        raise ValueError(f"Duplicate samples detected in the result list: {res}")
 
-    return res
+class FamilyBarcoder:
+    """
+    Barcodes of all samples of a VCF, computed once per family and per record, for main_barcode_fast
 
+    All samples of a family share the same barcode, so families are deduplicated once from get_families_indexes_v2() output.
+    For each record, the genotypes of a family's samples (0, 1 or 2, in barcode order) are read as a base-3 number,
+    which is the index of the family's barcode in a table of pre-encoded barcodes of the same length (e.g. "0112" is 0*27 + 1*9 + 1*3 + 2 = 14 in the table of 4 samples barcodes).
+    BCFS values never change from one record to the next, so they are encoded once.
+    """
+
+    def __init__(self, samples: list[str], families_indexes: list[list[int]]) -> None:
+        # families of more than one sample, in order of first appearance
+        families: list[tuple[int, ...]] = []
+        family_codes: dict[tuple[int, ...], int] = {}
+        # family of each sample, len(families) (which will hold ".") if the sample has no family
+        sample_families = []
+        for indexes in families_indexes:
+            indexes = tuple(indexes)
+            if len(indexes) == 1:
+                sample_families.append(-1)
+                continue
+            if indexes not in family_codes:
+                family_codes[indexes] = len(families)
+                families.append(indexes)
+            sample_families.append(family_codes[indexes])
+        self.families = families
+        self.sample_families = np.array([len(families) if f == -1 else f for f in sample_families], dtype=np.intp)
+
+        bcfs_list = [",".join([samples[i] for i in f]) for f in families] + ["."]
+        self.bcfs = np.asarray(bcfs_list, dtype=np.bytes_)[self.sample_families]
+
+        # one table of barcodes per family size, concatenated
+        sizes = sorted({len(f) for f in families if len(f) <= MAX_BARCODE_TABLE_SAMPLES})
+        tables = [np.asarray(["".join(p) for p in product("012", repeat=n)], dtype=np.bytes_) for n in sizes]
+        size_offsets = dict(zip(sizes, np.cumsum([0] + [len(t) for t in tables])))
+        self.table = np.concatenate(tables) if tables else np.empty(0, dtype=np.bytes_)
+
+        table_families = [f for f in families if len(f) <= MAX_BARCODE_TABLE_SAMPLES]
+        self.table_rows = np.array([i for i, f in enumerate(families) if len(f) <= MAX_BARCODE_TABLE_SAMPLES], dtype=np.intp)
+        self.large_families = [(i, np.array(f)) for i, f in enumerate(families) if len(f) > MAX_BARCODE_TABLE_SAMPLES]
+        # flattened samples of table families, weight of each sample's genotype in its family code, and start of each family
+        self.members = np.array([i for f in table_families for i in f], dtype=np.intp)
+        self.weights = np.array([3 ** (len(f) - 1 - k) for f in table_families for k in range(len(f))], dtype=np.int64)
+        self.starts = np.cumsum([0] + [len(f) for f in table_families[:-1]]).astype(np.intp)
+        self.offsets = np.array([size_offsets[len(f)] for f in table_families], dtype=np.int64)
+
+        self.barcode_dtype = np.dtype(f"S{max([len(f) for f in families], default=1)}")
+
+    def get_barcodes(self, gt_types: np.ndarray) -> np.ndarray:
+        """
+        Return the barcode of each sample ("." if it has no family)
+        gt_types: cyvcf2.Variant.gt_types read with gts012=True
+        """
+        # consider that unknown (3) are wild type (0) in barcode
+        genotypes = np.where(gt_types == 3, 0, gt_types)
+        family_barcodes = np.empty(len(self.families) + 1, dtype=self.barcode_dtype)
+        family_barcodes[-1] = b"."
+        if len(self.members):
+            codes = np.add.reduceat(genotypes[self.members] * self.weights, self.starts)
+            family_barcodes[self.table_rows] = self.table[self.offsets + codes]
+        for i, family in self.large_families:
+            family_barcodes[i] = "".join([str(v) for v in genotypes[family]]).encode()
+        return family_barcodes[self.sample_families]
+
+    def get_members(self, family: int) -> np.ndarray:
+        """
+        Return indexes of the samples carrying the barcode of the family-th family.
+        Usually the samples of the barcode, but pooled parents belong to another family and carry no barcode
+        """
+        return np.flatnonzero(self.sample_families == family)
+
+
+def get_barcode_family_id(ped: Ped, members: list[str]) -> str:
+    """
+    Family ID of a barcode family, taken from the samples carrying its barcode (see FamilyBarcoder.get_members)
+    rather than from its first barcode sample, which can be a pooled parent of another family or a parent absent from the ped
+    """
+    for member in members:
+        family_id = ped.get_family_from_sample(member)
+        if family_id is not None:
+            return family_id
+    return UNKNOWN_BARCODE_FAMILY
 
-# def recursive_get_parents(
-#     ped: Ped, sample: Sample, generation: int = 0, parents: list[str] = []
-# ) -> list[str]:
-#     """
-#     Recursively get all parents/grandparents/greatgrandparents/etc of a sample.
-#     Parents are ordered by generation, with the closest parents first and the mother first in each pair of parents.
 
-#     TODO: function works in standalone but not when repeatedly called from get_families_indexes_v2. Need to find the hidden side effect.
-#     """
-#     if sample.maternal_id not in ("", None):
-#         if sample.maternal_id not in parents:
-#             parents.append(sample.maternal_id)
-#         recursive_get_parents(ped, ped[sample.maternal_id], generation + 1, parents)
-#     if sample.paternal_id not in ("", None):
-#         if sample.paternal_id not in parents:
-#             parents.append(sample.paternal_id)
-#         recursive_get_parents(ped, ped[sample.paternal_id], generation + 1, parents)
-#     return parents
+def get_barcode_family_header(family_id: str, barcode_samples: list[str], members: list[str]) -> str:
+    """
+    Header line declaring a family's ordered barcode samples, and which samples carry its barcode
+    """
+    return f'##{BARCODE_FAMILY_HEADER}=<ID={family_id},Samples="{",".join(barcode_samples)}",Members="{",".join(members)}">'
 
 
-def samples_to_indexes(sample_list: list[str], samples_to_find: list[str]) -> list[int]:
-    indexes = []
-    for s in samples_to_find:
-        if s in sample_list:
-            indexes.append(sample_list.index(s))
-    return indexes
+def read_barcode_families(vcf: cyvcf2.VCF) -> dict[str, list[str]]:
+    """
+    For VCFs barcoded with header_families=True: return, for each sample carrying a barcode, the ordered samples of its barcode (what BCFS would contain)
+    Samples without barcode are absent from the result
+    """
+    sample_to_barcode_samples = {}
+    for line in vcf.raw_header.splitlines():
+        match = BARCODE_FAMILY_REGEX.match(line)
+        if match is None:
+            continue
+        barcode_samples = match.group(2).split(",")
+        for member in match.group(3).split(","):
+            sample_to_barcode_samples[member] = barcode_samples
+    return sample_to_barcode_samples
+
+
+def decode_barcode(barcode: str, barcode_samples: list[str]) -> dict[str, int]:
+    """
+    Return the genotype of each sample of a barcode (0 = wild type or unknown, 1 = heterozygous, 2 = homozygous)
+
+    >>> decode_barcode("120", ["SGT1", "SGT4", "SGT5"])
+    {'SGT1': 1, 'SGT4': 2, 'SGT5': 0}
+    """
+    if len(barcode) != len(barcode_samples):
+        raise ValueError(f"Barcode {barcode} does not match its {len(barcode_samples)} samples: {barcode_samples}")
+    return {s: int(g) for s, g in zip(barcode_samples, barcode)}
 
 
 def main_barcode_fast(
-    input_vcf_path: str, output_vcf_path: str, app: str, config: dict
+    input_vcf_path: str, output_vcf_path: str, app: str, config: dict, header_families: bool = False
 ):
+    """
+    Add BCF (barcode) and BCFS (barcode samples) FORMAT fields to each sample of input VCF
+
+    if header_families == True: BCFS is not written. Instead, each family's barcode samples are declared once in a ##BARCODE_FAMILY header line,
+    which makes output much smaller for large VCFs. Use read_barcode_families() to get each sample's barcode samples back
+    """
     # use a copied temporary vcf as input so its header can be modified for ease of development
     tmp_dir = tempfile.TemporaryDirectory()
     work_vcf_path = osj(tmp_dir.name, os.path.basename(input_vcf_path))
@@ -249,52 +356,55 @@ def main_barcode_fast(
 
     # for each sample, get indexes corresponding to its parents in the input VCF if they exist
     families_indexes = get_families_indexes_v2(input_vcf, ped)
+    barcoder = FamilyBarcoder(input_vcf.samples, families_indexes)
 
     # change input header as variants will originate from input_vcf
-    input_vcf.add_format_to_header(
-        {
-            "ID": "BCF",
-            "Number": 1,
-            "Type": "String",
-            "Description": "Family barcode: for each sample in the family, assign 1 integer depending on genotype. 0 = wild type or unknown, 1 = heterozygous, 2 = homozygous. The family's sample list can be found in the BCFS tag.",
-        }
-    )
-    input_vcf.add_format_to_header(
-        {
-            "ID": "BCFS",
-            "Number": ".",
-            "Type": "String",
-            "Description": "Samples in the family barcode",
-        }
-    )
+    if header_families:
+        family_ids = set()
+        for i, family in enumerate(barcoder.families):
+            members = [input_vcf.samples[j] for j in barcoder.get_members(i)]
+            family_id = get_barcode_family_id(ped, members)
+            # in case distinct barcodes come from the same family
+            while family_id in family_ids:
+                family_id += "_"
+            family_ids.add(family_id)
+            input_vcf.add_to_header(
+                get_barcode_family_header(family_id, [input_vcf.samples[j] for j in family], members)
+            )
+        input_vcf.add_format_to_header(
+            {
+                "ID": "BCF",
+                "Number": 1,
+                "Type": "String",
+                "Description": f"Family barcode: for each sample in the family, assign 1 integer depending on genotype. 0 = wild type or unknown, 1 = heterozygous, 2 = homozygous. The family's sample list can be found in the {BARCODE_FAMILY_HEADER} header line whose Members contain the sample.",
+            }
+        )
+    else:
+        input_vcf.add_format_to_header(
+            {
+                "ID": "BCF",
+                "Number": 1,
+                "Type": "String",
+                "Description": "Family barcode: for each sample in the family, assign 1 integer depending on genotype. 0 = wild type or unknown, 1 = heterozygous, 2 = homozygous. The family's sample list can be found in the BCFS tag.",
+            }
+        )
+        input_vcf.add_format_to_header(
+            {
+                "ID": "BCFS",
+                "Number": ".",
+                "Type": "String",
+                "Description": "Samples in the family barcode",
+            }
+        )
     output_vcf = cyvcf2.Writer(output_vcf_path, input_vcf)
 
     # then iterate over input_vcf and write variants with barcodes in output_vcf
     for var in input_vcf:
         if var.POS % 100000 == 0:
             log.info(f"{var.CHROM}:{var.POS}")
-        bcf_list = []
-        bcfs_list = []
-
-        genotypes: np.ndarray = var.gt_types
-        # consider that unknown (3) are wild type (0) in barcode
-        genotypes[var.gt_types == 3] = 0
-
-        for i, _ in enumerate(input_vcf.samples):
-            if len(families_indexes[i]) == 1:
-                # no family
-                bcf_list.append(".")
-                bcfs_list.append(".")
-            else:
-                barcode = "".join([str(v) for v in genotypes[families_indexes[i]]])
-                barcode_samples = ",".join(
-                    list(map(input_vcf.samples.__getitem__, families_indexes[i]))
-                )
-                bcf_list.append(barcode)
-                bcfs_list.append(barcode_samples)
-
-        var.set_format("BCF", np.asarray(bcf_list, dtype=np.bytes_))
-        var.set_format("BCFS", np.asarray(bcfs_list, dtype=np.bytes_))
+        var.set_format("BCF", barcoder.get_barcodes(var.gt_types))
+        if not header_families:
+            var.set_format("BCFS", barcoder.bcfs)
         output_vcf.write_record(var)
 
     output_vcf.close()
@@ -1,5 +1,12 @@
 from collections import UserDict
+import hashlib
 import json
+import logging as log
+import os
+import pickle
+
+# increase if Sample or Ped attributes change, to invalidate existing caches
+PED_CACHE_VERSION = 1
 
 
 class Sample:
@@ -15,6 +22,8 @@ class Sample:
         "HPO": 7,
         "tags": 8,
     }
+    # compact record: no per-instance __dict__, as application pedigrees can hold thousands of samples
+    __slots__ = tuple(ATTRIBUTES)
 
     def __init__(
         self, attributes: list[str] | dict[str, str | int | list[str] | None]
@@ -36,6 +45,14 @@ class Sample:
     def __str__(self):
         return ",".join([str(getattr(self, k)) for k in self.ATTRIBUTES.keys()])
 
+    def __getstate__(self):
+        # a plain tuple pickles and unpickles much faster than the default state of a __slots__ class
+        return tuple([getattr(self, k) for k in self.__slots__])
+
+    def __setstate__(self, state):
+        for k, v in zip(self.__slots__, state):
+            setattr(self, k, v)
+
     def load_from_list(self, attributes: list[str]) -> None:
         for k, v in self.ATTRIBUTES.items():
             if v >= 6 and len(attributes) == 6:
@@ -100,13 +117,14 @@ class Ped(UserDict):
             ped_object["sample_name"]
         instead of
             ped_object.samples["sample_name"] # where samples would have been a dict attribute containing samples
+
+    Family and parent/children lookups use indexes built once at load time (see build_indexes), and kept up to date when samples are set or deleted.
     """
 
     def __init__(self, ped_file: str | None = None) -> None:
         if not ped_file:
             self.data = {}
-            return
-        if ped_file.endswith(".json"):
+        elif ped_file.endswith(".json"):
             self.data = self.load_from_json(ped_file)
         elif ped_file.endswith(".ped") or ped_file.endswith(".ped9"):
             self.data = self.load_from_ped9(ped_file)
@@ -114,6 +132,26 @@ class Ped(UserDict):
             raise ValueError(
                 f"Expected file extension: .json, .ped, .ped9 ; got instead: {ped_file}"
             )
+        self.build_indexes()
+
+    def build_indexes(self) -> None:
+        """
+        family ID -> samples of the family, and parent ID -> children, both in ped order
+        """
+        self.families: dict[str, list[Sample]] = {}
+        self.children: dict[str, list[Sample]] = {}
+        for sample in self.data.values():
+            self.families.setdefault(sample.family_id, []).append(sample)
+            for parent in {sample.paternal_id, sample.maternal_id} - {"", None}:
+                self.children.setdefault(parent, []).append(sample)
+
+    def __setitem__(self, key, value):
+        super().__setitem__(key, value)
+        self.build_indexes()
+
+    def __delitem__(self, key):
+        super().__delitem__(key)
+        self.build_indexes()
 
     def __str__(self):
         return "\n".join([str(s) for s in self.data.values()])
@@ -159,13 +197,45 @@ class Ped(UserDict):
         return self.data[sample].family_id
 
     def get_samples_from_family(self, family: str) -> list[Sample]:
-        return [s for s in self.data.values() if s.family_id == family]
+        return list(self.families.get(family, []))
 
     def get_children_from_sample(self, sample: str) -> list[Sample]:
         if sample not in self.data:
             raise KeyError(f"Sample {sample} not found in the pedigree.")
-        children = []
-        for s in self.data.values():
-            if s.paternal_id == sample or s.maternal_id == sample:
-                children.append(s)
-        return children
+        return list(self.children.get(sample, []))
+
+
+def load_ped_cached(ped_file: str, cache_dir: str) -> Ped:
+    """
+    Same as Ped(ped_file), using a pickled copy of the parsed Ped stored in cache_dir.
+    The cache is keyed by the ped file's absolute path, modification time and size, so it is rebuilt whenever the file changes.
+    Any error reading or writing the cache falls back to parsing the file.
+    """
+    ped_file = os.path.abspath(ped_file)
+    stat = os.stat(ped_file)
+    key = (PED_CACHE_VERSION, ped_file, stat.st_mtime_ns, stat.st_size)
+    cache_dir = os.path.expanduser(cache_dir)
+    cache_file = os.path.join(cache_dir, f"ped_{hashlib.sha256(ped_file.encode()).hexdigest()[:16]}.pkl")
+
+    try:
+        with open(cache_file, "rb") as f:
+            cached_key, ped = pickle.load(f)
+        if cached_key == key:
+            log.debug(f"Loaded {ped_file} from cache {cache_file}")
+            return ped
+    except FileNotFoundError:
+        pass
+    except Exception as e:
+        log.debug(f"Ignoring unreadable ped cache {cache_file}: {e}")
+
+    # imported here since vannotplus.commons imports this module
+    from vannotplus.commons import atomic_write
+
+    ped = Ped(ped_file=ped_file)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        with atomic_write(cache_file) as f:
+            pickle.dump((key, ped), f, protocol=pickle.HIGHEST_PROTOCOL)
+    except OSError as e:
+        log.warning(f"Could not write ped cache in {cache_dir}: {e}")
+    return ped
@@ -0,0 +1,76 @@
+from collections import deque
+
+from vannotplus.family.ped9 import Ped, Sample
+
+
+class PedigreeGraph:
+    """
+    Parent links of a Ped, used to compute the barcode layout of each family once.
+
+    Layout of a family's barcode (see get_families_indexes_v2 in barcode.py):
+    1) affected samples of the family, except ancestors of other samples
+    2) their parents (mother first), then the parents of these parents (mother first), and so on, whatever the depth.
+       Each ancestor is placed once, in the closest generation it belongs to, which handles consanguineous families.
+    3) remaining samples of the family
+
+    Ancestors can belong to another family (e.g. pooled parental samples), they are still part of the layout.
+    """
+
+    def __init__(self, ped: Ped) -> None:
+        self.ped = ped
+        self.layouts: dict[str, list[str]] = {}
+
+    def get_parents(self, sample_id: str) -> list[str]:
+        """
+        Mother then father of sample_id if they are known, empty if sample_id is not in the ped
+        """
+        if sample_id not in self.ped:
+            return []
+        return self.ped[sample_id].get_parents()
+
+    def get_ancestors(self, samples: list[Sample]) -> list[str]:
+        """
+        Ancestors of samples, ordered by generation: parents of each sample (mother first) in the order of samples,
+        then their own parents in the same order, and so on
+        """
+        ancestors: list[str] = []
+        seen: set[str] = set()
+        queue = deque([s.individual_id for s in samples])
+        while queue:
+            for parent in self.get_parents(queue.popleft()):
+                if parent not in seen:
+                    seen.add(parent)
+                    ancestors.append(parent)
+                    queue.append(parent)
+        return ancestors
+
+    def get_barcode_samples(self, family: str) -> list[str]:
+        """
+        Ordered sample names of family's barcode, computed once per family
+        """
+        if family not in self.layouts:
+            self.layouts[family] = self.compute_layout(family)
+        return self.layouts[family]
+
+    def compute_layout(self, family: str) -> list[str]:
+        samples = self.ped.get_samples_from_family(family)
+        if len(samples) == 0:
+            return []
+
+        # generations are computed from samples that are nobody's parent, so that ancestors are sorted by generation
+        all_ancestors = set(self.get_ancestors(samples))
+        descendants = [s for s in samples if s.individual_id not in all_ancestors]
+        ancestors = self.get_ancestors(descendants)
+        # ancestors unreachable from descendants only happen with cycles in the ped, keep them after the others
+        ancestors += [a for a in self.get_ancestors(samples) if a not in ancestors]
+
+        res = [s.individual_id for s in descendants if s.is_affected()]
+        res += ancestors
+        placed = set(res)
+        res += [s.individual_id for s in samples if s.individual_id not in placed]
+
+        # This process should not result in duplicates
+        if len(res) != len(set(res)):
+            raise ValueError(f"Duplicate samples detected in the result list: {res}")
+
+        return res
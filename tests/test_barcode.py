@@ -1,10 +1,21 @@
 import filecmp
+import json
 import logging as log
 import os
 from os.path import join as osj
 
-from vannotplus.commons import load_config
-from vannotplus.family.barcode import main_barcode_fast
+from cyvcf2 import cyvcf2
+
+from vannotplus.commons import load_config, load_ped
+from vannotplus.family.barcode import (
+    BARCODE_FAMILY_REGEX,
+    decode_barcode,
+    main_barcode_fast,
+    read_barcode_families,
+)
+from vannotplus.family.ped9 import Ped, Sample, load_ped_cached
+from vannotplus.family.pedigree import PedigreeGraph
+import shutil
 import tempfile
 
 
@@ -54,6 +65,157 @@ def test_main_barcode_fast_pools(debug_mode=False):
     tmp_dir.cleanup()
 
 
+def test_main_barcode_fast_header_families():
+    """
+    Barcode samples declared in the header must be the same as BCFS values of the default output
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    config["ped_dir"] = osj(current_dir, "data")
+    config["ped_cache_dir"] = ""
+    input_vcf = osj(current_dir, "data", "test_pools.vcf")
+    control_vcf = osj(current_dir, "controls", "test_pools_barcoded.vcf")
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    output_vcf = osj(tmp_dir.name, "test_pools_header_families.vcf")
+    main_barcode_fast(input_vcf, output_vcf, "FAKE_APP", config, header_families=True)
+
+    output = cyvcf2.VCF(output_vcf)
+    barcode_families = read_barcode_families(output)
+    for var, control_var in zip(output, cyvcf2.VCF(control_vcf)):
+        assert "BCFS" not in var.FORMAT, "BCFS should not be written with header_families"
+        for i, s in enumerate(output.samples):
+            barcode = var.format("BCF")[i]
+            control_barcode = control_var.format("BCF")[i]
+            control_barcode_samples = control_var.format("BCFS")[i]
+            assert barcode == control_barcode
+            if control_barcode_samples == ".":
+                assert s not in barcode_families
+            else:
+                assert ",".join(barcode_families[s]) == control_barcode_samples
+                assert list(decode_barcode(barcode, barcode_families[s]).keys()) == barcode_families[s]
+    tmp_dir.cleanup()
+
+
+def test_main_barcode_fast_header_families_ids():
+    """
+    Family IDs in the header come from the samples carrying the barcode, not from its first sample,
+    which can be a pooled parent of another family or a parent absent from the ped
+    """
+    tmp_dir = tempfile.TemporaryDirectory()
+    # id, famID, maternalID, paternalID, phenotype, tags: only fathers and the pooled mother are sequenced
+    # famA barcode is POOL1,A_F, famB and famC barcodes start with a mother absent from the ped
+    ped = []
+    for row in (
+        ["A1", "famA", "POOL1", "A_F", "Affected", []],
+        ["A_F", "famA", "", "", 1, []],
+        ["POOL1", "pool", "", "", 1, ["APP#POOL"]],
+        ["B1", "famB", "B_M", "B_F", "Affected", []],
+        ["B_F", "famB", "", "", 1, []],
+        ["C1", "famC", "C_M", "C_F", "Affected", []],
+        ["C_F", "famC", "", "", 1, []],
+    ):
+        ped.append(
+            dict(zip(["id", "famID", "maternalID", "paternalID", "phenotype", "starkTags"], row), sex="", alias="", HPOList=[])
+        )
+    with open(osj(tmp_dir.name, "POOL_APP.json"), "w") as f:
+        json.dump(ped, f)
+    config = {"ped_dir": tmp_dir.name, "app_to_ped": {"POOL_APP": "POOL_APP.json"}, "ped_cache_dir": ""}
+
+    samples = ["POOL1", "A_F", "B_M", "B_F", "C_M", "C_F", "OTHER"]
+    input_vcf = osj(tmp_dir.name, "input.vcf")
+    with open(input_vcf, "w") as f:
+        f.write("##fileformat=VCFv4.2\n##contig=<ID=chr1>\n")
+        f.write('##FORMAT=<ID=GT,Number=1,Type=String,Description="Genotype">\n')
+        f.write("\t".join(["#CHROM", "POS", "ID", "REF", "ALT", "QUAL", "FILTER", "INFO", "FORMAT"] + samples) + "\n")
+        f.write("\t".join(["chr1", "100", ".", "A", "G", ".", "PASS", ".", "GT"] + ["0/1", "1/1", "0/0", "0/1", "1/1", "0/0", "0/1"]) + "\n")
+    output_vcf = osj(tmp_dir.name, "output.vcf")
+    main_barcode_fast(input_vcf, output_vcf, "POOL_APP", config, header_families=True)
+
+    output = cyvcf2.VCF(output_vcf)
+    header_families = {}
+    for line in output.raw_header.splitlines():
+        match = BARCODE_FAMILY_REGEX.match(line)
+        if match is not None:
+            header_families[match.group(1)] = (match.group(2), match.group(3))
+    assert header_families == {
+        "famA": ("POOL1,A_F", "A_F"),
+        "famB": ("B_M,B_F", "B_F"),
+        "famC": ("C_M,C_F", "C_F"),
+    }
+    var = next(output)
+    assert dict(zip(samples, var.format("BCF"))) == {
+        "POOL1": ".",
+        "A_F": "12",
+        "B_M": ".",
+        "B_F": "01",
+        "C_M": ".",
+        "C_F": "20",
+        "OTHER": ".",
+    }
+    tmp_dir.cleanup()
+
+
+def test_load_ped_cached():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    tmp_dir = tempfile.TemporaryDirectory()
+    ped_file = osj(tmp_dir.name, "FAKE_APP.json")
+    shutil.copy2(osj(current_dir, "data", "FAKE_APP.json"), ped_file)
+    cache_dir = osj(tmp_dir.name, "cache")
+
+    for _ in range(2):
+        # first call writes the cache, second one reads it
+        ped = load_ped_cached(ped_file, cache_dir)
+        assert str(ped) == str(Ped(ped_file))
+        assert len(os.listdir(cache_dir)) == 1
+
+    # cache is invalidated when the ped file changes
+    with open(ped_file) as f:
+        content = f.read().replace("fam1", "fam1_renamed")
+    with open(ped_file, "w") as f:
+        f.write(content)
+    ped = load_ped_cached(ped_file, cache_dir)
+    assert ped.get_samples_from_family("fam1") == []
+    assert len(ped.get_samples_from_family("fam1_renamed")) > 0
+    tmp_dir.cleanup()
+
+
+def test_load_ped_without_cache(monkeypatch):
+    """
+    Without ped_cache_dir, the ped is parsed and nothing is written, not even in the home directory
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    tmp_dir = tempfile.TemporaryDirectory()
+    monkeypatch.setenv("HOME", tmp_dir.name)
+    config = {"ped_dir": osj(current_dir, "data"), "app_to_ped": {"FAKE_APP": "FAKE_APP.json"}}
+    ped = load_ped(config, "FAKE_APP")
+    assert str(ped) == str(Ped(osj(current_dir, "data", "FAKE_APP.json")))
+    assert os.listdir(tmp_dir.name) == []
+    tmp_dir.cleanup()
+
+
+def test_pedigree_three_generations():
+    ped = Ped()
+    # family_id, individual_id, paternal_id, maternal_id, sex, phenotype
+    for row in (
+        ["fam", "grandmother", "", "", 2, 1],
+        ["fam", "sibling", "father", "mother", 1, 1],
+        ["fam", "index", "father", "mother", 2, 2],
+        ["fam", "mother", "grandfather", "grandmother", 2, 1],
+        ["fam", "father", "", "", 1, 1],
+        ["fam", "grandfather", "", "", 1, 1],
+    ):
+        ped[row[1]] = Sample(row)
+    assert PedigreeGraph(ped).get_barcode_samples("fam") == [
+        "index",
+        "mother",
+        "father",
+        "grandmother",
+        "grandfather",
+        "sibling",
+    ]
+
+
 if __name__ == "__main__":
     log.basicConfig(level=log.DEBUG)
     test_main_barcode_fast_family(debug_mode=True)
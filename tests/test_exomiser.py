@@ -1,10 +1,31 @@
 import filecmp
+import json
 import os
+import resource
 from os.path import join as osj
 import tempfile
 
-from vannotplus.commons import load_config, set_log_level
-from vannotplus.exomiser.exomiser import main_exomiser
+from cyvcf2 import cyvcf2
+import numpy as np
+import pytest
+
+from vannotplus.commons import atomic_write, load_config, set_log_level
+from vannotplus.exomiser.exomiser import (
+    TEMPLATE,
+    ExomiserRecords,
+    ExomiserResults,
+    get_gene_field,
+    get_gene_scores,
+    get_analyses,
+    get_job_resources,
+    get_phenotype_only_template,
+    main_exomiser,
+    write_exomiser_inputs,
+)
+from vannotplus.family.ped9 import Ped
+from vannotplus.exomiser.exomiser_cache import ExomiserCache, get_cache_key
+from vannotplus.exomiser.exomiser_resume import ExomiserManifest, get_work_dir
+from vannotplus.exomiser.exomiser_stub import STUB_FAIL_ENV
 
 def test_exomiser(debug_mode=False):
     current_dir = os.path.dirname(os.path.abspath(__file__))
@@ -28,6 +49,498 @@ def test_exomiser(debug_mode=False):
         tmp_dir.cleanup()
 
 
+def get_stub_config() -> dict:
+    """
+    Test config running the stub instead of Exomiser, without any cache
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    config["ped_dir"] = osj(current_dir, "data")
+    config["ped_cache_dir"] = ""
+    config["exomiser"]["cache_dir"] = ""
+    config["exomiser"]["runner"] = "stub"
+    return config
+
+
+def write_stub_input(input_vcf: str, n_records: int = 60) -> None:
+    """
+    Input VCF with the header of data/exomiser.vcf, and samples SGT11, SGT12 and SGT20 having varied genotypes
+    at n_records sites spread over genes of the stub (see exomiser_stub.py)
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    genotypes = ["0/1", "1/1", "0/0", "0/1", "./."]
+    with open(osj(current_dir, "data", "exomiser.vcf"), "r") as f_in, open(input_vcf, "w") as f_out:
+        for l in f_in:
+            if l.startswith("#CHROM"):
+                f_out.write("\t".join(l.split("\t")[:9] + ["SGT11", "SGT12", "SGT20"]) + "\n")
+                break
+            f_out.write(l)
+        for i in range(n_records):
+            pos = 10000 + 30000 * i
+            samples = [genotypes[(i + offset) % len(genotypes)] for offset in range(3)]
+            f_out.write("\t".join(["chr1", str(pos), ".", "A", "G", "100", "PASS", f"symbol=chr1_{pos // 100000}", "GT"] + samples) + "\n")
+
+
+def test_exomiser_stub_failure(monkeypatch):
+    """
+    A failing job cancels the jobs that did not start yet, and its error is raised once the others are over
+    """
+    config = get_stub_config()
+    tmp_dir = tempfile.TemporaryDirectory()
+    input_vcf = osj(tmp_dir.name, "input.vcf")
+    write_stub_input(input_vcf)
+    output_vcf = osj(tmp_dir.name, "out.vcf")
+    timings = osj(tmp_dir.name, "timings.tsv")
+
+    # one job at a time, in sample order: SGT11 succeeds, SGT12 fails, SGT20 does not start
+    monkeypatch.setenv(STUB_FAIL_ENV, "SGT12")
+    with pytest.raises(RuntimeError, match="SGT12"):
+        main_exomiser(input_vcf, output_vcf, "FAKE_APP", config, resume=True, timings=timings)
+    assert not os.path.exists(output_vcf)
+    with open(timings, "r") as f:
+        assert [l.split("\t")[0] for l in list(f)[1:]] == ["SGT11"]
+    work_dir = get_work_dir(output_vcf)
+    assert ExomiserManifest.load(work_dir).analyses.keys() == {"SGT11"}
+    assert not os.path.exists(osj(work_dir, "SGT20.vcf.gz"))
+
+    # resumed once the failure is fixed, only missing analyses are run
+    monkeypatch.delenv(STUB_FAIL_ENV)
+    main_exomiser(input_vcf, output_vcf, "FAKE_APP", config, resume=True, timings=timings)
+    with open(timings, "r") as f:
+        assert [l.split("\t")[0] for l in list(f)[1:]] == ["SGT12", "SGT20"]
+    expected_vcf = osj(tmp_dir.name, "expected.vcf")
+    main_exomiser(input_vcf, expected_vcf, "FAKE_APP", config)
+    assert filecmp.cmp(output_vcf, expected_vcf, shallow=False)
+    tmp_dir.cleanup()
+
+
+def get_format(vcf_path: str, field: str) -> np.ndarray:
+    return np.array([v.format(field)[:, 0].copy() for v in cyvcf2.VCF(vcf_path)])
+
+
+def test_exomiser_stub_runner():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = get_stub_config()
+    input_vcf = osj(current_dir, "data", "exomiser.vcf")
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    outputs = []
+    for i in range(2):
+        output_vcf = osj(tmp_dir.name, f"exomiser_out_{i}.vcf")
+        timings = osj(tmp_dir.name, f"timings_{i}.tsv")
+        main_exomiser(input_vcf, output_vcf, "FAKE_APP", config, timings=timings)
+        outputs.append(output_vcf)
+        with open(timings, "r") as f:
+            lines = [l.rstrip("\n").split("\t") for l in f]
+        assert lines[0] == ["analysis", "runner", "job_analyses", "wall_time", "cpu_time", "max_rss"]
+        assert [l[:3] for l in lines[1:]] == [["SGT20", "stub", "1"]]
+        assert float(lines[1][3]) > 0 and int(lines[1][5]) > 0
+
+    # the stub is deterministic, and every variant of the sample gets scores
+    assert filecmp.cmp(outputs[0], outputs[1], shallow=False)
+    vcf = cyvcf2.VCF(outputs[0])
+    n_variants = 0
+    for variant in vcf:
+        if variant.genotypes[0][:2] != [0, 0]:
+            assert not np.isnan(variant.format("EXOMISER_GENE_PHENO_SCORE")[0][0])
+            n_variants += 1
+    assert n_variants > 0
+    vcf.close()
+
+    config["exomiser"]["runner"] = "podman"
+    # unknown runners are rejected
+    with pytest.raises(ValueError):
+        main_exomiser(input_vcf, osj(tmp_dir.name, "out.vcf"), "FAKE_APP", config)
+    tmp_dir.cleanup()
+
+
+def test_exomiser_stub_batch():
+    """
+    Batch mode, with a job budget running 2 jobs at once for 3 samples, must give the same output as one job per sample
+    """
+    config = get_stub_config()
+    tmp_dir = tempfile.TemporaryDirectory()
+    input_vcf = osj(tmp_dir.name, "input.vcf")
+    write_stub_input(input_vcf)
+    config["exomiser"]["job_threads"] = "6"
+    config["exomiser"]["job_heap"] = "25G"
+    assert get_job_resources(config["exomiser"])[0] == 2
+
+    output_vcf = osj(tmp_dir.name, "out.vcf")
+    main_exomiser(input_vcf, output_vcf, "FAKE_APP", config)
+    config["exomiser"]["batch"] = True
+    batch_vcf = osj(tmp_dir.name, "out_batch.vcf")
+    timings = osj(tmp_dir.name, "timings.tsv")
+    main_exomiser(input_vcf, batch_vcf, "FAKE_APP", config, timings=timings)
+
+    with open(timings, "r") as f:
+        job_sizes = sorted(l.split("\t")[2] for l in list(f)[1:])
+    # SGT11 and SGT20 in the first job, SGT12 in the second one
+    assert job_sizes == ["1", "2", "2"]
+    assert filecmp.cmp(output_vcf, batch_vcf, shallow=False)
+    scores = get_format(batch_vcf, "EXOMISER_GENE_PHENO_SCORE")
+    assert (~np.isnan(scores)).any(axis=0).all(), "Every sample should get scores."
+    tmp_dir.cleanup()
+
+
+def check_profiles_rows(output_vcf: str, p1_field: str, p2_field: str) -> None:
+    """
+    Checks of test_exomiser_stub_profiles output, whose profiles P1 (FAKE_APP) and P2 (OTHER_APP) share the records of the input:
+    SGT12 has HPOs in P1 only, SGT11 has the same HPOs in both
+    """
+    vcf = cyvcf2.VCF(output_vcf)
+    sgt11, sgt12 = vcf.samples.index("SGT11"), vcf.samples.index("SGT12")
+    vcf.close()
+    p1 = get_format(output_vcf, p1_field)
+    p2 = get_format(output_vcf, p2_field)
+    # a sample without HPOs in a profile gets no value in it, whatever it gets in the other one
+    assert not np.isnan(p1[:, sgt12]).all()
+    assert np.isnan(p2[:, sgt12]).all()
+    # same analysis in both profiles: same values at the same records
+    assert not np.isnan(p1[:, sgt11]).all()
+    assert np.array_equal(p1[:, sgt11], p2[:, sgt11], equal_nan=True)
+
+
+def test_exomiser_stub_profiles():
+    """
+    Each profile of a multi-profile run must get the annotations of a single-profile run with its application
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = get_stub_config()
+    tmp_dir = tempfile.TemporaryDirectory()
+    input_vcf = osj(tmp_dir.name, "input.vcf")
+    write_stub_input(input_vcf)
+
+    # applications sharing some samples' HPOs, and not others
+    config["ped_dir"] = tmp_dir.name
+    with open(osj(current_dir, "data", "FAKE_APP.json"), "r") as f:
+        ped = json.load(f)
+    for app, changes in (
+        ("FAKE_APP", {}),
+        ("OTHER_APP", {"SGT20": ["HP:0000001"], "SGT12": []}),
+        ("THIRD_APP", {"SGT11": ["HP:0000002", "HP:0000003"]}),
+    ):
+        app_ped = [{**s, "HPOList": changes.get(s["id"], s["HPOList"])} for s in ped]
+        with open(osj(tmp_dir.name, app + ".json"), "w") as f:
+            json.dump(app_ped, f)
+        config["app_to_ped"][app] = app + ".json"
+
+    annots = config["exomiser"]["annotations_to_add"]
+    single_vcfs = {}
+    for app in ("FAKE_APP", "OTHER_APP", "THIRD_APP"):
+        single_vcfs[app] = osj(tmp_dir.name, f"out_{app}.vcf")
+        main_exomiser(input_vcf, single_vcfs[app], app, config)
+
+    output_vcf = osj(tmp_dir.name, "out_profiles.vcf")
+    main_exomiser(input_vcf, output_vcf, ["FAKE_APP:P1", "OTHER_APP:P2"], config)
+    for app, field in (("FAKE_APP", "P1"), ("OTHER_APP", "P2")):
+        for annot in annots:
+            expected = get_format(single_vcfs[app], annot)
+            assert np.array_equal(get_format(output_vcf, f"{field}_{annot}"), expected, equal_nan=True)
+    assert not np.array_equal(
+        get_format(output_vcf, "P1_EXOMISER_GENE_PHENO_SCORE"),
+        get_format(output_vcf, "P2_EXOMISER_GENE_PHENO_SCORE"),
+        equal_nan=True,
+    ), "Test profiles should have different HPOs."
+    for annot in annots:
+        check_profiles_rows(output_vcf, f"P1_{annot}", f"P2_{annot}")
+
+    # gene mode: pooled inputs and carriers are shared by profiles too
+    config["exomiser"]["annotations_to_add"] = ["EXOMISER_GENE_PHENO_SCORE"]
+    config["exomiser"]["gene_field"] = "symbol"
+    for app in ("FAKE_APP", "OTHER_APP"):
+        single_vcfs[app] = osj(tmp_dir.name, f"out_genes_{app}.vcf")
+        main_exomiser(input_vcf, single_vcfs[app], app, config)
+    output_vcf = osj(tmp_dir.name, "out_genes_profiles.vcf")
+    main_exomiser(input_vcf, output_vcf, ["FAKE_APP:P1", "OTHER_APP:P2"], config)
+    for app, field in (("FAKE_APP", "P1"), ("OTHER_APP", "P2")):
+        expected = get_format(single_vcfs[app], "EXOMISER_GENE_PHENO_SCORE")
+        assert np.array_equal(get_format(output_vcf, field), expected, equal_nan=True)
+    check_profiles_rows(output_vcf, "P1", "P2")
+    del config["exomiser"]["gene_field"]
+
+    # Makefile audrey target: one run instead of 3 runs whose EXOMISER_GENE_PHENO_SCORE was renamed then merged
+    config["exomiser"]["annotations_to_add"] = ["EXOMISER_GENE_PHENO_SCORE"]
+    fields = {
+        "FAKE_APP": "EXOMISER_1_PATHOLOGIE",
+        "OTHER_APP": "EXOMISER_2_PRESCRIPTION",
+        "THIRD_APP": "EXOMISER_3_COMPTERENDU",
+    }
+    output_vcf = osj(tmp_dir.name, "out_audrey.vcf")
+    main_exomiser(input_vcf, output_vcf, [f"{app}:{field}" for app, field in fields.items()], config)
+    vcf = cyvcf2.VCF(output_vcf)
+    output_fields = [h["ID"] for h in vcf.header_iter() if h["HeaderType"] == "FORMAT" and h["ID"].startswith("EXOMISER")]
+    vcf.close()
+    assert output_fields == list(fields.values())
+    for app, field in fields.items():
+        expected = get_format(single_vcfs[app], "EXOMISER_GENE_PHENO_SCORE")
+        assert np.array_equal(get_format(output_vcf, field), expected, equal_nan=True)
+    tmp_dir.cleanup()
+
+
+def test_get_gene_scores():
+    tmp_dir = tempfile.TemporaryDirectory()
+    tsv = osj(tmp_dir.name, "SGT20.genes.tsv")
+    with open(tsv, "w") as f:
+        f.write("#RANK\tID\tGENE_SYMBOL\tENTREZ_GENE_ID\tMOI\tP-VALUE\tEXOMISER_GENE_COMBINED_SCORE\tEXOMISER_GENE_PHENO_SCORE\n")
+        f.write("1\tALMS1_AR\tALMS1\t7840\tAR\t0.01\t0.95\t0.9\n")
+        f.write("2\tPKD1_AD\tPKD1\t5310\tAD\t0.2\t0.5\t0.4\n")
+        f.write("3\tALMS1_AD\tALMS1\t7840\tAD\t0.3\t0.2\t0.45\n")
+    # the best ranked mode of inheritance of each gene is kept
+    assert get_gene_scores(tsv) == {
+        "ALMS1": {"EXOMISER_GENE_PHENO_SCORE": "0.9"},
+        "PKD1": {"EXOMISER_GENE_PHENO_SCORE": "0.4"},
+    }
+
+    with open(tsv, "w") as f:
+        f.write("#RANK\tID\tGENE_SYMBOL\n")
+    # a genes TSV without gene-level columns is rejected
+    with pytest.raises(ValueError):
+        get_gene_scores(tsv)
+    tmp_dir.cleanup()
+
+
+def test_get_job_resources():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    # default: one job using the whole budget
+    assert get_job_resources(config["exomiser"]) == (1, "75G", "12")
+
+    # limited by heap
+    config["exomiser"]["job_heap"] = "25G"
+    config["exomiser"]["job_threads"] = "2"
+    assert get_job_resources(config["exomiser"]) == (3, "25G", "2")
+
+    # limited by threads
+    config["exomiser"]["job_threads"] = "6"
+    assert get_job_resources(config["exomiser"]) == (2, "25G", "6")
+
+    config["exomiser"]["job_heap"] = "100G"
+    # job_heap cannot exceed heap
+    with pytest.raises(ValueError):
+        get_job_resources(config["exomiser"])
+
+
+def test_exomiser_cache():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    input_vcf = osj(current_dir, "data", "exomiser.vcf")
+    with open(TEMPLATE, "r") as f:
+        template = json.load(f)
+    tmp_dir = tempfile.TemporaryDirectory()
+
+    key = get_cache_key(input_vcf, ["HP:2", "HP:1"], template, "exomiser")
+    # HPO order, run-specific paths and names do not matter
+    template["analysis"]["vcf"] = "/another/path.vcf"
+    template["outputOptions"]["outputDirectory"] = "/another/dir"
+    assert get_cache_key(input_vcf, ["HP:1", "HP:2"], template, "exomiser") == key
+    assert get_cache_key(input_vcf, ["HP:1"], template, "exomiser") != key
+    assert get_cache_key(input_vcf, ["HP:1", "HP:2"], template, "exomiser2") != key
+    template["analysis"]["analysisMode"] = "PASS_ONLY"
+    assert get_cache_key(input_vcf, ["HP:1", "HP:2"], template, "exomiser") != key
+
+    cache = ExomiserCache(osj(tmp_dir.name, "cache"), max_size=10**6)
+    assert cache.get(key) is None
+    value = {"chr1_1_A_T": {"EXOMISER_GENE_PHENO_SCORE": "0.5"}}
+    cache.put(key, value)
+    assert cache.get(key) == value
+
+    # least recently used entries are removed first
+    cache.put("other", value)
+    os.utime(cache.get_path(key), ns=(0, 0))
+    cache.max_size = os.path.getsize(cache.get_path("other"))
+    cache.evict()
+    assert cache.get(key) is None
+    assert cache.get("other") == value
+    tmp_dir.cleanup()
+
+
+def test_exomiser_manifest():
+    tmp_dir = tempfile.TemporaryDirectory()
+    value = {"chr1_1_A_T": {"EXOMISER_GENE_PHENO_SCORE": "0.5"}}
+    manifest = ExomiserManifest.load(tmp_dir.name)
+    assert manifest.get("SGT1", "key") is None
+    manifest.add("SGT1", "key", value)
+
+    # a resumed run finds completed analyses, unless their inputs changed
+    resumed = ExomiserManifest.load(tmp_dir.name)
+    assert resumed.get("SGT1", "key") == value
+    assert resumed.get("SGT1", "other_key") is None
+    assert resumed.get("SGT2", "key") is None
+    assert sorted(os.listdir(tmp_dir.name)) == ["SGT1_result.pkl", "manifest.json"]
+
+    # a failed write leaves the previous file untouched and no temporary file behind
+    with pytest.raises(ValueError):
+        with atomic_write(resumed.path, "w") as f:
+            f.write("{truncated")
+            raise ValueError
+    assert ExomiserManifest.load(tmp_dir.name).get("SGT1", "key") == value
+    assert sorted(os.listdir(tmp_dir.name)) == ["SGT1_result.pkl", "manifest.json"]
+
+    with open(resumed.path, "w") as f:
+        f.write("{truncated")
+    assert ExomiserManifest.load(tmp_dir.name).get("SGT1", "key") is None
+    tmp_dir.cleanup()
+
+
+def test_get_phenotype_only_template():
+    with open(TEMPLATE, "r") as f:
+        template = json.load(f)
+    reduced = get_phenotype_only_template(template)
+    assert reduced["analysis"]["frequencySources"] == []
+    assert reduced["analysis"]["pathogenicitySources"] == []
+    assert reduced["analysis"]["steps"] == [{"omimPrioritiser": {}}, {"hiPhivePrioritiser": {}}]
+    assert reduced["analysis"]["inheritanceModes"] == template["analysis"]["inheritanceModes"]
+    assert reduced["outputOptions"] == template["outputOptions"]
+    # the shipped template is left untouched
+    assert len(template["analysis"]["frequencySources"]) > 0
+
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    config["exomiser"]["annotations_to_add"] = ["EXOMISER_GENE_PHENO_SCORE", "EXOMISER_P_VALUE"]
+    # variant-level annotations cannot be added in phenotype-only mode
+    with pytest.raises(ValueError):
+        main_exomiser("in.vcf", "out.vcf", "APP", config, phenotype_only=True)
+
+
+def test_get_analyses():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    ped = Ped(osj(current_dir, "data", "FAKE_APP.json"))
+    ped["SGT12"].HPO = list(reversed(ped["SGT11"].HPO))
+    samples = ["SGT20", "SGT1", "SGT12", "SGT11"]
+
+    # one input and analysis per sample with HPOs
+    inputs, analyses = get_analyses(samples, [ped])
+    assert inputs == {"SGT20": ["SGT20"], "SGT12": ["SGT12"], "SGT11": ["SGT11"]}
+    assert {name: a.members for name, a in analyses.items()} == {
+        "SGT20": [(0, "SGT20")],
+        "SGT12": [(0, "SGT12")],
+        "SGT11": [(0, "SGT11")],
+    }
+
+    # gene mode: one input and analysis per HPO set, including the sets of a second profile
+    other_ped = Ped(osj(current_dir, "data", "FAKE_APP.json"))
+    other_ped["SGT20"].HPO = ["HP:0000001"]
+    other_ped["SGT12"].HPO = ped["SGT12"].HPO
+    inputs, analyses = get_analyses(samples, [ped, other_ped], gene_field="GNOMEN")
+    assert inputs == {"SGT20": ["SGT20"], "SGT12": ["SGT12", "SGT11"], "SGT20_2": ["SGT20"]}
+    assert {name: (a.input_name, a.members) for name, a in analyses.items()} == {
+        "SGT20": ("SGT20", [(0, "SGT20")]),
+        "SGT12": ("SGT12", [(0, "SGT12"), (0, "SGT11"), (1, "SGT12"), (1, "SGT11")]),
+        "SGT20_2": ("SGT20_2", [(1, "SGT20")]),
+    }
+
+    # gene scores are only used with a gene field and gene-level annotations
+    assert get_gene_field(config, ["EXOMISER_GENE_PHENO_SCORE"]) is None
+    config["exomiser"]["gene_field"] = "GNOMEN"
+    assert get_gene_field(config, ["EXOMISER_GENE_PHENO_SCORE"]) == "GNOMEN"
+    assert get_gene_field(config, config["exomiser"]["annotations_to_add"]) is None
+
+
+def test_write_exomiser_inputs():
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    input_vcf = osj(current_dir, "data", "test_family.vcf")
+    tmp_dir = tempfile.TemporaryDirectory()
+
+    # hom-ref and no-call records are skipped
+    write_exomiser_inputs(input_vcf, {"SGT15": ["SGT15"], "SGT999": ["SGT999"]}, tmp_dir.name)
+    for sample, expected in (("SGT15", ["1/1", "0/1"]), ("SGT999", ["1/1", "0/1"])):
+        vcf = cyvcf2.VCF(osj(tmp_dir.name, sample + "_exomiserinput.vcf"))
+        assert vcf.samples == [sample]
+        genotypes = []
+        for variant in vcf:
+            assert dict(variant.INFO) == {}
+            genotypes.append(str(variant).strip().split("\t")[9])
+        assert genotypes == expected
+
+    # pooled genotypes: one sample, at sites carried by any of the samples, homozygous if one of them is
+    write_exomiser_inputs(input_vcf, {"SGT11": ["SGT15", "SGT999"]}, tmp_dir.name, pool_genotypes=True)
+    vcf = cyvcf2.VCF(osj(tmp_dir.name, "SGT11_exomiserinput.vcf"))
+    assert vcf.samples == ["SGT11"]
+    assert [str(variant).strip().split("\t")[8:] for variant in vcf] == [["GT", "1/1"], ["GT", "0/1"]]
+    # GT is declared once, whether the input declares it or not
+    assert vcf.raw_header.count("##FORMAT=<ID=GT,") == 1
+    no_gt_vcf = osj(tmp_dir.name, "test_family_no_gt.vcf")
+    with open(input_vcf, "r") as f_in, open(no_gt_vcf, "w") as f_out:
+        f_out.writelines(l for l in f_in if not l.startswith("##FORMAT=<ID=GT,"))
+    write_exomiser_inputs(no_gt_vcf, {"SGT11": ["SGT15", "SGT999"]}, tmp_dir.name, pool_genotypes=True)
+    with open(osj(tmp_dir.name, "SGT11_exomiserinput.vcf"), "r") as f:
+        assert f.read().count("##FORMAT=<ID=GT,") == 1
+
+    # every input record is registered, rows of the results follow input order
+    vcf = cyvcf2.VCF(input_vcf)
+    records = ExomiserRecords()
+    results = ExomiserResults(["EXOMISER_GENE_PHENO_SCORE"], records, vcf.samples, ["SGT15", "SGT999"])
+    write_exomiser_inputs(input_vcf, {"SGT15": ["SGT15"]}, tmp_dir.name, records=records)
+    assert records.n_records == 3
+    key = next(iter(records.rows))
+    results.fill("SGT15", {key: {"EXOMISER_GENE_PHENO_SCORE": "0.5"}})
+    for row in range(records.n_records):
+        values = results.get_row("EXOMISER_GENE_PHENO_SCORE", row)
+        assert values.dtype == np.float32
+        expected = [np.nan, np.nan, np.nan, 0.5 if row in records.rows[key] else np.nan, np.nan]
+        assert np.array_equal(values, np.array(expected, dtype=np.float32), equal_nan=True)
+
+    # gene mode: gene scores are only given to samples carrying an alternative allele
+    gene_vcf = osj(tmp_dir.name, "test_family_gene.vcf")
+    with open(input_vcf, "r") as f_in, open(gene_vcf, "w") as f_out:
+        for l in f_in:
+            if l.startswith("#CHROM"):
+                f_out.write('##INFO=<ID=GNOMEN,Number=1,Type=String,Description="Gene">\n')
+            elif not l.startswith("#"):
+                fields = l.split("\t")
+                fields[7] = "GNOMEN=G1"
+                l = "\t".join(fields)
+            f_out.write(l)
+    records = ExomiserRecords("GNOMEN")
+    results = ExomiserResults(["EXOMISER_GENE_PHENO_SCORE"], records, vcf.samples, vcf.samples)
+    # profiles share the records, each one only scores its own samples
+    other_results = ExomiserResults(["EXOMISER_GENE_PHENO_SCORE"], records, vcf.samples, ["SGT15"])
+    write_exomiser_inputs(gene_vcf, {"SGT11": vcf.samples}, tmp_dir.name, pool_genotypes=True, records=records)
+    for s in vcf.samples:
+        results.fill(s, {"G1": {"EXOMISER_GENE_PHENO_SCORE": "0.5"}})
+    other_results.fill("SGT15", {"G1": {"EXOMISER_GENE_PHENO_SCORE": "0.25"}})
+    # gt_types is a view on the record, copied before the next one is read
+    carried = np.array([v.gt_types.copy() for v in cyvcf2.VCF(gene_vcf)])
+    carried = (carried == 1) | (carried == 3)
+    sgt15 = vcf.samples.index("SGT15")
+    for row in range(records.n_records):
+        values = results.get_row("EXOMISER_GENE_PHENO_SCORE", row)
+        assert np.array_equal(np.isnan(values), ~carried[row])
+        other_values = other_results.get_row("EXOMISER_GENE_PHENO_SCORE", row)
+        expected = np.full(len(vcf.samples), np.nan, dtype=np.float32)
+        if carried[row, sgt15]:
+            expected[sgt15] = 0.25
+        assert np.array_equal(other_values, expected, equal_nan=True)
+    assert (~carried).sum() > 0, "Test data should have hom-ref or no-call genotypes."
+    tmp_dir.cleanup()
+
+
+def test_write_exomiser_inputs_open_files():
+    """
+    Inputs are written one file at a time, so that there can be more inputs than open files allowed
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    input_vcf = osj(current_dir, "data", "test_family.vcf")
+    tmp_dir = tempfile.TemporaryDirectory()
+    inputs = {f"SGT15_{i}": ["SGT15"] for i in range(200)}
+    soft, hard = resource.getrlimit(resource.RLIMIT_NOFILE)
+    resource.setrlimit(resource.RLIMIT_NOFILE, (len(os.listdir("/proc/self/fd")) + 20, hard))
+    try:
+        # flushed after each record
+        write_exomiser_inputs(input_vcf, inputs, tmp_dir.name, buffer_size=1)
+    finally:
+        resource.setrlimit(resource.RLIMIT_NOFILE, (soft, hard))
+
+    write_exomiser_inputs(input_vcf, {"SGT15": ["SGT15"]}, tmp_dir.name)
+    with open(osj(tmp_dir.name, "SGT15_exomiserinput.vcf"), "r") as f:
+        expected = f.read()
+    for name in inputs:
+        with open(osj(tmp_dir.name, name + "_exomiserinput.vcf"), "r") as f:
+            assert f.read() == expected.replace("\tSGT15\n", f"\t{name}\n", 1)
+    tmp_dir.cleanup()
+
+
 if __name__ == "__main__":
     set_log_level("DEBUG") # will also keep exomiser's container's temporary files
     test_exomiser(debug_mode=True)
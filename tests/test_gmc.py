@@ -1,9 +1,18 @@
 import filecmp
+import gzip
 import os
 from os.path import join as osj
+import shutil
 import tempfile
 
-from vannotplus.commons import load_config, set_log_level
+from cyvcf2 import cyvcf2
+import numpy as np
+import pysam
+import pytest
+
+from vannotplus.commons import get_indexed_contigs, load_config, set_log_level
+from vannotplus.annot.gmc import FilteredGmcFilter, get_gmc_index, variant_to_filtered_counts
+from vannotplus.annot.gmc_cache import GmcCache, get_incremental_gmc_index
 from vannotplus.annot.score import main_annot
 
 
@@ -48,6 +57,340 @@ def test_filtered_gmc(debug_mode=False):
     if not debug_mode:
         tmp_dir.cleanup()
 
+def test_gmc_multiallelic(debug_mode=False):
+    """
+    Control was checked against the same input normalized with bcftools norm -m-: each split record gets the GMC and GMC_FILTERED of its multiallelic record
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    input_vcf = osj(current_dir, "data", "gmc_multiallelic_input.vcf")
+    control_vcf = osj(current_dir, "controls", "gmc_multiallelic_control.vcf")
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    output_vcf = osj(tmp_dir.name, "gmc_multiallelic_out.vcf")
+    main_annot(input_vcf, output_vcf, config, do_vannotscore=False, do_filtered_gmc=True)
+
+    assert os.path.exists(output_vcf), "Output VCF file was not created."
+    assert filecmp.cmp(
+        output_vcf, control_vcf
+    ), f"Output {output_vcf} does not match control {control_vcf}."
+
+    if not debug_mode:
+        tmp_dir.cleanup()
+
+def test_gmc_streaming(debug_mode=False):
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    input_vcf = osj(current_dir, "data", "gmc_mini_input.vcf")
+    control_vcf = osj(current_dir, "controls", "gmc_mini_control.vcf")
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    output_vcf = osj(tmp_dir.name, "gmc_mini_streaming_out.vcf")
+    config["gmc"]["do_filtered_gmc"] = False
+    main_annot(input_vcf, output_vcf, config, do_vannotscore=False, do_filtered_gmc=False, streaming=True)
+
+    assert os.path.exists(output_vcf), "Output VCF file was not created."
+    assert filecmp.cmp(
+        output_vcf, control_vcf
+    ), f"Output {output_vcf} does not match control {control_vcf}."
+
+    if not debug_mode:
+        tmp_dir.cleanup()
+
+def test_gmc_streaming_filtered(debug_mode=False):
+    """
+    Streaming output with filtered GMC must be the same as the two-pass output
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    input_vcf = osj(current_dir, "data", "filtered_gmc_input.vcf")
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    outputs = []
+    for streaming in (False, True):
+        output_vcf = osj(tmp_dir.name, f"filtered_gmc_streaming_{streaming}_out.vcf")
+        main_annot(input_vcf, output_vcf, config, do_vannotscore=False, do_filtered_gmc=True, streaming=streaming)
+        outputs.append(output_vcf)
+    assert filecmp.cmp(*outputs), f"Streaming output {outputs[1]} does not match two-pass output {outputs[0]}."
+
+    if not debug_mode:
+        tmp_dir.cleanup()
+
+def test_gmc_streaming_errors(debug_mode=False):
+    """
+    Streaming refuses unsorted inputs, and genes spanning more than max_gene_span bases
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    input_vcf = osj(current_dir, "data", "filtered_gmc_input.vcf")
+    tmp_dir = tempfile.TemporaryDirectory()
+    output_vcf = osj(tmp_dir.name, "gmc_streaming_errors_out.vcf")
+
+    # chr1:3000 after chr1:4000
+    unsorted_vcf = osj(tmp_dir.name, "unsorted_input.vcf")
+    with open(input_vcf, "r") as f:
+        lines = f.readlines()
+    first = next(i for i, l in enumerate(lines) if not l.startswith("#"))
+    lines[first + 2], lines[first + 3] = lines[first + 3], lines[first + 2]
+    with open(unsorted_vcf, "w") as f:
+        f.writelines(lines)
+    with pytest.raises(ValueError, match="coordinate-sorted"):
+        main_annot(unsorted_vcf, output_vcf, config, do_vannotscore=False, do_filtered_gmc=True, streaming=True)
+
+    # TP53 spans 13kb
+    config["gmc"]["max_gene_span"] = 5000
+    with pytest.raises(ValueError, match="TP53"):
+        main_annot(input_vcf, output_vcf, config, do_vannotscore=False, do_filtered_gmc=True, streaming=True)
+
+    if not debug_mode:
+        tmp_dir.cleanup()
+
+def test_gmc_table(debug_mode=False):
+    """
+    First run creates the GMC table, second run reuses it: both must match the control
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    input_vcf = osj(current_dir, "data", "gmc_mini_input.vcf")
+    control_vcf = osj(current_dir, "controls", "gmc_mini_control.vcf")
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    gmc_table = osj(tmp_dir.name, "gmc_table.npz")
+    config["gmc"]["do_filtered_gmc"] = False
+    for i in range(2):
+        output_vcf = osj(tmp_dir.name, f"gmc_mini_table_out_{i}.vcf")
+        main_annot(input_vcf, output_vcf, config, do_vannotscore=False, do_filtered_gmc=False, gmc_table=gmc_table)
+        assert os.path.exists(gmc_table), "GMC table was not created."
+        assert filecmp.cmp(
+            output_vcf, control_vcf
+        ), f"Output {output_vcf} does not match control {control_vcf}."
+
+    if not debug_mode:
+        tmp_dir.cleanup()
+
+def write_vcf_variant(input_vcf: str, output_vcf: str, samples: list[int] | None = None, changed_genotype: str | None = None) -> None:
+    """
+    Copy input_vcf to output_vcf, keeping only samples (column indexes) if set,
+    and replacing the FORMAT values of the second sample of the first record by changed_genotype if set
+    """
+    with open(input_vcf, "r") as f_in, open(output_vcf, "w") as f_out:
+        first = True
+        for l in f_in:
+            if not l.startswith("##"):
+                fields = l.rstrip("\n").split("\t")
+                if not l.startswith("#") and first and changed_genotype is not None:
+                    fields[10] = changed_genotype
+                if not l.startswith("#"):
+                    first = False
+                if samples is not None:
+                    fields = fields[:9] + [fields[9 + i] for i in samples]
+                l = "\t".join(fields) + "\n"
+            f_out.write(l)
+
+def assert_same_gmc(index, expected) -> None:
+    assert index.samples == expected.samples
+    assert index.n_records == expected.n_records
+    for record in range(expected.n_records):
+        gmc, filtered_gmc = index.get(record)
+        expected_gmc, expected_filtered_gmc = expected.get(record)
+        if expected_gmc is None:
+            assert gmc is None
+        else:
+            assert np.array_equal(gmc, expected_gmc)
+            assert np.array_equal(filtered_gmc, expected_filtered_gmc)
+
+def test_gmc_table_incremental():
+    """
+    GMC computed with a table must equal a fresh count when samples are added, when a sample's genotypes change, and when the gmc config changes
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    input_vcf = osj(current_dir, "data", "filtered_gmc_input.vcf")
+    tmp_dir = tempfile.TemporaryDirectory()
+    gmc_table = osj(tmp_dir.name, "gmc_table.npz")
+
+    # (a) table built on a subset of samples, then a new sample appears
+    subset_vcf = osj(tmp_dir.name, "subset.vcf")
+    write_vcf_variant(input_vcf, subset_vcf, samples=[0, 1])
+    get_incremental_gmc_index(subset_vcf, config["gmc"], True, gmc_table)
+    assert GmcCache.load(gmc_table).samples == ["SAMPLE1", "SAMPLE2"]
+    index = get_incremental_gmc_index(input_vcf, config["gmc"], True, gmc_table)
+    assert_same_gmc(index, get_gmc_index(input_vcf, config["gmc"], do_filtered_gmc=True))
+    assert GmcCache.load(gmc_table).samples == ["SAMPLE1", "SAMPLE2", "SAMPLE3"]
+
+    # (b) genotypes of one sample change between runs
+    changed_vcf = osj(tmp_dir.name, "changed.vcf")
+    write_vcf_variant(input_vcf, changed_vcf, changed_genotype="0/1:0.30:40:28,12")
+    expected = get_gmc_index(changed_vcf, config["gmc"], do_filtered_gmc=True)
+    assert not np.array_equal(
+        expected.get(0)[0], get_gmc_index(input_vcf, config["gmc"], do_filtered_gmc=True).get(0)[0]
+    ), "Test data should change GMC."
+    fingerprints = GmcCache.load(gmc_table).fingerprints
+    index = get_incremental_gmc_index(changed_vcf, config["gmc"], True, gmc_table)
+    assert_same_gmc(index, expected)
+    new_fingerprints = GmcCache.load(gmc_table).fingerprints
+    assert [a == b for a, b in zip(fingerprints, new_fingerprints)] == [True, False, True]
+
+    # (c) the gmc config changes: the table is not used
+    config["gmc"]["vaf_threshold"] = 0.5
+    expected = get_gmc_index(changed_vcf, config["gmc"], do_filtered_gmc=True)
+    assert not np.array_equal(expected.filtered_gmc, index.filtered_gmc), "Test config should change filtered GMC."
+    index = get_incremental_gmc_index(changed_vcf, config["gmc"], True, gmc_table)
+    assert_same_gmc(index, expected)
+    tmp_dir.cleanup()
+
+def test_gmc_max_memory(debug_mode=False):
+    """
+    With a null memory budget, GMC counts are entirely spilled to disk: output must not change
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    input_vcf = osj(current_dir, "data", "gmc_mini_input.vcf")
+    control_vcf = osj(current_dir, "controls", "gmc_mini_control.vcf")
+
+    tmp_dir = tempfile.TemporaryDirectory()
+    output_vcf = osj(tmp_dir.name, "gmc_mini_max_memory_out.vcf")
+    config["gmc"]["do_filtered_gmc"] = False
+    main_annot(input_vcf, output_vcf, config, do_vannotscore=False, do_filtered_gmc=False, max_memory=0)
+
+    assert os.path.exists(output_vcf), "Output VCF file was not created."
+    assert filecmp.cmp(
+        output_vcf, control_vcf
+    ), f"Output {output_vcf} does not match control {control_vcf}."
+    assert os.listdir(tmp_dir.name) == ["gmc_mini_max_memory_out.vcf"], "Spilled GMC files were not removed."
+
+    if not debug_mode:
+        tmp_dir.cleanup()
+
+def get_records(vcf_path: str) -> list[str]:
+    """
+    Lines of vcf_path (plain or compressed) without meta-information lines
+    """
+    with (gzip.open(vcf_path, "rt") if vcf_path.endswith(".gz") else open(vcf_path, "r")) as f:
+        return [l for l in f if not l.startswith("##")]
+
+def test_gmc_threads(debug_mode=False):
+    """
+    Parallel annot on bgzipped inputs indexed with tabix or CSI, to plain and bgzipped outputs, must match the controls
+    filtered_gmc_control.vcf only differs from the current output by the description of GMC_FILTERED, so only records are compared for it
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    tmp_dir = tempfile.TemporaryDirectory()
+    for name, control, do_filtered_gmc in (
+        ("gmc_mini_input", "gmc_mini_control.vcf", False),
+        ("filtered_gmc_input", "filtered_gmc_control.vcf", True),
+    ):
+        config = load_config(osj(current_dir, "data", "config.yml"))
+        config["gmc"]["do_filtered_gmc"] = do_filtered_gmc
+        control_vcf = osj(current_dir, "controls", control)
+        for csi in (False, True):
+            input_vcf = osj(tmp_dir.name, f"{name}_{csi}.vcf")
+            shutil.copy(osj(current_dir, "data", name + ".vcf"), input_vcf)
+            input_vcf = pysam.tabix_index(input_vcf, preset="vcf", csi=csi)
+            assert get_indexed_contigs(input_vcf) == ["chr1"]
+
+            for extension in (".vcf", ".vcf.gz"):
+                output_vcf = osj(tmp_dir.name, f"{name}_{csi}_out{extension}")
+                main_annot(input_vcf, output_vcf, config, do_vannotscore=False, do_filtered_gmc=do_filtered_gmc, threads=2)
+                if extension == ".vcf" and not do_filtered_gmc:
+                    assert filecmp.cmp(output_vcf, control_vcf), f"Output {output_vcf} does not match control {control_vcf}."
+                assert get_records(output_vcf) == get_records(control_vcf), f"Output {output_vcf} does not match control {control_vcf}."
+                if extension == ".vcf.gz":
+                    # a valid BGZF file can be indexed again
+                    pysam.tabix_index(output_vcf, preset="vcf", force=True, keep_original=True)
+                    assert get_indexed_contigs(output_vcf) == ["chr1"]
+                    with gzip.open(output_vcf, "rt") as f_out, open(osj(tmp_dir.name, f"{name}_{csi}_out.vcf"), "r") as f:
+                        assert f_out.read() == f.read()
+
+    if not debug_mode:
+        tmp_dir.cleanup()
+
+def test_gmc_threads_contigs(debug_mode=False):
+    """
+    With several contigs, chunks of each contig are concatenated in the input's order: output must match the single process one
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    tmp_dir = tempfile.TemporaryDirectory()
+    input_vcf = osj(tmp_dir.name, "contigs_input.vcf")
+    with open(osj(current_dir, "data", "filtered_gmc_input.vcf"), "r") as f:
+        lines = f.readlines()
+    header = [l for l in lines if l.startswith("#")]
+    records = [l for l in lines if not l.startswith("#")]
+    with open(input_vcf, "w") as f:
+        f.writelines(header[:-1])
+        f.write("##contig=<ID=chr1>\n##contig=<ID=chr2>\n##contig=<ID=chr10>\n")
+        f.write(header[-1])
+        f.writelines(records)
+        # records of the second half on other contigs, gene names are shared across contigs
+        for contig, half in (("chr2", records[: len(records) // 2]), ("chr10", records[len(records) // 2 :])):
+            f.writelines(contig + l[len("chr1") :] for l in half)
+    input_vcf = pysam.tabix_index(input_vcf, preset="vcf")
+    assert get_indexed_contigs(input_vcf) == ["chr1", "chr2", "chr10"]
+
+    expected_vcf = osj(tmp_dir.name, "contigs_expected.vcf")
+    main_annot(input_vcf, expected_vcf, config, do_vannotscore=False, do_filtered_gmc=True)
+    for extension in (".vcf", ".vcf.gz"):
+        output_vcf = osj(tmp_dir.name, "contigs_out" + extension)
+        main_annot(input_vcf, output_vcf, config, do_vannotscore=False, do_filtered_gmc=True, threads=3)
+        assert get_records(output_vcf) == get_records(expected_vcf)
+    pysam.tabix_index(output_vcf, preset="vcf", force=True, keep_original=True)
+    assert get_indexed_contigs(output_vcf) == ["chr1", "chr2", "chr10"]
+
+    if not debug_mode:
+        tmp_dir.cleanup()
+
+def test_filtered_gmc_filter():
+    """
+    The vectorized filter must give the same result as the record by record reference implementation
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    vcf = cyvcf2.VCF(osj(current_dir, "data", "filtered_gmc_input.vcf"), gts012=True)
+    variants = list(vcf)
+    default_filtered_gmc = np.zeros(len(vcf.samples), dtype=np.int32)
+
+    expected = np.array([variant_to_filtered_counts(v, default_filtered_gmc, config["gmc"]) for v in variants])
+    gt_types = np.array([v.gt_types for v in variants])
+    result = FilteredGmcFilter(config["gmc"]).evaluate(variants, gt_types)
+
+    assert np.array_equal(result, expected)
+    assert result.sum() > 0, "No variant passed the filter, test data should be updated."
+
+def test_filtered_gmc_without_vaf(debug_mode=False):
+    """
+    Without VAF in the input, every sample passes the VAF filter
+    """
+    current_dir = os.path.dirname(os.path.abspath(__file__))
+    config = load_config(osj(current_dir, "data", "config.yml"))
+    tmp_dir = tempfile.TemporaryDirectory()
+    input_vcf = osj(tmp_dir.name, "filtered_gmc_no_vaf_input.vcf")
+    with open(osj(current_dir, "data", "filtered_gmc_input.vcf"), "r") as f_in, open(input_vcf, "w") as f_out:
+        for l in f_in:
+            if l.startswith("##FORMAT=<ID=VAF,"):
+                continue
+            if not l.startswith("#"):
+                fields = l.rstrip("\n").split("\t")
+                # drop VAF, the second FORMAT field
+                fields[8:] = [":".join(v for i, v in enumerate(col.split(":")) if i != 1) for col in fields[8:]]
+                l = "\t".join(fields) + "\n"
+            f_out.write(l)
+
+    vcf = cyvcf2.VCF(input_vcf, gts012=True)
+    variants = list(vcf)
+    default_filtered_gmc = np.zeros(len(vcf.samples), dtype=np.int32)
+    expected = np.array([variant_to_filtered_counts(v, default_filtered_gmc, config["gmc"]) for v in variants])
+    gt_types = np.array([v.gt_types for v in variants])
+    assert np.array_equal(FilteredGmcFilter(config["gmc"]).evaluate(variants, gt_types), expected)
+    vcf.close()
+
+    output_vcf = osj(tmp_dir.name, "filtered_gmc_no_vaf_out.vcf")
+    main_annot(input_vcf, output_vcf, config, do_vannotscore=False, do_filtered_gmc=True)
+    assert os.path.exists(output_vcf), "Output VCF file was not created."
+
+    if not debug_mode:
+        tmp_dir.cleanup()
+
 if __name__ == "__main__":
     set_log_level("DEBUG")
     test_gmc(debug_mode=True)